@@ -6,6 +6,8 @@ import argparse
 import datetime
 import fcntl
 import getpass
+import heapq
+import itertools
 import logging
 import logging.handlers
 import os
@@ -155,8 +157,20 @@ class SingleSigner(object):
             else:
                 raise ValueError("tag must be specified")
 
+        return self.sign_tasks([signing_task])[0]
+
+    def sign_tasks(self, signing_tasks):
+        """ Sign the RPMs of several builds with a single sigul call per
+        attempt.
+
+        :returns: list with the signing task for each build that was
+            processed, ``task.unsigned`` contains the RPMs that are still
+            unsigned. None is used for builds that cannot be signed at all.
+        """
+        build_ids = ", ".join(str(t.build_id) for t in signing_tasks)
+
         def log_(level, msg, *args, **kwargs):
-            log_infos = dict(build_id=signing_task.build_id,
+            log_infos = dict(build_id=build_ids,
                              instance=self.instance, key=self.key,)
             log_infos.update(kwargs)
             log_function = getattr(log, level)
@@ -165,18 +179,32 @@ class SingleSigner(object):
 
         log_("debug", "Start processing using key {key}")
 
-        # Verify fedmsg data
-        if not self.kojihelper.check_build_is_tagged(signing_task.build_id,
-                                                     signing_task.tag):
-            log_("error", "Build not in expected tag")
-            return None
-
-        rpminfo = self.kojihelper.get_rpms(signing_task.build_id)
-        if len(rpminfo) == 0:
-            log_("error", "No RPMs found")
-            return None
-        else:
-            log_("debug", "Found {count} RPMs", count=len(rpminfo))
+        results = []
+        task_rpms = []
+        rpminfo = {}
+        for signing_task in signing_tasks:
+            # Verify fedmsg data
+            if not self.kojihelper.check_build_is_tagged(
+                    signing_task.build_id, signing_task.tag):
+                log_("error", "Build {0} not in expected tag",
+                     signing_task.build_id)
+                results.append(None)
+                continue
+
+            build_rpminfo = self.kojihelper.get_rpms(signing_task.build_id)
+            if len(build_rpminfo) == 0:
+                log_("error", "No RPMs found for build {0}",
+                     signing_task.build_id)
+                results.append(None)
+                continue
+            results.append(signing_task)
+            task_rpms.append((signing_task, build_rpminfo))
+            rpminfo.update(build_rpminfo)
+
+        if not rpminfo:
+            return results
+
+        log_("debug", "Found {count} RPMs", count=len(rpminfo))
 
         rpm_log_list = ", ".join(list(rpminfo)[0:10])
         if len(list(rpminfo)) > 10:
@@ -243,18 +271,112 @@ class SingleSigner(object):
         else:
             log_("info", "Completed: {rpms}", rpms=", ".join(
                 sorted(list(rpminfo))))
-        signing_task.unsigned = unsigned
-        return signing_task
+        for signing_task, build_rpminfo in task_rpms:
+            signing_task.unsigned = dict(
+                (rpm, rpm_id) for rpm, rpm_id in build_rpminfo.items()
+                if rpm in unsigned)
+        return results
+
+
+class SigningWorker(threading.Thread):
+    """ Sign builds for one (instance, key) signer in its own thread.
+
+    Tasks are kept in a heap ordered by the time they are due. New tasks are
+    due ``coalesce_window`` seconds after they were queued, so builds tagged
+    in a burst are signed with a single sigul call. Incomplete tasks are
+    queued again with an increasing delay.
+    """
+    max_batch_size = 50
+
+    def __init__(self, instance, key, password, coalesce_window=10):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.name = "{0}_{1}".format(instance, key)
+        self.instance = instance
+        self.key = key
+        self.password = password
+        self.coalesce_window = coalesce_window
+        self.signer = None
+        self.queue = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+
+    def put(self, signing_task, delay=None):
+        if delay is None:
+            delay = self.coalesce_window
+        with self.condition:
+            heapq.heappush(self.queue, (time.time() + delay,
+                                        next(self.counter), signing_task))
+            self.condition.notify()
+
+    def wake_retries(self):
+        """ Make all queued tasks due now, e.g. because sigul works again """
+        with self.condition:
+            now = time.time()
+            self.queue = [(min(due, now), count, task)
+                          for due, count, task in self.queue]
+            heapq.heapify(self.queue)
+
+    def get_due_tasks(self):
+        """ Wait until tasks are due and return up to max_batch_size of them
+        """
+        with self.condition:
+            while True:
+                now = time.time()
+                if self.queue and self.queue[0][0] <= now:
+                    break
+                if self.queue:
+                    self.condition.wait(self.queue[0][0] - now)
+                else:
+                    self.condition.wait()
+            tasks = []
+            while self.queue and self.queue[0][0] <= now and \
+                    len(tasks) < self.max_batch_size:
+                tasks.append(heapq.heappop(self.queue)[2])
+            return tasks
+
+    def retry_later(self, signing_task):
+        signing_task.error_count += 1
+        signing_task.last_attempt = time.time()
+        delay = min(300 * signing_task.error_count, 1800)
+        log.debug("Retrying %r in %ss", signing_task, delay)
+        self.put(signing_task, delay)
+
+    def run(self):
+        while True:
+            signing_tasks = self.get_due_tasks()
+            try:
+                if self.signer is None:
+                    self.signer = SingleSigner(self.instance, self.key,
+                                               self.password)
+                results = self.signer.sign_tasks(signing_tasks)
+            except Exception:
+                log.error("Exception signing %r: %s", signing_tasks,
+                          traceback.format_exc())
+                for signing_task in signing_tasks:
+                    self.retry_later(signing_task)
+                continue
+
+            completed = False
+            for signing_task in results:
+                if signing_task is None:
+                    continue
+                if signing_task.unsigned:
+                    self.retry_later(signing_task)
+                else:
+                    completed = True
+            if completed:
+                self.wake_retries()
 
 
 class AutoSigner(object):
-    def __init__(self, sigul_passwords):
+    def __init__(self, sigul_passwords, coalesce_window=10):
         self.sigul_passwords = sigul_passwords
-        self.incomplete = []
-        self.signers = {}
-        self.last_retry_attempt = 0
+        self.coalesce_window = coalesce_window
+        self.workers = {}
 
     def sign(self, signing_task):
+        """ Queue signing_task with the worker for its instance and key """
         sigul_password = self.sigul_passwords.get(signing_task.key)
         if not sigul_password:
             log.critical("Password missing for %s", signing_task)
@@ -262,69 +384,16 @@ class AutoSigner(object):
 
         signer_id = "{0.instance}_{0.key}".format(signing_task)
 
-        # Do not use self.signers.setdefault() to avoid creating the
-        # SingleSigner if it is not needed
-        if signer_id in self.signers:
-            signer = self.signers[signer_id]
-        else:
-            signer = SingleSigner(signing_task.instance, signing_task.key,
-                                  sigul_password)
-            self.signers[signer_id] = signer
-
-        signing_task = signer.sign(signing_task=signing_task)
-        if signing_task is not None:
-            return False
-        elif signing_task.unsigned:
-            signing_task.error_count += 1
-            signing_task.last_attempt = time.time()
-            self.incomplete.append(signing_task)
-            return False
-        else:
-            return True
-
-    def retry(self, force_check=False):
-        now = time.time()
-        # only retry once every 5 minutes
-        if not force_check and now < (self.last_retry_attempt + 300):
-            return None
-
-        if len(self.incomplete) < 10:
-            waiting_time = 300
+        # Do not use self.workers.setdefault() to avoid creating the
+        # SigningWorker if it is not needed
+        if signer_id in self.workers:
+            worker = self.workers[signer_id]
         else:
-            waiting_time = 1800
-
-        incomplete = self.incomplete
-        self.incomplete = []
-        while incomplete:
-            signing_task = incomplete.pop(0)
-            if force_check or \
-                    signing_task.last_attempt > (now + waiting_time):
-                log.debug("Retrying %r", signing_task)
-                signing_success = self.sign(signing_task)
-                if not force_check and not signing_success:
-                    while incomplete:
-                        self.incomplete.insert(0, incomplete.pop(0))
-            else:
-                self.incomplete.append(signing_task)
-        self.last_retry_attempt = time.time()
-
-        # command = ["./sigulsign_unsigned.py", "-vv", "--batch-mode",
-        #            "--sigul-batch-size=1"]
-        # if signing_task.instance in secondary_instances:
-        #     command.extend(
-        #         [
-        #             "--arch", signing_task.instance,
-        #             "--sigul-config-file",
-        #             os.path.expanduser("~/.sigul/client-secondary.conf")])
-        # elif signing_task.instance != "primary":
-        #     return -1
-        #
-        # command.extend([signing_task.key, str(signing_task.build_id)])
-        # log.info("Running", " ".join(command))
-        # child = subprocess.Popen(command, stdin=subprocess.PIPE)
-        # child.communicate(sigul_password + '\0')
-        # ret = child.wait()
-        # return ret
+            worker = SigningWorker(signing_task.instance, signing_task.key,
+                                   sigul_password, self.coalesce_window)
+            worker.start()
+            self.workers[signer_id] = worker
+        worker.put(signing_task)
 
 
 def parse_message(msg):
@@ -416,6 +485,9 @@ if __name__ == "__main__":
     argument_parser.add_argument(
         "--batch", help="Read JSON information with password keys from stdin",
         action="store_true", default=False)
+    argument_parser.add_argument(
+        "--coalesce-window", type=int, default=10,
+        help="Seconds to wait for more builds to sign them in one batch")
     args = argument_parser.parse_args()
     log_basedir = setup_logging()
 
@@ -446,7 +518,7 @@ if __name__ == "__main__":
         sigul_passwords = json.load(sys.stdin)
     else:
         sigul_passwords = ask_key_passwords()
-    auto_signer = AutoSigner(sigul_passwords)
+    auto_signer = AutoSigner(sigul_passwords, args.coalesce_window)
 
     log.info("Start processing messages for %r", TAG_INFO)
     count = 0
@@ -471,10 +543,7 @@ if __name__ == "__main__":
                     log.debug("Processing message: %s",
                               fedmsg.encoding.pretty_dumps(
                                   remove_certificate(msg)))
-                    if auto_signer.sign(signing_task):
-                        auto_signer.retry(force_check=True)
-            else:
-                auto_signer.retry()
+                    auto_signer.sign(signing_task)
         except Exception, e:
             try:
                 exc_type, exc_value, exc_traceback = sys.exc_info()
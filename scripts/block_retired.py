@@ -7,13 +7,14 @@ import datetime
 import getpass
 import logging
 import os
-import subprocess
+import threading
 import time
 
 import koji
 import pkgdb2client
 
 from autosigner import SubjectSMTPHandler
+from kojiutils import multicall_methods
 
 
 log = logging.getLogger(__name__)
@@ -31,6 +32,9 @@ SERVERCA = os.path.expanduser('~/.fedora-server-ca.cert')
 CLIENTCA = os.path.expanduser('~/.fedora-upload-ca.cert')
 CLIENTCERT = os.path.expanduser('~/.fedora.cert')
 
+_clients = {}
+_clients_lock = threading.Lock()
+
 
 class ReleaseMapper(object):
     BRANCHNAME = 0
@@ -77,13 +81,33 @@ class ReleaseMapper(object):
         return None
 
 
+def get_koji_session(staging=False):
+    """ Return an authenticated koji session that is reused for all calls
+    """
+    url = PRODUCTION_KOJI if not staging else STAGING_KOJI
+    with _clients_lock:
+        if ("koji", url) not in _clients:
+            kojisession = koji.ClientSession(url)
+            kojisession.ssl_login(CLIENTCERT, CLIENTCA, SERVERCA)
+            _clients[("koji", url)] = kojisession
+        return _clients[("koji", url)]
+
+
+def get_pkgdb(staging=False):
+    """ Return a pkgdb client that is reused for all calls
+    """
+    url = PRODUCTION_PKGDB if not staging else STAGING_PKGDB
+    with _clients_lock:
+        if ("pkgdb", url) not in _clients:
+            _clients[("pkgdb", url)] = pkgdb2client.PkgDB(url)
+        return _clients[("pkgdb", url)]
+
+
 def get_packages(tag, staging=False):
     """
     Get a list of all blocked and unblocked packages in a branch.
     """
-    url = PRODUCTION_KOJI if not staging else STAGING_KOJI
-    kojisession = koji.ClientSession(url)
-    kojisession.ssl_login(CLIENTCERT, CLIENTCA, SERVERCA)
+    kojisession = get_koji_session(staging)
     pkglist = kojisession.listPackages(tagID=tag, inherited=True)
     blocked = []
     unblocked = []
@@ -109,8 +133,7 @@ def unblocked_packages(branch="master", staging=False):
 
 
 def get_retired_packages(branch="master", staging=False):
-    url = PRODUCTION_PKGDB if not staging else STAGING_PKGDB
-    pkgdb = pkgdb2client.PkgDB(url)
+    pkgdb = get_pkgdb(staging)
 
     try:
         retiredresponse = pkgdb.get_packages(
@@ -132,8 +155,7 @@ def pkgdb_retirement_status(package, branch="master", staging=False):
     there was an error, status_change: last status change as datetime object
     """
 
-    url = PRODUCTION_PKGDB if not staging else STAGING_PKGDB
-    pkgdb = pkgdb2client.PkgDB(url)
+    pkgdb = get_pkgdb(staging)
     retired = None
     status_change = None
     try:
@@ -178,17 +200,6 @@ def get_retirement_info(message):
     return None
 
 
-def run_koji(koji_params, staging=False):
-    url = PRODUCTION_KOJI if not staging else STAGING_KOJI
-    koji_cmd = ["koji", "--server", url]
-    cmd = koji_cmd + koji_params
-    log.debug("Running: %s", " ".join(cmd))
-    process = subprocess.Popen(cmd, stderr=subprocess.PIPE,
-                               stdout=subprocess.PIPE)
-    stdout, stderr = process.communicate()
-    return process, stdout, stderr
-
-
 def block_package(packages, branch="master", staging=False):
     if isinstance(packages, basestring):
         packages = [packages]
@@ -199,29 +210,40 @@ def block_package(packages, branch="master", staging=False):
     mapper = ReleaseMapper(staging=staging)
     tag = mapper.koji_tag(branch)
     epel_build_tag = mapper.epel_build_tag(branch)
+    kojisession = get_koji_session(staging)
 
     errors = []
 
-    def catch_koji_errors(cmd):
-        process, stdout, stderr = run_koji(cmd, staging=staging)
-        if process.returncode != 0:
-            errors.append("{0} stdout: {1!r} stderr: {2!r}".format(cmd, stdout,
-                                                                   stderr))
+    def run_calls(calls):
+        """ Run calls and record an error for every failed call """
+        results = multicall_methods(kojisession, calls)
+        for (method, args, kwargs), result in zip(calls, results):
+            if isinstance(result, dict):
+                errors.append("{0}{1!r}: {2}".format(
+                    method, args, result.get("faultString", result)))
+        return results
 
     # Untag builds first due to koji/mash bug:
     # https://fedorahosted.org/koji/ticket/299
     # FIXME: This introduces a theoretical race condition when a package is
     # built after all builds were untagged and before the package is blocked
     if epel_build_tag:
-        cmd = ["untag-build", "--all", tag] + packages
-        catch_koji_errors(cmd)
-
-    cmd = ["block-pkg", tag] + packages
-    catch_koji_errors(cmd)
+        calls = [("listTagged", (tag,), dict(package=package))
+                 for package in packages]
+        untag_calls = []
+        for result in run_calls(calls):
+            if isinstance(result, dict):
+                continue
+            for build in result[0]:
+                untag_calls.append(("untagBuild", (tag, build["nvr"]), {}))
+        run_calls(untag_calls)
+
+    run_calls([("packageListBlock", (tag, package), {})
+               for package in packages])
 
     if epel_build_tag:
-        cmd = ["unblock-pkg", epel_build_tag] + packages
-        catch_koji_errors(cmd)
+        run_calls([("packageListUnblock", (epel_build_tag, package), {})
+                   for package in packages])
 
     return errors
 
@@ -267,22 +289,17 @@ def block_all_retired(branches=RETIRING_BRANCHES, staging=False):
         # ensures that no packages not included in a tag are tried to be
         # blocked. Packages might not be in the rawhide tag if they are retired
         # too fast, e.g. because they are EPEL-only
-        allunblocked = unblocked_packages(branch, staging)
+        allunblocked = set(unblocked_packages(branch, staging))
         for pkg in retired:
             if pkg in allunblocked:
                 unblocked.append(pkg)
 
+        # Every package is handled by its own call in the multicalls, so an
+        # error with one package does not stop the others from being blocked
         errors = block_package(unblocked, branch, staging=staging)
-        # Block packages individually so that errors with one package does not
-        # stop the other packages to be blocked
-        if errors:
-            for error in errors:
-                log.error(error)
-            for package in unblocked:
-                errors = block_package(package, branch, staging=staging)
-                log.info("Blocked %s on %s", package, branch)
-                for error in errors:
-                    log.error(error)
+        for error in errors or []:
+            log.error(error)
+        log.info("Blocked %s packages on %s", len(unblocked), branch)
 
 
 def setup_logging(debug=False, mail=False):
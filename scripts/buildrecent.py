@@ -0,0 +1,350 @@
+#!/usr/bin/python
+#
+# buildrecent.py - Rebuild or import the builds of a tag of a remote koji hub
+#                  on a local hub, shared by build-current.py and
+#                  build-previous.py
+#
+# Copyright (C) 2013 Red Hat Inc.
+# SPDX-License-Identifier:	GPL-2.0+
+#
+
+import os
+import shutil
+import urllib2
+import koji
+import logging
+import time
+import random
+import string
+import rpm
+from multiprocessing.pool import ThreadPool
+
+import kojiutils
+
+REMOTEKOJIHUB = 'http://koji.fedoraproject.org/kojihub'
+PACKAGEURL = 'http://kojipkgs.fedoraproject.org/'
+
+# Should probably set these from a koji config file
+SERVERCA = os.path.expanduser('~/.fedora-server-ca.cert')
+CLIENTCA = os.path.expanduser('~/.fedora-server-ca.cert')
+CLIENTCERT = os.path.expanduser('~/.fedora.cert')
+
+workpath = '/tmp/build-recent'
+
+# concurrent SRPM downloads and concurrent local hub uploads/submissions
+DOWNLOAD_WORKERS = 4
+SUBMIT_WORKERS = 4
+# read/write and upload chunk size
+BUFSIZE = 1024 * 1024
+
+
+def _unique_path(prefix):
+    """Create a unique path fragment by appending a path component
+    to prefix.  The path component will consist of a string of letter and
+    numbers that is unlikely to be a duplicate, but is not guaranteed to be
+    unique."""
+    # Use time() in the dirname to provide a little more information when
+    # browsing the filesystem.
+    # For some reason repr(time.time()) includes 4 or 5
+    # more digits of precision than str(time.time())
+    return '%s/%r.%s' % (prefix, time.time(),
+                         ''.join([random.choice(string.ascii_letters)
+                                 for i in range(8)]))
+
+
+def _rpmvercmp((e1, v1, r1), (e2, v2, r2)):
+    """find out which build is newer"""
+    rc = rpm.labelCompare((e1, v1, r1), (e2, v2, r2))
+    if rc == 1:
+        # first evr wins
+        return 1
+    elif rc == 0:
+        # same evr
+        return 0
+    else:
+        # second evr wins
+        return -1
+
+
+def isNoarch(rpms):
+    if not rpms:
+        return False
+    noarch = False
+    for rpminfo in rpms:
+        if rpminfo['arch'] == 'noarch':
+            # note that we've seen a noarch rpm
+            noarch = True
+        elif rpminfo['arch'] != 'src':
+            return False
+    return noarch
+
+
+def tagSuccessful(localhub, nvr, tag):
+    """tag completed builds into final tags"""
+    localSession(localhub).tagBuildBypass(tag, nvr)
+    print "tagged %s to %s" % (nvr, tag)
+
+
+def _downloadURL(url, destf):
+    """Download a url and save it to a file, streaming it in BUFSIZE
+    chunks"""
+    src = urllib2.urlopen(url)
+    tmpf = destf + '.part'
+    try:
+        with open(tmpf, 'wb') as out:
+            shutil.copyfileobj(src, out, BUFSIZE)
+    finally:
+        src.close()
+    # only complete downloads get the final name, so they can be reused
+    os.rename(tmpf, destf)
+
+
+def _login(kojisession):
+    kojisession.ssl_login(CLIENTCERT, CLIENTCA, SERVERCA)
+
+
+def localSession(localhub):
+    """Return the local hub session of the calling worker thread"""
+    return kojiutils.thread_session(localhub, _login)
+
+
+def _importURL(localhub, url, fn):
+    """Import an rpm directly from a url"""
+    serverdir = _unique_path('build-recent')
+    # TODO - would be possible, using uploadFile directly, to upload without
+    # writing locally.
+    # for now, though, just use uploadWrapper
+    koji.ensuredir(workpath)
+    dst = "%s/%s" % (workpath, fn)
+    print "Downloading %s to %s..." % (url, dst)
+    _downloadURL(url, dst)
+    print "Uploading %s..." % dst
+    localSession(localhub).uploadWrapper(dst, serverdir, blocksize=BUFSIZE)
+    localSession(localhub).importRPM(serverdir, fn)
+
+
+def importBuild(localhub, build, rpms, buildinfo, tag=None):
+    '''import a build from remote hub'''
+    for rpminfo in rpms:
+        if rpminfo['arch'] == 'src':
+            srpm = rpminfo
+    pathinfo = koji.PathInfo(PACKAGEURL)
+    build_url = pathinfo.build(buildinfo)
+    url = "%s/%s" % (pathinfo.build(buildinfo), pathinfo.rpm(srpm))
+    fname = "%s.src.rpm" % build
+    _importURL(localhub, url, fname)
+    for rpminfo in rpms:
+        if rpminfo['arch'] == 'src':
+            # already imported above
+            continue
+        relpath = pathinfo.rpm(rpminfo)
+        url = "%s/%s" % (build_url, relpath)
+        logging.debug("url: %s" % url)
+        fname = os.path.basename(relpath)
+        logging.debug("fname: %s" % fname)
+        _importURL(localhub, url, fname)
+    tagSuccessful(localhub, build, tag)
+    return True
+
+
+def importJob(localhub, tag, job):
+    """Import a noarch build, run in the submit pool"""
+    try:
+        return importBuild(localhub, job['nvr'], job['rpms'],
+                           job['buildinfo'], tag=tag)
+    except Exception:
+        logging.exception("failed to import %s" % job['nvr'])
+        return False
+
+
+def downloadJob(job):
+    """Fetch the SRPM of a build, run in the download pool"""
+    job['fname'] = "%s.src.rpm" % job['nvr']
+    job['fpath'] = "%s/%s" % (workpath, job['fname'])
+    url = "%s/packages/%s/%s/%s/src/%s" % (PACKAGEURL, job['name'],
+                                           job['version'], job['release'],
+                                           job['fname'])
+    try:
+        if not os.path.isfile(job['fpath']):
+            logging.debug("downloading %s" % url)
+            _downloadURL(url, job['fpath'])
+        return job
+    except Exception:
+        logging.exception("failed to download %s" % url)
+        return None
+
+
+def buildJob(localhub, job):
+    """Upload a downloaded SRPM and submit its build, run in the submit
+    pool"""
+    try:
+        session = localSession(localhub)
+        serverdir = _unique_path('cli-build')
+        session.uploadWrapper(job['fpath'], serverdir, blocksize=BUFSIZE)
+        source = "%s/%s" % (serverdir, job['fname'])
+        session.build(source, job['target'], opts=None, priority=2)
+        logging.info("submitted build: %s" % job['nvr'])
+        return True
+    except Exception:
+        logging.exception("failed to submit %s" % job['nvr'])
+        return False
+
+
+def _previousBuilds(remotekojisession, tag, pkgs):
+    """Return the build before the latest one of every package in pkgs, or
+    the latest one if there is no older build"""
+    calls = [((tag,), {'inherit': True, 'package': pkg['package_name']})
+             for pkg in pkgs]
+    remotebuilds = []
+    for pkg, result in zip(pkgs, kojiutils.multicall(remotekojisession,
+                                                     'listTagged', calls)):
+        if isinstance(result, dict):
+            logging.error("listTagged failed for %s: %s"
+                          % (pkg['package_name'], result['faultString']))
+            continue
+        pkginfo = result[0]
+        pkgindex = 1
+        if len(pkginfo) > pkgindex:
+            logging.info("got build %s" % pkginfo[pkgindex]['nvr'])
+        elif len(pkginfo) == 1:
+            pkgindex = 0
+            logging.info("no previous build for %s" % pkg['package_name'])
+            logging.info("reverting to current %s" % pkginfo[pkgindex]['nvr'])
+        else:
+            # We apparently have 0 builds for this package!
+            logging.info("no builds for %s - skipping" % pkg['package_name'])
+            continue
+        remotebuilds.append(pkginfo[pkgindex])
+    return remotebuilds
+
+
+def reconcile(remotekojisession, localkojisession, tag, pkgs,
+              previous=False):
+    """Compare the builds of both hubs by EVR, returns the list of remote
+    builds that need to be imported or built locally. With previous, the
+    build before the latest one of every package is used, if there is
+    one."""
+    if previous:
+        remotebuilds = _previousBuilds(remotekojisession, tag, pkgs)
+    else:
+        # the latest builds of all packages at once, instead of asking for
+        # every package on its own
+        names = set(pkg['package_name'] for pkg in pkgs)
+        remotebuilds = sorted([build for build in
+                               remotekojisession.listTagged(tag, latest=True)
+                               if build['package_name'] in names],
+                              key=lambda build: build['package_name'])
+    # latest local build of every package, inherited like getLatestBuilds
+    locallatest = dict((build['package_name'], build) for build in
+                       localkojisession.listTagged(tag, latest=True,
+                                                   inherit=True))
+
+    missing = []
+    for build in remotebuilds:
+        latest = locallatest.get(build['package_name'])
+        if latest is None:
+            missing.append(build)
+            continue
+        parentevr = (str(build['epoch']), build['version'], build['release'])
+        latestevr = (str(latest['epoch']), latest['version'],
+                     latest['release'])
+        newestRPM = _rpmvercmp(parentevr, latestevr)
+        logging.debug("remote evr: %s  \nlocal evr: %s \nResult: %s",
+                      parentevr, latestevr, newestRPM)
+        if newestRPM == -1:
+            logging.info("Newer locally: %s locally is newer than "
+                         "remote" % (latestevr,))
+        elif newestRPM == 0:
+            logging.info("Already Built: %s " % (latestevr,))
+        else:
+            missing.append(build)
+
+    # the NVRs that are not tagged locally may still be built already
+    localbuilds = kojiutils.multicall(localkojisession, 'getBuild',
+                                      [((build['nvr'],), {})
+                                       for build in missing])
+    todo = []
+    for build, localBuild in zip(missing, localbuilds):
+        nvr = build['nvr']
+        if isinstance(localBuild, dict):
+            logging.error("local lookup failed for %s" % nvr)
+            continue
+        if localBuild[0] is not None and localBuild[0]['state'] == 1:
+            logging.debug("Local Complete Build: %s" % nvr)
+            continue
+        todo.append({'nvr': nvr, 'name': build['package_name'],
+                     'version': build['version'],
+                     'release': build['release'],
+                     'build_id': build['build_id'],
+                     'task_id': build['task_id']})
+
+    # noarch builds get imported, everything else is rebuilt from the task
+    # request of the remote build
+    rpmlists = kojiutils.multicall(remotekojisession, 'listRPMs',
+                                   [((job['build_id'],), {})
+                                    for job in todo])
+    jobs = []
+    for job, rpms in zip(todo, rpmlists):
+        if isinstance(rpms, dict):
+            logging.error("listRPMs failed for %s" % job['nvr'])
+            continue
+        job['rpms'] = rpms[0]
+        job['noarch'] = isNoarch(job['rpms'])
+        jobs.append(job)
+    calls = [('getBuild', (job['build_id'],), {}) if job['noarch']
+             else ('getTaskRequest', (job['task_id'],), {}) for job in jobs]
+    for job, result in zip(jobs, kojiutils.multicall_methods(
+            remotekojisession, calls)):
+        if isinstance(result, dict):
+            logging.error("remote lookup failed for %s" % job['nvr'])
+            job['failed'] = True
+        elif job['noarch']:
+            job['buildinfo'] = result[0]
+        else:
+            job['request'] = result[0]
+    return [job for job in jobs if not job.get('failed')]
+
+
+def submit(localhub, tag, jobs, rawhide='rawhide', distprefix='f'):
+    """Import the noarch builds of jobs and rebuild the others on localhub.
+    Builds of the rawhide target are submitted to the target of the Fedora
+    release in their dist tag instead. Returns the number of failures."""
+    koji.ensuredir(workpath)
+    imports = []
+    builds = []
+    for job in jobs:
+        if job['noarch']:
+            imports.append(job)
+            continue
+        request = job['request']
+        target = request[1]
+        if target == rawhide:
+            try:
+                target = "%s%s" % (distprefix,
+                                   job['nvr'].split("fc")[-1].rsplit('.')[0])
+                logging.info("switched target to: %s" % (target,))
+            except:
+                logging.info("unable to switch target: ")
+        if target.startswith("dist-f11"):
+            logging.debug("Skiping package: %s" % job['name'])
+            continue
+        job['target'] = target
+        builds.append(job)
+
+    logging.info("%d builds to import, %d to submit" % (len(imports),
+                                                        len(builds)))
+
+    downloadpool = ThreadPool(DOWNLOAD_WORKERS)
+    submitpool = ThreadPool(SUBMIT_WORKERS)
+    results = [submitpool.apply_async(importJob, (localhub, tag, job))
+               for job in imports]
+    # hand every SRPM to the submit pool as soon as its download finished
+    for job in downloadpool.imap_unordered(downloadJob, builds):
+        if job is not None:
+            results.append(submitpool.apply_async(buildJob, (localhub, job)))
+    downloadpool.close()
+    submitpool.close()
+    downloadpool.join()
+    submitpool.join()
+
+    return len(builds) + len(imports) - len([r for r in results if r.get()])
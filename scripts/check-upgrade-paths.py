@@ -26,15 +26,17 @@ import rpm
 import sys
 import smtplib
 import datetime
+import functools
+import json
+from optparse import OptionParser
 
 fromaddr = 'buildsys@fedoraproject.org'
 toaddr = 'devel@lists.fedoraproject.org'
 domain = '@fedoraproject.org'
 smtpserver = 'localhost'
 
-def usage():
-    print """
-    check-upgrade-paths.py tag1 [/]tag2 [[/]tag3 [/]tag4]
+usage = """
+    %prog tag1 [/]tag2 [[/]tag3 [/]tag4]
     tags must be in ascending order, f8-gold dist-f8-updates dist-f8-updates-testing dist-f9-updates ...
     prepending a / is special: A /B C means A will not be checked against B, but against the union of B and C
     Only A is affected, everything preceding A will still be checked against B normally, as will B against C.
@@ -42,14 +44,15 @@ def usage():
     dist-f8-updates dist-f8-updates-testing /dist-f9-updates dist-f9-updates-testing
     """
 
-def compare(pkgA, pkgB):
-    pkgdictA = koji.parse_NVR(pkgA)
-    pkgdictB = koji.parse_NVR(pkgB)
+# Sort key for (epoch, version, release) tuples, so every build is parsed
+# once and compared with <, > and min()
+EVRKey = functools.cmp_to_key(rpm.labelCompare)
 
-    rc = rpm.labelCompare((pkgdictA['epoch'], pkgdictA['version'], pkgdictA['release']),
-                         (pkgdictB['epoch'], pkgdictB['version'], pkgdictB['release']))
-
-    return rc
+def buildToKey(build):
+    # the 'or 0' is because some epoch's that should be 0 but are None
+    # and in rpm.labelCompare(), None < 0
+    return EVRKey((str(build['epoch'] or 0), str(build['version']),
+                   str(build['release'])))
 
 def buildToNvr(build):
     if build['epoch']:
@@ -57,7 +60,26 @@ def buildToNvr(build):
     else:
         return build['nvr']
 
-def genPackageMail(builder, package):
+_smtp = None
+
+def sendMail(toaddrs, msg):
+    """Send a mail over a single SMTP connection which is kept open for all
+       the mails we send, reconnecting once if the server dropped it."""
+    global _smtp
+    for attempt in range(2):
+        try:
+            if not _smtp:
+                _smtp = smtplib.SMTP(smtpserver)
+                _smtp.set_debuglevel(1)
+            _smtp.sendmail(fromaddr, toaddrs, msg)
+            return
+        except smtplib.SMTPServerDisconnected:
+            _smtp = None
+        except:
+            break
+    print 'sending mail failed'
+
+def genPackageMail(builder, package, paths):
     """Send a mail to the package watchers and the builder regarding the break.
        Mail is set out once per broken package."""
 
@@ -69,7 +91,7 @@ Subject: Broken upgrade path(s) detected for: %s
 
 """ % (fromaddr, ','.join([addy+domain for addy in addresses]), package)
 
-    for path in badpaths[pkg]:
+    for path in paths:
         msg += "    %s\n" % path
 
     msg += "\n\nPlease fix the(se) issue(s) as soon as possible.\n"
@@ -77,21 +99,48 @@ Subject: Broken upgrade path(s) detected for: %s
     msg += "\n---------------\n"
     msg += "This report generated by Fedora Release Engineering, using http://git.fedorahosted.org/cgit/releng/tree/scripts/check-upgrade-paths.py"
 
-    try:
-        server = smtplib.SMTP(smtpserver)
-        server.set_debuglevel(1)
-        server.sendmail(fromaddr, [addy+domain for addy in addresses], msg)
-    except:
-        print 'sending mail failed'
-
-if len(sys.argv) > 1 and sys.argv[1] in ['-h', '--help', '-help', '--usage']:
-    usage()
-    sys.exit(0)
-elif len(sys.argv) < 3:
-    usage()
+    sendMail([addy+domain for addy in addresses], msg)
+
+def findBadPaths(builds, tags, slashdict):
+    """Return the (lower build, higher build) pairs of a package whose
+       upgrade path is broken. builds maps each tag to the package's build in
+       that tag, tags are in ascending order."""
+    chain = [(idx, tag, builds[tag]) for idx, tag in enumerate(tags)
+             if tag in builds]
+
+    # lowest[n] is the lowest EVR among chain[n:], so a build only needs to
+    # be compared to every later build when it is newer than one of them
+    lowest = [None] * len(chain)
+    for n in range(len(chain) - 1, -1, -1):
+        key = chain[n][2]['key']
+        if n + 1 < len(chain) and lowest[n + 1] < key:
+            key = lowest[n + 1]
+        lowest[n] = key
+
+    broken = []
+    for n, (idx, tag, build) in enumerate(chain[:-1]):
+        if not lowest[n + 1] < build['key']:
+            continue
+        for (nextidx, nexttag, nextbuild) in chain[n + 1:]:
+            if not nextbuild['key'] < build['key']:
+                continue
+            if nextidx == idx + 1 and slashdict[nexttag] and idx + 2 < len(tags):
+                # Broken? Need to check the next tag!
+                nextnexttag = tags[idx + 2]
+                if nextnexttag in builds and \
+                        not builds[nextnexttag]['key'] < build['key']:
+                    continue
+            broken.append((tag, nexttag, build, nextbuild))
+    return broken
+
+parser = OptionParser(usage=usage)
+parser.add_option("--json", metavar="FILE",
+                  help="also write the report as JSON to FILE")
+(options, cmdtags) = parser.parse_args()
+
+if len(cmdtags) < 2:
+    parser.print_usage()
     sys.exit(1)
-else:
-    cmdtags = sys.argv[1:]
 
 kojisession = koji.ClientSession('http://koji.fedoraproject.org/kojihub')
 tagdict = {}
@@ -99,6 +148,7 @@ pkgdict = {}
 slashdict = {}
 badpaths = {}
 badpathsbybuilder = {}
+report = {}
 
 # Remove prepended slashes and make a dict of them
 tags = []
@@ -122,39 +172,29 @@ results = kojisession.multiCall()
 for tag, result in zip(tags, results):
     tagdict[tag] = result[0]
 
-# Populate the pkgdict with a set of package names to tags to nvrs
+# Populate the pkgdict with a set of package names to tags to builds, parsing
+# each EVR only once
 for tag in tags:
     for pkg in tagdict[tag]:
-        if not pkgdict.has_key(pkg['name']):
-            pkgdict[pkg['name']] = {}
-        pkgdict[pkg['name']][tag] = {'nvr': buildToNvr(pkg), 'builder': pkg['owner_name']}
+        pkgdict.setdefault(pkg['name'], {})[tag] = {
+            'nvr': buildToNvr(pkg), 'builder': pkg['owner_name'],
+            'key': buildToKey(pkg)}
 
-# Loop through the packages, compare e:n-v-rs from the first tag upwards
-# then proceed to the next given tag and again compare upwards
+# Walk each package's builds from the first tag upwards
 for pkg in pkgdict:
-    for tag in tags[:-1]: # Skip the last tag since there is nothing to compare it to
-        idx = tags.index(tag)
-        for nexttag in tags[idx+1:]: # Compare from current tag up
-            if pkgdict[pkg].has_key(tag):
-                if pkgdict[pkg].has_key(nexttag): # only compare if the next tag knows about this package
-                    rc = compare(pkgdict[pkg][tag]['nvr'], pkgdict[pkg][nexttag]['nvr'])
-                    if rc <= 0:
-                        continue
-                    if rc > 0 and tags.index(nexttag) == idx+1 and slashdict[nexttag] and idx+2 < len(tags):
-                        # Broken? Need to check the next tag!
-                        nextnexttag = tags[idx+2]
-                        if pkgdict[pkg].has_key(nextnexttag):
-                            rc = compare(pkgdict[pkg][tag]['nvr'], pkgdict[pkg][nextnexttag]['nvr'])
-                    if rc > 0:
-                        # We've got something broken here.
-                        if not badpaths.has_key(pkg):
-                            badpaths[pkg] = []
-                        if not badpathsbybuilder.has_key(pkgdict[pkg][tag]['builder']):
-                            badpathsbybuilder[pkgdict[pkg][tag]['builder']] = {}
-                        if not badpathsbybuilder[pkgdict[pkg][tag]['builder']].has_key(pkg):
-                            badpathsbybuilder[pkgdict[pkg][tag]['builder']][pkg] = []
-                        badpaths[pkg].append('%s > %s (%s %s)' % (tag, nexttag, pkgdict[pkg][tag]['nvr'], pkgdict[pkg][nexttag]['nvr']))
-                        badpathsbybuilder[pkgdict[pkg][tag]['builder']][pkg].append('%s > %s (%s %s)' % (tag, nexttag, pkgdict[pkg][tag]['nvr'], pkgdict[pkg][nexttag]['nvr']))
+    for (tag, nexttag, build, nextbuild) in findBadPaths(pkgdict[pkg], tags, slashdict):
+        # We've got something broken here.
+        path = '%s > %s (%s %s)' % (tag, nexttag, build['nvr'], nextbuild['nvr'])
+        badpaths.setdefault(pkg, []).append(path)
+        badpathsbybuilder.setdefault(build['builder'], {}).setdefault(pkg, []).append(path)
+        report.setdefault(pkg, []).append({
+            'tag': tag, 'nvr': build['nvr'], 'builder': build['builder'],
+            'newer_tag': nexttag, 'newer_nvr': nextbuild['nvr']})
+
+if options.json:
+    with open(options.json, 'w') as jsonfile:
+        json.dump({'date': str(datetime.date.today()), 'tags': cmdtags,
+                   'broken': report}, jsonfile, indent=2, sort_keys=True)
 
 msg = """From: %s
 To: %s
@@ -180,7 +220,7 @@ for builder in builders:
     pkgs = badpathsbybuilder[builder].keys()
     pkgs.sort()
     for pkg in pkgs:
-        genPackageMail(builder, pkg)
+        genPackageMail(builder, pkg, badpaths[pkg])
         msg += "    %s:\n" % pkg
         for path in badpathsbybuilder[builder][pkg]:
             msg += "        %s\n" % path
@@ -189,9 +229,9 @@ for builder in builders:
 msg += "---------------\n"
 msg += "This report generated by Fedora Release Engineering, using http://git.fedorahosted.org/cgit/releng/tree/scripts/check-upgrade-paths.py"
 
-try:
-    server = smtplib.SMTP(smtpserver)
-    server.set_debuglevel(1)
-    server.sendmail(fromaddr, toaddr, msg)
-except:
-    print 'sending mail failed'
+sendMail(toaddr, msg)
+if _smtp:
+    try:
+        _smtp.quit()
+    except smtplib.SMTPException:
+        pass
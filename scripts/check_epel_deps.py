@@ -4,16 +4,15 @@
 # SPDX-License-Identifier:	GPL-2.0+
 
 import os
-import shutil
 from stat import *
 import string
 import sys
 import tempfile
 import re
 import smtplib
+from multiprocessing import Pool
 from optparse import OptionParser
 from yum.constants import *
-from yum.misc import getCacheDir
 
 # HAAACK
 import imp
@@ -23,6 +22,9 @@ import repoclosure
 owners = {}
 deps = {}
 
+# Metadata is kept here between runs, one directory per tree and arch
+CACHEDIR = os.path.expanduser('~/.cache/check_epel_deps')
+
 def generateConfig(distdir, treename, arch, testing=False):
     if not os.path.exists(os.path.join(distdir, arch)):
         return None
@@ -46,6 +48,7 @@ pkgpolicy=newest
 distroverpkg=redhat-release
 reposdir=/dev/null
 keepcache=0
+metadata_expire=0
 #exclude=kmod*,abrt*
 
 [%s-%s]
@@ -83,6 +86,7 @@ pkgpolicy=newest
 distroverpkg=redhat-release
 reposdir=/dev/null
 keepcache=0
+metadata_expire=0
 
 [%s-%s]
 name=Fedora EPEL %s Tree - %s
@@ -159,10 +163,13 @@ def printableReq(pkg, dep):
         req = '%s %s' % (req, v)
     return "%s requires %s" % (pkg, req,)
 
-def assignBlame(resolver, dep, guilty):
-    def __addpackages(sack):
-        for package in sack.returnPackages():
-            p = getSrcPkg(package)
+def assignBlame(resolver, dep, guilty, provides_cache):
+    def __addpackages(name):
+        # whatProvides is slow, and the same deps break for many packages
+        if name not in provides_cache:
+            provides_cache[name] = [getSrcPkg(package) for package in
+                resolver.whatProvides(name, None, None).returnPackages()]
+        for p in provides_cache[name]:
             if addOwner(guilty, p):
                 list.append(p)
     
@@ -174,14 +181,14 @@ def assignBlame(resolver, dep, guilty):
     list.append(dep)
 
     # Something that provides the dep
-    __addpackages(resolver.whatProvides(dep, None, None))
+    __addpackages(dep)
 
     # Libraries: check for variant in soname
     if re.match("lib.*\.so\.[0-9]+",dep):
         new = re.sub("(lib.*\.so\.)([0-9]+)",libmunge,dep)
-        __addpackages(resolver.whatProvides(new, None, None))
+        __addpackages(new)
         libname = dep.split('.')[0]
-        __addpackages(resolver.whatProvides(libname, None, None))
+        __addpackages(libname)
 
     return list
 
@@ -240,59 +247,93 @@ Subject: Broken dependencies: %s
         except:
             print 'sending mail failed'
 
-def doit(dir, treename, mail=True, testing=False):
+def checkArch(job):
+    """ Find the broken deps of the EPEL packages for one arch. Runs in a
+        worker process, so only plain data is returned. """
+    (arch, conffile, cachedir) = job
+    if arch == 'i386':
+        carch = 'i686'
+    elif arch == 'ppc':
+        carch = 'ppc64'
+    elif arch == 'sparc':
+        carch = 'sparc64v'
+    else:
+        carch = arch
+    my = repoclosure.RepoClosure(config = conffile, arch = [carch])
+    # yum checks the cached metadata against repomd.xml and only downloads
+    # what changed since the last run
+    my.repos.setCacheDir(cachedir)
+    my.readMetadata()
+    baddeps = my.getBrokenDeps(newest = False)
+    pkgs = baddeps.keys()
+    tmplist = [(x.returnSimple('name'), x) for x in pkgs]
+    tmplist.sort()
+    pkgs = [x for (key, x) in tmplist]
+
+    output = []
+    if len(pkgs) > 0:
+        output.append("Broken deps for %s" % (arch,))
+        output.append("----------------------------------------------------------")
+    guilty = {}
+    provides_cache = {}
+    results = []
+    for pkg in pkgs:
+        if not pkg.repoid.startswith('epel'):
+            continue
+        srcpkg = getSrcPkg(pkg)
+        pkgid = "%s-%s" % (pkg.name, pkg.printVer())
+
+        broken = []
+        for (n, f, v) in baddeps[pkg]:
+            output.append("\t%s" % printableReq(pkg, (n, f, v)))
+
+            blamelist = assignBlame(my, n, guilty, provides_cache)
+
+            broken.append( (str(pkg), (n, f, v), blamelist) )
+
+        results.append((srcpkg, pkgid, broken))
+
+    return (arch, output, results)
+
+def doit(dir, treename, mail=True, testing=False, cachedir=CACHEDIR,
+         jobs=None):
+    arches = []
     for arch in os.listdir(dir):
         conffile = generateConfig(dir, treename, arch, testing)
         if not conffile:
             continue
-        if arch == 'i386':
-            carch = 'i686'
-        elif arch == 'ppc':
-            carch = 'ppc64'
-        elif arch == 'sparc':
-            carch = 'sparc64v'
-        else:
-            carch = arch
-        my = repoclosure.RepoClosure(config = conffile, arch = [carch])
-        cachedir = getCacheDir()
-        my.repos.setCacheDir(cachedir)
-        my.readMetadata()
-        baddeps = my.getBrokenDeps(newest = False)
-        pkgs = baddeps.keys()
-        tmplist = [(x.returnSimple('name'), x) for x in pkgs]
-        tmplist.sort()
-        pkgs = [x for (key, x) in tmplist]
-        if len(pkgs) > 0:
-            print "Broken deps for %s" % (arch,)
-            print "----------------------------------------------------------"
-        for pkg in pkgs:
-            if not pkg.repoid.startswith('epel'):
-                continue
-            srcpkg = getSrcPkg(pkg)
+        arches.append((arch, conffile, os.path.join(cachedir, treename, arch)))
+
+    if arches:
+        pool = Pool(jobs or len(arches))
+        try:
+            archresults = pool.map(checkArch, arches)
+        finally:
+            pool.close()
+            for (arch, conffile, archcache) in arches:
+                os.unlink(conffile)
+    else:
+        archresults = []
 
+    for (arch, output, results) in archresults:
+        for line in output:
+            print line
+        for (srcpkg, pkgid, broken) in results:
             addOwner(owners, srcpkg)
+            # the first entry is the dep itself, which has no owner
+            for (pkg, dep, blamelist) in broken:
+                for blame in blamelist[1:]:
+                    addOwner(owners, blame)
 
             if not deps.has_key(srcpkg):
                 deps[srcpkg] = {}
 
-            pkgid = "%s-%s" % (pkg.name, pkg.printVer())
-
             if not deps[srcpkg].has_key(pkgid):
                 deps[srcpkg][pkgid] = {}
 
-            broken = []
-            for (n, f, v) in baddeps[pkg]:
-                print "\t%s" % printableReq(pkg, (n, f, v))
-
-                blamelist = assignBlame(my, n, owners)
-
-                broken.append( (pkg, (n, f, v), blamelist) )
-
             deps[srcpkg][pkgid][arch] = broken
 
         print "\n\n"
-        os.unlink(conffile)
-        shutil.rmtree(cachedir, ignore_errors = True)
 
     pkglist = deps.keys()
     for pkg in pkglist:
@@ -304,6 +345,11 @@ if __name__ == '__main__':
     parser.add_option("--nomail", action="store_true")
     parser.add_option("--enable-testing", action="store_true")
     parser.add_option("--treename", default="rawhide")
+    parser.add_option("--cachedir", default=CACHEDIR,
+                      help="directory to keep repo metadata in between runs")
+    parser.add_option("-j", "--jobs", type="int", default=None,
+                      help="number of arches to check in parallel "
+                      "(default: all)")
     (options, args) = parser.parse_args(sys.argv[1:])
 
     if len(args) != 1:
@@ -320,4 +366,5 @@ if __name__ == '__main__':
     else:
         testing = False
 
-    doit(args[0], options.treename, mail, testing)
+    doit(args[0], options.treename, mail, testing, options.cachedir,
+         options.jobs)
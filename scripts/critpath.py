@@ -6,11 +6,15 @@
 # Authors: Will Woods <wwoods@redhat.com>
 #          Seth Vidal <skvidal@fedoraproject.org>
 
+import os
 import sys
+import time
 import yum
 import optparse
 import shutil
 import tempfile
+from collections import deque
+from multiprocessing import Pool
 from rpmUtils.arch import getBaseArch
 
 # Set some constants
@@ -48,8 +52,10 @@ blacklist = [ 'tzdata' ]
 def get_source(pkg):
     return pkg.rsplit('-',2)[0]
 
-provides_cache = {}
-def resolve_deps(pkg, base):
+def resolve_deps(pkg, base, provides_cache):
+    """Return the names of the packages providing the requires of pkg.
+    provides_cache maps provides to package names and must only be shared
+    between calls for the same arch."""
     deps = []
     for prov in pkg.provides:
         provides_cache[prov] = pkg.name
@@ -69,57 +75,69 @@ def resolve_deps(pkg, base):
 
     return deps
 
-def expand_critpath(my, start_list):
-    name_list = []
+def expand_critpath(my, start_list, arch=''):
+    prefix = '[%s] ' % arch if arch else ''
+    name_list = deque()
+    queued = set()
     # Expand the start_list to a list of names
     for name in start_list:
         if name.startswith('@'):
-            print "expanding %s" % name
+            print "%sexpanding %s" % (prefix, name)
             count = 0
             group = my.comps.return_group(name[1:])
             for groupmem in group.mandatory_packages.keys() + group.default_packages.keys():
-                if groupmem not in name_list:
+                if groupmem not in queued:
                     name_list.append(groupmem)
+                    queued.add(groupmem)
                     count += 1
-            print "%s packages added" % count
+            print "%s%s packages added" % (prefix, count)
         else:
-            if name not in name_list:
+            if name not in queued:
                 name_list.append(name)
+                queued.add(name)
     # Iterate over the name_list
     count = 0
     pkg_list = []
     skipped_list = []
-    handled = []
+    provides_cache = {}
 
+    # every name ends up in queued exactly once, so it doubles as the set of
+    # handled, skipped and still to be handled names
     while name_list:
         count += 1
-        name = name_list.pop(0)
-        handled.append(name)
+        name = name_list.popleft()
         if name in blacklist:
             continue
-        print "depsolving %4u done/%4u remaining (%s)" % (count, len(name_list), name)
+        print "%sdepsolving %4u done/%4u remaining (%s)" % (prefix, count, len(name_list), name)
         p = my.pkgSack.searchNevra(name=name)
         if not p:
-            print "WARNING: unresolved package name: %s" % name
+            print "%sWARNING: unresolved package name: %s" % (prefix, name)
             skipped_list.append(name)
             continue
         for pkg in p:
             pkg_list.append(pkg)
-            for dep in resolve_deps(pkg, my):
-                if dep not in handled and dep not in skipped_list and dep not in name_list:
-                    print "    added %s" % dep
+            for dep in resolve_deps(pkg, my, provides_cache):
+                if dep not in queued:
+                    print "%s    added %s" % (prefix, dep)
                     name_list.append(dep)
-    print "depsolving complete."
-    print "%u packages in critical path" % (count)
-    print "%u rejected package names: %s" % (len(skipped_list),
-                                             " ".join(skipped_list))
+                    queued.add(dep)
+    print "%sdepsolving complete." % prefix
+    print "%s%u packages in critical path" % (prefix, count)
+    print "%s%u rejected package names: %s" % (prefix, len(skipped_list),
+                                               " ".join(skipped_list))
     return pkg_list
 
 
-def setup_yum(url=None, release=None, arch=None):
+def setup_yum(url=None, release=None, arch=None, cachedir=None):
+    """Set up a YumBase for release and arch. If cachedir is None the
+    metadata is downloaded into a new temporary directory, otherwise it is
+    kept in cachedir and reused by later runs."""
     my = yum.YumBase()
     basearch = getBaseArch()
-    cachedir = tempfile.mkdtemp(dir='/tmp', prefix='critpath-')
+    if cachedir is None:
+        cachedir = tempfile.mkdtemp(dir='/tmp', prefix='critpath-')
+    elif not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
     if arch is None:
         arch = basearch
     elif arch != basearch:
@@ -138,6 +156,32 @@ def setup_yum(url=None, release=None, arch=None):
 def nvr(p):
     return '-'.join([p.name, p.ver, p.rel])
 
+def critpath_for_arch(job):
+    """Expand the critical path for one arch, meant to be run in a worker
+    process. Returns the arch, a list of (name, nvr, source name) tuples and
+    a dict of timings in seconds."""
+    (arch, url, release, cachedir) = job
+    if cachedir is not None:
+        cachedir = os.path.join(cachedir, '%s-%s' % (release, arch))
+    timings = {}
+    start = time.time()
+    (my, cachedir) = setup_yum(url=url, release=release, arch=arch,
+                               cachedir=cachedir)
+    # load the metadata here to be able to report the time needed for it
+    my.pkgSack
+    my.comps
+    timings['metadata'] = time.time() - start
+    start = time.time()
+    pkgs = expand_critpath(my, critpath_groups, arch)
+    timings['depsolve'] = time.time() - start
+    print "%u packages for %s" % (len(pkgs), arch)
+    result = [(p.name.encode('utf8'), nvr(p).encode('utf8'),
+               get_source(p.sourcerpm)) for p in pkgs]
+    del my
+    if cachedir.startswith("/tmp/critpath-"):
+        shutil.rmtree(cachedir)
+    return (arch, result, timings)
+
 if __name__ == '__main__':
     # Option parsing
     releases = sorted(releasepath.keys())
@@ -152,6 +196,13 @@ if __name__ == '__main__':
                       help="URL to repos")
     parser.add_option("--srpm", action='store_true', default=False,
                       help="Output source RPMS instead of binary RPMS (for pkgdb)")
+    parser.add_option("-c", "--cachedir",
+                      default=os.path.expanduser('~/.cache/critpath'),
+                      help="directory to keep repo metadata in between runs (%default)")
+    parser.add_option("--no-cache", dest="cachedir", action='store_const',
+                      const=None, help="use a temporary cachedir for each run")
+    parser.add_option("-j", "--jobs", type="int", default=0,
+                      help="number of arches to expand in parallel (default: all)")
     (opt, args) = parser.parse_args()
     if (len(args) != 1) or (args[0] not in releases):
         parser.error("must choose a release from the list: %s" % releases)
@@ -170,23 +221,28 @@ if __name__ == '__main__':
         releasepath[release] = releasepath[release].replace('development/','')
     print "Using URL %s" % (opt.url + releasepath[release])
 
-    # Do the critpath expansion for each arch
+    # Do the critpath expansion for all arches in parallel
     critpath = set()
-    for arch in check_arches:
-        print "Expanding critical path for %s" % arch
-        (my, cachedir) = setup_yum(url = opt.url, release=release, arch=arch)
-        pkgs = expand_critpath(my, critpath_groups)
-        print "%u packages for %s" % (len(pkgs), arch)
+    start = time.time()
+    jobs = [(arch, opt.url, release, opt.cachedir) for arch in check_arches]
+    pool = Pool(opt.jobs or len(jobs))
+    results = pool.map(critpath_for_arch, jobs)
+    pool.close()
+    pool.join()
+    print
+    print "%-10s %8s %10s %10s" % ("arch", "packages", "metadata", "depsolve")
+    for (arch, pkgs, timings) in results:
+        print "%-10s %8u %9.1fs %9.1fs" % (arch, len(pkgs),
+                                         timings['metadata'],
+                                         timings['depsolve'])
         if opt.nvr:
-            critpath.update([nvr(p).encode('utf8') for p in pkgs])
+            critpath.update([p[1] for p in pkgs])
         elif opt.srpm:
-            critpath.update([get_source(p.sourcerpm) for p in pkgs])
+            critpath.update([p[2] for p in pkgs])
         else:
-            critpath.update([p.name.encode('utf8') for p in pkgs])
-        del my
-        if cachedir.startswith("/tmp/"):
-            shutil.rmtree(cachedir)
-        print
+            critpath.update([p[0] for p in pkgs])
+    print "Expanded %u arches in %.1fs" % (len(results), time.time() - start)
+    print
     # Write full list
     f = open(opt.output,"w")
     for packagename in sorted(critpath):
@@ -30,30 +30,55 @@ def error(msg=None, code=1):
         sys.stderr.flush()
     sys.exit(code)
 
+def evr(pkg):
+    """Return the (epoch, version, release) tuple of a build, computing it
+    only once per build"""
+    if 'evr' not in pkg:
+        # the 'or 0' is because some epoch's that should be 0 but are None
+        # and in rpm.labelCompare(), None < 0
+        pkg['evr'] = (str(pkg['epoch'] or 0), str(pkg['version']),
+                      str(pkg['release']))
+    return pkg['evr']
+
 def compare_pkgs(pkg1, pkg2):
     """Helper function to compare two package versions
          return 1 if a > b
          return 0 if a == b
          return -1 if a < b"""
-    # the 'or 0' is because some epoch's that should be 0 but are None
-    # and in rpm.labelCompare(), None < 0
-    e1 = str(pkg1['epoch'] or 0)
-    v1 = str(pkg1['version'])
-    r1 = str(pkg1['release'])
-    e2 = str(pkg2['epoch'] or 0)
-    v2 = str(pkg2['version'])
-    r2 = str(pkg2['release'])
-    #print "(%s, %s, %s) vs (%s, %s, %s)" % (e1, v1, r1, e2, v2, r2)
-    return rpm.labelCompare((e1, v1, r1), (e2, v2, r2))
+    #print "%s vs %s" % (evr(pkg1), evr(pkg2))
+    return rpm.labelCompare(evr(pkg1), evr(pkg2))
+
+def latest_packages(tagged_pkgs, pkg_list=None):
+    """Return ({package_name: latest by nvr}, {package_name: latest by tag
+    ordering}) for the builds of a tag"""
+    if pkg_list:
+        pkg_list = set(pkg_list)
+    latest = {}
+    top = {}
+    for pkg in tagged_pkgs:
+        name = pkg['package_name']
+        if pkg_list and not name in pkg_list:
+            continue
+        top.setdefault(name, pkg)
+        if name not in latest or compare_pkgs(pkg, latest[name]) == 1:
+            latest[name] = pkg
+    return latest, top
+
+_changelogs = {}
 
 def diff_changelogs(session, pkg1, pkg2):
-    cl2 = session.getChangelogEntries(pkg2['build_id'])
-    for x in session.getChangelogEntries(pkg1['build_id']):
-        try:
-            cl2.remove(x)
-        except ValueError:
-            pass
-    return cl2
+    """Return the changelog entries of pkg2 that pkg1 does not have"""
+    missing = [pkg['build_id'] for pkg in (pkg1, pkg2)
+               if pkg['build_id'] not in _changelogs]
+    if missing:
+        session.multicall = True
+        for build_id in missing:
+            session.getChangelogEntries(build_id)
+        for build_id, result in zip(missing, session.multiCall(strict=True)):
+            _changelogs[build_id] = result[0]
+    seen = set(tuple(sorted(x.items())) for x in _changelogs[pkg1['build_id']])
+    return [x for x in _changelogs[pkg2['build_id']]
+            if tuple(sorted(x.items())) not in seen]
     #return session.getChangelogEntries(pkg2['build_id'], after=pkg1['completion_time'])
 
 def print_hidden_packages(session, tag, opts, pkg_list=None):
@@ -90,39 +115,29 @@ def print_hidden_packages(session, tag, opts, pkg_list=None):
     if opts['verbose']:
         print "\nBuilding package lists:"
 
+    # Fetch the builds of our tag and of all the tags we compare it to
+    # with a single multicall
+    session.multicall = True
+    session.listTagged(tag['id'], latest=True)
+    for ctag in comp_tags:
+        session.listTagged(ctag[ctag_id_key], latest=True)
+    results = session.multiCall(strict=True)
+
     # Build {package_name: pkg} list for all our tags
-    main_latest = {}    #latest by nvr
-    main_top = {}       #latest by tag ordering
     if opts['verbose']:
         print "%s ..." % tag['name']
-    tagged_pkgs = session.listTagged(tag['id'], latest=True)
-    if opts['verbose']:
-        print " [%d packages]" % len(tagged_pkgs)
-    for pkg in tagged_pkgs:
-        if pkg_list and not pkg['package_name'] in pkg_list:
-            continue
-        main_top.setdefault(pkg['package_name'], pkg)
-        if main_latest.has_key(pkg['package_name']) and (compare_pkgs(pkg, main_latest[pkg['package_name']]) == -1):
-            continue
-        main_latest[pkg['package_name']] = pkg
+        print " [%d packages]" % len(results[0][0])
+    #latest by nvr, latest by tag ordering
+    main_latest, main_top = latest_packages(results[0][0], pkg_list)
 
     comp_latest = {}    #latest by nvr
     comp_top = {}       #latest by tag ordering
-    for ctag in comp_tags:
+    for ctag, result in zip(comp_tags, results[1:]):
         if opts['verbose']:
             print "%s ..." % ctag['name']
-        tagged_pkgs = session.listTagged(ctag[ctag_id_key], latest=True)
-        if opts['verbose']:
-            print " [%d packages]" % len(tagged_pkgs)
-        comp_latest[ctag['name']] = {}
-        comp_top[ctag['name']] = {}
-        for pkg in tagged_pkgs:
-            if pkg_list and not pkg['package_name'] in pkg_list:
-                continue
-            comp_top[ctag['name']].setdefault(pkg['package_name'], pkg)
-            if comp_latest[ctag['name']].has_key(pkg['package_name']) and (compare_pkgs(pkg, comp_latest[ctag['name']][pkg['package_name']]) == -1):
-                continue
-            comp_latest[ctag['name']][pkg['package_name']] = pkg
+            print " [%d packages]" % len(result[0])
+        comp_latest[ctag['name']], comp_top[ctag['name']] = \
+            latest_packages(result[0], pkg_list)
 
     # Check for invalid packages
     if pkg_list and opts['verbose']:
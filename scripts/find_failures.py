@@ -14,6 +14,11 @@
 import koji
 import operator
 import datetime
+import json
+import os
+from optparse import OptionParser
+
+import kojiutils
 
 # Set some variables
 # Some of these could arguably be passed in as args.
@@ -22,6 +27,9 @@ desttag = 'f23' # Tag where fixed builds go
 epoch = '2015-06-16 00:00:00.000000' # Date to check for failures from
 failures = {} # dict of owners to lists of packages that failed.
 failed = [] # raw list of failed packages
+multicall_size = 100 # calls per koji multicall
+# Info of finished tasks does not change anymore, so it is kept between runs
+taskinfo_cache = os.path.expanduser('~/.cache/find_failures-taskinfo.pickle')
 
 
 def get_failed_builds(kojisession, epoch, buildtag, desttag):
@@ -47,63 +55,87 @@ def get_failed_builds(kojisession, epoch, buildtag, desttag):
     for build in destbuilds:
         if build['creation_time'] > epoch:
             goodbuilds.append(build)
+    good_ids = set(build['package_id'] for build in goodbuilds)
 
     pkgs = kojisession.listPackages(desttag, inherited=True)
 
     # get the list of packages that are blocked
-    pkgs = sorted([pkg for pkg in pkgs if pkg['blocked']],
-                  key=operator.itemgetter('package_id'))
+    blocked_ids = set(pkg['package_id'] for pkg in pkgs if pkg['blocked'])
 
     # Check if newer build exists for package
-    failbuilds = []
-    for build in failtasks:
-        if ((not build['package_id'] in [goodbuild['package_id'] for goodbuild in goodbuilds]) and (not build['package_id'] in [pkg['package_id'] for pkg in pkgs])):
-            failbuilds.append(build)
-
-    # Generate taskinfo for each failed build
-    kojisession.multicall = True
+    failbuilds = [build for build in failtasks
+                  if build['package_id'] not in good_ids and
+                  build['package_id'] not in blocked_ids]
+
+    # Generate taskinfo for each failed build, only asking koji about the
+    # tasks we have not seen in an earlier run
+    taskinfos = kojiutils.load_pickle(taskinfo_cache, {})
+    missing = sorted(set(build['task_id'] for build in failbuilds
+                         if build['task_id'] not in taskinfos))
+    if missing:
+        results = kojiutils.multicall(kojisession, 'getTaskInfo',
+                                      [((task_id,), {'request': True})
+                                       for task_id in missing],
+                                      size=multicall_size, strict=True)
+        for task_id, [taskinfo] in zip(missing, results):
+            taskinfos[task_id] = taskinfo
+        kojiutils.save_pickle(taskinfo_cache, taskinfos)
     for build in failbuilds:
-        kojisession.getTaskInfo(build['task_id'], request=True)
+        build['taskinfo'] = taskinfos[build['task_id']]
 
-    taskinfos = kojisession.multiCall()
-    for build, [taskinfo] in zip(failbuilds, taskinfos):
-        build['taskinfo'] = taskinfo
     # Get owners of the packages with failures
-    kojisession.multicall = True
+    owners = dict((pkg['package_id'], pkg['owner_name']) for pkg in
+                  kojisession.listPackages(tagID=buildtag, inherited=True))
     for build in failbuilds:
-        kojisession.listPackages(tagID=buildtag,
-                                 pkgID=build['package_id'],
-                                 inherited=True)
-    pkginfo = kojisession.multiCall()
-
-    for build, [pkg] in zip(failbuilds, pkginfo):
-        if len(pkg) > 0:
-            build['package_owner'] = pkg[0]['owner_name']
-        else:
+        if build['package_id'] in owners:
+            build['package_owner'] = owners[build['package_id']]
+    return failbuilds
+
+
+def get_rebuild_failures(kojisession, epoch, buildtag, desttag):
+    """This function returns a dict of package names to the latest failed
+    build of the package that was built for buildtag. Each build has its
+    taskinfo URL as 'taskurl'.
+
+    Keyword arguments are the same as for get_failed_builds()
+    """
+    failbuilds = {}
+    for build in get_failed_builds(kojisession, epoch, buildtag, desttag):
+        if not build['taskinfo']['request'][1] == buildtag:
             continue
+        build['taskurl'] = 'http://koji.fedoraproject.org/koji/taskinfo?taskID=%s' % build['task_id']
+        # failed builds are sorted by task id, so the latest one wins
+        failbuilds[build['package_name']] = build
     return failbuilds
 
 
 if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--json", metavar="FILE",
+                      help="also write the failures as JSON to FILE")
+    (options, args) = parser.parse_args()
+
     # Create a koji session
     kojisession = koji.ClientSession('http://koji.fedoraproject.org/kojihub')
 
-    failbuilds = get_failed_builds(kojisession, epoch, buildtag, desttag)
-
+    failbuilds = get_rebuild_failures(kojisession, epoch, buildtag, desttag)
 
     # Generate the dict with the failures and urls
-    for build in failbuilds:
-        if not build['taskinfo']['request'][1] == buildtag:
-            continue
-        taskurl = 'http://koji.fedoraproject.org/koji/taskinfo?taskID=%s' % build['task_id']
-        owner = build['package_owner']
-        pkg = build['package_name']
-        if not pkg in failed:
-            failed.append(pkg)
-        failures.setdefault(owner, {})[pkg] = taskurl
+    failed = sorted(failbuilds.keys())
+    for pkg in failed:
+        build = failbuilds[pkg]
+        owner = build.get('package_owner')
+        failures.setdefault(owner, {})[pkg] = build['taskurl']
 
     now = datetime.datetime.now()
     now_str = "%s UTC" % str(now.utcnow())
+
+    if options.json:
+        with open(options.json, 'w') as jsonfile:
+            json.dump({'last_run': now_str, 'buildtag': buildtag,
+                       'desttag': desttag, 'failed': failed,
+                       'failures': failures}, jsonfile, indent=2)
+
     print '<html><head>'
     print '<title>Packages that failed to build as of %s</title>' % now_str
     print '<style type="text/css"> dt { margin-top: 1em } </style>'
@@ -12,17 +12,20 @@
 #     Till Maas <opensource@till.name>
 
 from Queue import Queue
+from StringIO import StringIO
 from collections import OrderedDict
-from threading import Thread
+from threading import Lock, Thread
 import argparse
 import cPickle as pickle
 import datetime
 import email.mime.text
 import hashlib
+import json
 import os
 import smtplib
 import sys
 import textwrap
+import time
 
 import koji
 import pkgdb2client
@@ -144,7 +147,7 @@ def get_cache(filename,
     """ Get a pickle file from cache
     :param filename: Filename with pickle data
     :type filename: str
-    :param max_age: Maximum age of cache in seconds
+    :param max_age: Maximum age of cache in seconds, None to never expire
     :type max_age: int
     :param cachedir: Directory to get file from
     :type cachedir: str
@@ -158,7 +161,7 @@ def get_cache(filename,
             mtime = os.fstat(pickle_file.fileno()).st_mtime
             mtime = datetime.datetime.fromtimestamp(mtime)
             now = datetime.datetime.now()
-            if (now - mtime).total_seconds() < max_age:
+            if max_age is None or (now - mtime).total_seconds() < max_age:
                 res = pickle.load(pickle_file)
             else:
                 res = default
@@ -177,7 +180,86 @@ def write_cache(data, filename, cachedir='~/.cache'):
     """
     cache_file = os.path.expanduser(os.path.join(cachedir, filename))
     with open(cache_file, "wb") as pickle_file:
-        pickle.dump(data, pickle_file)
+        pickle.dump(data, pickle_file, pickle.HIGHEST_PROTOCOL)
+
+
+class PKGDBCache(object):
+    """ Persistent cache of PKGDBInfo objects with a TTL per entry
+
+    Entries are appended to the cache file as soon as they are added, so a
+    crash does not lose lookups. Expired entries are dropped when the file is
+    loaded.
+    """
+    def __init__(self, filename, ttl=86400, cachedir='~/.cache'):
+        self.filename = os.path.expanduser(os.path.join(cachedir, filename))
+        self.ttl = ttl
+        self.lock = Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.load()
+
+    def load(self):
+        now = time.time()
+        try:
+            with open(self.filename, "rb") as pickle_file:
+                while True:
+                    try:
+                        package, expires, pkginfo = pickle.load(pickle_file)
+                    except EOFError:
+                        break
+                    except Exception as e:
+                        # Probably truncated by a crash while writing
+                        sys.stderr.write(
+                            "Ignoring rest of {}: {}\n".format(
+                                self.filename, e))
+                        break
+                    if expires > now:
+                        self.entries[package] = (expires, pkginfo)
+        except IOError:
+            pass
+
+        # Rewrite the file without expired or duplicate entries
+        cachedir = os.path.dirname(self.filename)
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        with open(self.filename + ".tmp", "wb") as pickle_file:
+            for package, (expires, pkginfo) in self.entries.iteritems():
+                pickle.dump((package, expires, pkginfo), pickle_file,
+                            pickle.HIGHEST_PROTOCOL)
+        os.rename(self.filename + ".tmp", self.filename)
+        self.cache_file = open(self.filename, "ab")
+
+    def get(self, package):
+        """ Return cached PKGDBInfo for ``package`` or None """
+        with self.lock:
+            entry = self.entries.get(package)
+            if entry is not None and entry[0] > time.time():
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def add(self, package, pkginfo, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        with self.lock:
+            if pkginfo.pkginfo is None:
+                # do not cache failed lookups
+                self.errors += 1
+                return
+            expires = time.time() + ttl
+            self.entries[package] = (expires, pkginfo)
+            pickle.dump((package, expires, pkginfo), self.cache_file,
+                        pickle.HIGHEST_PROTOCOL)
+            self.cache_file.flush()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = 100.0 * self.hits / lookups if lookups else 0.0
+        return "{} lookups, {} hits ({:.1f}%), {} misses, {} errors".format(
+            lookups, self.hits, hit_rate, self.misses, self.errors)
 
 
 class PKGDBInfo(object):
@@ -262,9 +344,94 @@ def setup_yum(repo=RAWHIDE_RELEASE["repo"],
     return yb
 
 
-def orphan_packages(branch=RAWHIDE_RELEASE["branch"]):
+def repomd_checksum(yumbase):
+    """ Return a checksum over the repomd.xml files of all enabled repos
+    """
+    digest = hashlib.sha256()
+    for repo in sorted(yumbase.repos.listEnabled(), key=lambda r: r.id):
+        repomd = os.path.join(repo.cachedir, 'repomd.xml')
+        with open(repomd, "rb") as repomd_file:
+            digest.update(repomd_file.read())
+    return digest.hexdigest()
+
+
+class DepIndex(object):
+    """ Index of provide -> providers, requirement -> requirers and
+    file -> owners for all packages of a YumBase, built in a single pass over
+    the package sack.
+
+    The index refers to packages by their position in a list of pkgtups, so
+    it can be cached on disk and is reused as long as the repo metadata
+    (repomd.xml checksum) does not change.
+    """
+    def __init__(self, yumbase, cache_filename=None):
+        packages = yumbase.pkgSack.returnPackages()
+        by_pkgtup = dict((pkg.pkgtup, pkg) for pkg in packages)
+
+        checksum = repomd_checksum(yumbase)
+        cached = None
+        if cache_filename:
+            cached = get_cache(cache_filename, max_age=None)
+        if cached and cached["checksum"] == checksum:
+            index = cached
+        else:
+            index = self.build(packages)
+            index["checksum"] = checksum
+            if cache_filename:
+                try:
+                    write_cache(index, cache_filename)
+                except IOError, e:
+                    sys.stderr.write(
+                        "Caching of dependency index failed: {0}\n".format(e))
+
+        self.packages = [by_pkgtup[pkgtup] for pkgtup in index["pkgtups"]]
+        self._provides = index["provides"]
+        self._requires = index["requires"]
+        self._files = index["files"]
+
+    @staticmethod
+    def build(packages):
+        provides = {}
+        requires = {}
+        files = {}
+        for pkg_idx, pkg in enumerate(packages):
+            for (name, flag, evr) in pkg.provides:
+                provides.setdefault(name, set()).add(pkg_idx)
+            for (name, flag, evr) in pkg.requires:
+                requires.setdefault(name, set()).add(pkg_idx)
+            # pkg.files is a dict with keys like "file" and "dir", values are
+            # a list of file/dir paths, see find_dependent_packages() for the
+            # normalisation
+            for paths in pkg.files.itervalues():
+                for fn in paths:
+                    files.setdefault(os.path.normpath('//%s' % fn),
+                                     set()).add(pkg_idx)
+
+        def compact(mapping):
+            return dict((key, tuple(value))
+                        for key, value in mapping.iteritems())
+
+        return dict(
+            pkgtups=[pkg.pkgtup for pkg in packages],
+            provides=compact(provides),
+            requires=compact(requires),
+            files=compact(files),
+        )
+
+    def providers(self, name):
+        """ Return packages providing ``name`` as a provide or as a file """
+        idxs = set(self._provides.get(name, ()))
+        idxs.update(self._files.get(name, ()))
+        return [self.packages[i] for i in idxs]
+
+    def requirers(self, name):
+        """ Return packages requiring ``name`` """
+        return [self.packages[i] for i in self._requires.get(name, ())]
+
+
+def orphan_packages(branch=RAWHIDE_RELEASE["branch"], max_age=3600):
     cache_filename = 'orphans-{}.pickle'.format(branch)
-    orphans = get_cache(cache_filename, default={})
+    orphans = get_cache(cache_filename, max_age=max_age, default={})
 
     if orphans:
         return orphans
@@ -305,9 +472,11 @@ def unblocked_packages(packages, tagID=RAWHIDE_RELEASE["tag"]):
 
 
 class DepChecker(object):
-    def __init__(self, release, repo=None, source_repo=None):
+    def __init__(self, release, repo=None, source_repo=None,
+                 pkgdb_workers=8, pkgdb_cache_ttl=86400):
         self._src_by_bin = None
         self._bin_by_src = None
+        self._dep_index = None
         self.release = release
         if repo is None:
             repo = RELEASES[release]["repo"]
@@ -318,8 +487,12 @@ class DepChecker(object):
         yumbase = setup_yum(repo=repo, source_repo=source_repo)
         self.yumbase = yumbase
         self.pkgdbinfo_queue = Queue()
-        self.pkgdb_cache = "orphans-pkgdb-{}.pickle".format(release)
-        self.pkgdb_dict = get_cache(self.pkgdb_cache, default={})
+        self.pkgdb_cache = PKGDBCache(
+            "orphans-pkgdb-{}.pickles".format(release), ttl=pkgdb_cache_ttl)
+        self.pkgdb_dict = {}
+        self.pkgdb_requested = set()
+        self.pkgdb_workers = pkgdb_workers
+        self.pkgdb_threads = []
         self.not_in_repo = []
 
     def create_mapping(self):
@@ -341,6 +514,15 @@ class DepChecker(object):
         self._src_by_bin = src_by_bin
         self._bin_by_src = bin_by_src
 
+    @property
+    def dep_index(self):
+        if self._dep_index is None:
+            self._dep_index = DepIndex(
+                self.yumbase,
+                cache_filename="orphans-depindex-{}.pickle".format(
+                    self.release))
+        return self._dep_index
+
     @property
     def by_src(self):
         if not self._bin_by_src:
@@ -357,10 +539,10 @@ class DepChecker(object):
         """ Return packages depending on packages built from SRPM ``srpmname``
             that are built from different SRPMS not specified in ``ignore``.
 
-            :param ignore: list of binary package names that will not be
+            :param ignore: binary package names that will not be
                 returned as dependent packages or considered as alternate
                 providers
-            :type ignore: list() of str()
+            :type ignore: set() of str()
 
             :returns: OrderedDict dependent_package: list of requires only
                 provided by package ``srpmname`` {dep_pkg: [prov, ...]}
@@ -377,6 +559,7 @@ class DepChecker(object):
                 "Package {0} not found in repo\n".format(srpmname))
             self.not_in_repo.append(srpmname)
             rpms = []
+        own_rpms = set(rpms)
 
         # provides of all packages built from ``srpmname``
         provides = []
@@ -404,28 +587,17 @@ class DepChecker(object):
             # "foo = 1.fc20" -> "foo"
             base_provide = prov.split()[0]
 
-            # FIXME: Workaround for:
-            # https://bugzilla.redhat.com/show_bug.cgi?id=1191178
-            if base_provide[0] == "/":
-                base_provide = base_provide.replace("[", "?")
-                base_provide = base_provide.replace("]", "?")
-
             # Elide provide if also provided by another package
-            for pkg in self.yumbase.pkgSack.searchProvides(base_provide):
+            for pkg in self.dep_index.providers(base_provide):
                 # FIXME: might miss broken dependencies in case the other
                 # provider depends on a to-be-removed package as well
-                if pkg.name in ignore:
-                    #sys.stderr.write("Ignoring provider package %s\n" %
-                    #                  pkg.name)
-                    pass
-                else:
+                if pkg.name not in ignore:
                     break
             else:
-                for dependent_pkg in self.yumbase.pkgSack.searchRequires(
-                        base_provide):
+                for dependent_pkg in self.dep_index.requirers(base_provide):
                     # skip if the dependent rpm package belongs to the
                     # to-be-removed Fedora package
-                    if dependent_pkg in self.by_src[srpmname]:
+                    if dependent_pkg in own_rpms:
                         continue
 
                     # skip if the dependent rpm package is also a
@@ -443,32 +615,47 @@ class DepChecker(object):
         branch = RELEASES[self.release]["branch"]
         while True:
             package = self.pkgdbinfo_queue.get()
-            if package not in self.pkgdb_dict:
-                pkginfo = PKGDBInfo(package, branch)
-                self.pkgdb_dict[package] = pkginfo
-            self.pkgdbinfo_queue.task_done()
+            # always mark the package done, or join() on the queue hangs
+            try:
+                pkginfo = self.pkgdb_cache.get(package)
+                if pkginfo is None:
+                    pkginfo = PKGDBInfo(package, branch)
+                    self.pkgdb_dict[package] = pkginfo
+                    self.pkgdb_cache.add(package, pkginfo)
+                else:
+                    self.pkgdb_dict[package] = pkginfo
+            except Exception as e:
+                sys.stderr.write(
+                    "Error looking up {} in pkgdb: {}\n".format(package, e))
+            finally:
+                self.pkgdbinfo_queue.task_done()
+
+    def prefetch_pkgdb(self, package):
+        """ Queue a (co)maintainer lookup for ``package`` unless it was
+        already requested, starting the worker threads if needed """
+        if not self.pkgdb_threads:
+            for i in range(0, self.pkgdb_workers):
+                people_thread = Thread(target=self.pkgdb_worker)
+                people_thread.daemon = True
+                people_thread.start()
+                self.pkgdb_threads.append(people_thread)
+        if package not in self.pkgdb_requested:
+            self.pkgdb_requested.add(package)
+            self.pkgdbinfo_queue.put(package)
 
     def recursive_deps(self, packages, max_deps=20):
-        # Start threads to get information about (co)maintainers for packages
-        for i in range(0, 2):
-            people_thread = Thread(target=self.pkgdb_worker)
-            people_thread.daemon = True
-            people_thread.start()
-        # keep pylint silent
-        del i
-        # get a list of all rpm_pkgs that are to be removed
-        rpm_pkg_names = []
+        # get a set of all rpm_pkgs that are to be removed
+        ignore = set()
         for name in packages:
-            self.pkgdbinfo_queue.put(name)
+            self.prefetch_pkgdb(name)
             # Empty list if pkg is only for a different arch
             bin_pkgs = self.by_src.get(name, [])
-            rpm_pkg_names.extend([p.name for p in bin_pkgs])
+            ignore.update([p.name for p in bin_pkgs])
 
         # dict for all dependent packages for each to-be-removed package
         dep_map = OrderedDict()
         for name in sorted(packages):
             sys.stderr.write("Checking: {0}\n".format(name))
-            ignore = rpm_pkg_names
             dep_map[name] = OrderedDict()
             to_check = [name]
             allow_more = True
@@ -482,7 +669,6 @@ class DepChecker(object):
                                                                   ignore)
                 if dependent_packages:
                     new_names = []
-                    new_srpm_names = set()
                     for pkg, dependencies in dependent_packages.items():
                         if pkg.arch != "src":
                             srpm_name = self.by_bin[pkg].name
@@ -492,7 +678,7 @@ class DepChecker(object):
                                 srpm_name not in new_names and \
                                 srpm_name not in seen:
                             new_names.append(srpm_name)
-                        new_srpm_names.add(srpm_name)
+                        self.prefetch_pkgdb(srpm_name)
 
                         for dep in dependencies:
                             dep_map[name].setdefault(
@@ -500,10 +686,7 @@ class DepChecker(object):
                                 OrderedDict()
                             ).setdefault(pkg, set()).add(dep)
 
-                    for srpm_name in new_srpm_names:
-                        self.pkgdbinfo_queue.put(srpm_name)
-
-                    ignore.extend(new_names)
+                    ignore.update(new_names)
                     if allow_more:
                         to_check.extend(new_names)
                         dep_count = len(set(dep_map[name].keys() + to_check))
@@ -520,7 +703,7 @@ class DepChecker(object):
         sys.stderr.write("Waiting for (co)maintainer information...")
         self.pkgdbinfo_queue.join()
         sys.stderr.write("done\n")
-        write_cache(self.pkgdb_dict, self.pkgdb_cache)
+        sys.stderr.write("pkgdb cache: {}\n".format(self.pkgdb_cache.stats()))
         return dep_map
 
     # This function was stolen from pungi
@@ -542,175 +725,228 @@ class DepChecker(object):
             sys.exit(1)
 
 
-def maintainer_table(packages, pkgdb_dict):
-    affected_people = {}
+def pkgdb_people(pkgdb_dict, package):
+    """ Return the (co)maintainers of ``package``, an empty list if the
+    pkgdb lookup failed """
+    pkginfo = pkgdb_dict.get(package)
+    if pkginfo is None:
+        return []
+    return pkginfo.get_people()
+
+
+def pkgdb_age(pkgdb_dict, package):
+    """ Return the age of the status change of ``package``, None if the
+    pkgdb lookup failed """
+    pkginfo = pkgdb_dict.get(package)
+    if pkginfo is None or pkginfo.pkginfo is None:
+        return None
+    return pkginfo.age
+
 
+def maintainer_table(out, packages, pkgdb_dict, affected_people):
     if with_table:
         table = texttable.Texttable(max_width=80)
         table.header(["Package", "(co)maintainers", "Status Change"])
         table.set_cols_align(["l", "l", "l"])
         table.set_deco(table.HEADER)
-    else:
-        table = ""
 
     for package_name in packages:
-        pkginfo = pkgdb_dict[package_name]
-        people = pkginfo.get_people()
+        people = pkgdb_people(pkgdb_dict, package_name)
         for p in people:
             affected_people.setdefault(p, set()).add(package_name)
         p = ', '.join(people)
-        age = pkginfo.age
-        agestr = "{} weeks ago".format(age.days / 7)
+        age = pkgdb_age(pkgdb_dict, package_name)
+        if age is None:
+            agestr = "unknown"
+        else:
+            agestr = "{} weeks ago".format(age.days / 7)
 
         if with_table:
             table.add_row([package_name, p, agestr])
         else:
-            table += "{} {} {}\n".format(package_name, p, agestr)
+            out.write("{} {} {}\n".format(package_name, p, agestr))
 
     if with_table:
-        table = table.draw()
-    return table, affected_people
+        out.write(table.draw())
 
 
-def dependency_info(dep_map, affected_people, pkgdb_dict):
-    info = ""
+def dependency_info(out, dep_map, affected_people, pkgdb_dict):
     for package_name, subdict in dep_map.items():
         if subdict:
-            pkginfo = pkgdb_dict[package_name]
-            status_change = pkginfo.status_change.strftime("%Y-%m-%d")
-            age = pkginfo.age.days / 7
+            age = pkgdb_age(pkgdb_dict, package_name)
+            if age is None:
+                status_change = "unknown"
+                age = "?"
+            else:
+                status_change = pkgdb_dict[package_name].status_change
+                status_change = status_change.strftime("%Y-%m-%d")
+                age = age.days / 7
             fmt = "Depending on: {} ({}), status change: {} ({} weeks ago)\n"
-            info += fmt.format(package_name, len(subdict.keys()),
-                               status_change, age)
+            out.write(fmt.format(package_name, len(subdict.keys()),
+                                 status_change, age))
             for fedora_package, dependent_packages in subdict.items():
-                people = pkgdb_dict[fedora_package].get_people()
+                people = pkgdb_people(pkgdb_dict, fedora_package)
                 for p in people:
                     affected_people.setdefault(p, set()).add(package_name)
                 p = ", ".join(people)
-                info += "\t{0} (maintained by: {1})\n".format(fedora_package,
-                                                              p)
+                out.write("\t{0} (maintained by: {1})\n".format(
+                    fedora_package, p))
                 for dep in dependent_packages:
                     provides = ", ".join(sorted(dependent_packages[dep]))
-                    info += "\t\t%s requires %s\n" % (dep.nvra, provides)
-                info += "\n"
-            info += "\n"
-    return info
+                    out.write("\t\t%s requires %s\n" % (dep.nvra, provides))
+                out.write("\n")
+            out.write("\n")
 
 
-def maintainer_info(affected_people):
-    info = ""
+def maintainer_info(out, affected_people):
     for person in sorted(affected_people.iterkeys()):
         packages = affected_people[person]
         if person == ORPHAN_UID:
             continue
-        info += "{0}: {1}\n".format(person, ", ".join(packages))
-    return info
-
+        out.write("{0}: {1}\n".format(person, ", ".join(packages)))
 
-def package_info(unblocked, dep_map, depchecker, orphans=None, failed=None,
-                 week_limit=6, release=""):
-    info = ""
-    pkgdb_dict = depchecker.pkgdb_dict
 
-    table, affected_people = maintainer_table(unblocked, pkgdb_dict)
-    info += table
-    info += "\n\nThe following packages require above mentioned packages:\n"
-    info += dependency_info(dep_map, affected_people, pkgdb_dict)
+def package_categories(unblocked, dep_map, depchecker, orphans=None,
+                       failed=None, week_limit=6, release=""):
+    """ Sort the packages into the report categories in one pass over the
+    orphans and the FTBFS packages
 
-    info += "Affected (co)maintainers\n"
-    info += maintainer_info(affected_people)
+    :returns: list of (key, label, packages) in report order
+    """
+    pkgdb_dict = depchecker.pkgdb_dict
 
     if release:
         release_text = " ({})".format(release)
     else:
         release_text = ""
 
-    wrapper = textwrap.TextWrapper(
-        break_long_words=False, subsequent_indent="    ",
-        break_on_hyphens=False
-    )
+    categories = []
 
-    def wrap_and_format(label, pkgs):
-        count = len(pkgs)
-        text = "{} ({}): {}".format(label, count, " ".join(pkgs))
-        wrappedtext = "\n" + wrapper.fill(text) + "\n\n"
-        return wrappedtext
+    breaking = set()
+    for deps in dep_map.itervalues():
+        breaking.update(deps.iterkeys())
 
     if orphans:
-        orphans = [o for o in orphans if o in unblocked]
-        info += wrap_and_format("Orphans", orphans)
-
-        orphans_breaking_deps = [o for o in orphans if
-                                 o in dep_map and dep_map[o]]
-        info += wrap_and_format("Orphans (dependend on)",
-                                orphans_breaking_deps)
-
-        orphans_breaking_deps_stale = [
-            o for o in orphans_breaking_deps if
-            (pkgdb_dict[o].age.days / 7) >= week_limit]
+        unblocked = set(unblocked)
+        unblocked_orphans = []
+        breaking_deps = []
+        breaking_deps_stale = []
+        not_breaking_deps = []
+        not_breaking_deps_stale = []
+        stale_breaking = set()
+        for o in orphans:
+            if o not in unblocked:
+                continue
+            unblocked_orphans.append(o)
+            age = pkgdb_age(pkgdb_dict, o)
+            stale = age is not None and (age.days / 7) >= week_limit
+            if dep_map.get(o):
+                breaking_deps.append(o)
+                if stale:
+                    breaking_deps_stale.append(o)
+                    stale_breaking.update(dep_map[o].iterkeys())
+            else:
+                not_breaking_deps.append(o)
+                if stale:
+                    not_breaking_deps_stale.append(o)
+
+        categories.extend([
+            ("orphans", "Orphans", unblocked_orphans),
+            ("orphans_breaking_deps", "Orphans (dependend on)",
+             breaking_deps),
+            ("orphans_breaking_deps_stale",
+             "Orphans{} for at least {} weeks (dependend on)".format(
+                 release_text, week_limit),
+             breaking_deps_stale),
+            ("orphans_not_breaking_deps",
+             "Orphans {}(not depended on)".format(release_text),
+             not_breaking_deps),
+            ("orphans_not_breaking_deps_stale",
+             "Orphans{} for at least {} weeks (not dependend on)".format(
+                 release_text, week_limit),
+             not_breaking_deps_stale),
+        ])
 
-        info += wrap_and_format(
-            "Orphans{} for at least {} weeks (dependend on)".format(
-                release_text, week_limit),
-            orphans_breaking_deps_stale)
+    if breaking:
+        categories.append(("breaking", "Depending packages" + release_text,
+                           sorted(breaking)))
 
-        orphans_not_breaking_deps = [o for o in orphans if
-                                     o not in dep_map or not dep_map[o]]
+        if orphans and unblocked_orphans:
+            categories.append((
+                "stale_breaking",
+                "Packages depending on packages orphaned{} for more than "
+                "{} weeks".format(release_text, week_limit),
+                sorted(stale_breaking)))
 
-        info += wrap_and_format("Orphans {}(not depended on)".format(
-            release_text),
-            orphans_not_breaking_deps)
+    if failed:
+        ftbfs_label = "FTBFS" + release_text
+        ftbfs_breaking_deps = []
+        ftbfs_not_breaking_deps = []
+        for o in failed:
+            if dep_map.get(o):
+                ftbfs_breaking_deps.append(o)
+            else:
+                ftbfs_not_breaking_deps.append(o)
 
-        orphans_not_breaking_deps_stale = [
-            o for o in orphans_not_breaking_deps if
-            (pkgdb_dict[o].age.days / 7) >= week_limit]
+        categories.extend([
+            ("ftbfs", ftbfs_label, failed),
+            ("ftbfs_breaking_deps", ftbfs_label + " (depended on)",
+             ftbfs_breaking_deps),
+            ("ftbfs_not_breaking_deps", ftbfs_label + " (not depended on)",
+             ftbfs_not_breaking_deps),
+        ])
 
-        info += wrap_and_format(
-            "Orphans{} for at least {} weeks (not dependend on)".format(
-                release_text, week_limit),
-            orphans_not_breaking_deps_stale)
+    if depchecker.not_in_repo:
+        categories.append(("not_in_repo", "Not found in repo" + release_text,
+                           sorted(depchecker.not_in_repo)))
 
-    breaking = set()
-    for package, deps in dep_map.items():
-        breaking = breaking.union(set(deps.keys()))
+    return categories
 
-    if breaking:
-        info += wrap_and_format("Depending packages" + release_text,
-                                sorted(breaking))
-
-        if orphans:
-            stale_breaking = set()
-            for package in orphans_breaking_deps_stale:
-                stale_breaking = stale_breaking.union(
-                    set(dep_map[package].keys()))
-            info += wrap_and_format(
-                "Packages depending on packages orphaned{} for more than "
-                "{} weeks".format(release_text, week_limit),
-                sorted(stale_breaking))
 
-    if failed:
-        ftbfs_label = "FTBFS" + release_text
-        info += wrap_and_format(ftbfs_label, failed)
+def package_info(out, unblocked, dep_map, depchecker, orphans=None,
+                 failed=None, week_limit=6, release=""):
+    """ Write the report to out
 
-        ftbfs_breaking_deps = [o for o in failed if
-                               o in dep_map and dep_map[o]]
+    :returns: (mail addresses of the affected people, report data for JSON
+        output)
+    """
+    pkgdb_dict = depchecker.pkgdb_dict
+    affected_people = {}
 
-        info += wrap_and_format(ftbfs_label + " (depended on)",
-                                ftbfs_breaking_deps)
+    maintainer_table(out, unblocked, pkgdb_dict, affected_people)
+    out.write("\n\nThe following packages require above mentioned "
+              "packages:\n")
+    dependency_info(out, dep_map, affected_people, pkgdb_dict)
 
-        ftbfs_not_breaking_deps = [o for o in failed if
-                                   o not in dep_map or not dep_map[o]]
+    out.write("Affected (co)maintainers\n")
+    maintainer_info(out, affected_people)
 
-        info += wrap_and_format(ftbfs_label + " (not depended on)",
-                                ftbfs_not_breaking_deps)
+    wrapper = textwrap.TextWrapper(
+        break_long_words=False, subsequent_indent="    ",
+        break_on_hyphens=False
+    )
 
-    if depchecker.not_in_repo:
-        info += wrap_and_format("Not found in repo" + release_text,
-                                sorted(depchecker.not_in_repo))
+    categories = package_categories(unblocked, dep_map, depchecker,
+                                    orphans=orphans, failed=failed,
+                                    week_limit=week_limit, release=release)
+    for key, label, pkgs in categories:
+        text = "{} ({}): {}".format(label, len(pkgs), " ".join(pkgs))
+        out.write("\n" + wrapper.fill(text) + "\n\n")
 
     addresses = ["{0}@fedoraproject.org".format(p)
                  for p in affected_people.keys() if p != ORPHAN_UID]
-    return info, addresses
+    report = OrderedDict((key, pkgs) for key, label, pkgs in categories)
+    report["dependencies"] = dict(
+        (package_name, dict(
+            (fedora_package, dict(
+                (dep.nvra, sorted(provides))
+                for dep, provides in dependent_packages.items()))
+            for fedora_package, dependent_packages in subdict.items()))
+        for package_name, subdict in dep_map.items() if subdict)
+    report["affected_people"] = dict(
+        (person, sorted(packages))
+        for person, packages in affected_people.items())
+    return addresses, report
 
 
 def main():
@@ -734,6 +970,14 @@ def main():
                         dest="skipblocked", action="store_false",
                         help="Do not skip blocked pkgs")
     parser.add_argument("--mailfrom", default="nobody@fedoraproject.org")
+    parser.add_argument("--pkgdb-workers", default=8, type=int,
+                        help="Number of parallel pkgdb lookups")
+    parser.add_argument("--pkgdb-cache-ttl", default=86400, type=int,
+                        help="Seconds to cache (co)maintainer information")
+    parser.add_argument("--orphans-cache-ttl", default=3600, type=int,
+                        help="Seconds to cache the list of orphans")
+    parser.add_argument("--json", default=None, metavar="FILE",
+                        help="Also write the report as JSON to FILE")
     parser.add_argument("failed", nargs="*",
                         help="Additional packages, e.g. FTBFS packages")
     args = parser.parse_args()
@@ -750,7 +994,8 @@ def main():
     else:
         # list of orphans on the devel branch from pkgdb
         sys.stderr.write('Contacting pkgdb for list of orphans...')
-        orphans = sorted(orphan_packages(RELEASES[args.release]["branch"]))
+        orphans = sorted(orphan_packages(RELEASES[args.release]["branch"],
+                                         max_age=args.orphans_cache_ttl))
         sys.stderr.write('done\n')
 
     sys.stderr.write('Getting builds from koji...')
@@ -762,22 +1007,36 @@ def main():
         unblocked = allpkgs
     sys.stderr.write('done\n')
 
-    text = HEADER.format(RELEASES[args.release]["tag"].upper())
     sys.stderr.write("Setting up dependency checker...")
-    depchecker = DepChecker(args.release)
+    depchecker = DepChecker(args.release, pkgdb_workers=args.pkgdb_workers,
+                            pkgdb_cache_ttl=args.pkgdb_cache_ttl)
     sys.stderr.write("done\n")
     sys.stderr.write('Calculating dependencies...')
     # Create yum object and depsolve out if requested.
     # TODO: add app args to either depsolve or not
     dep_map = depchecker.recursive_deps(unblocked)
     sys.stderr.write('done\n')
-    info, addresses = package_info(
-        unblocked, dep_map, depchecker, orphans=orphans, failed=failed,
+
+    # Only keep the text around if it needs to be mailed
+    if args.mailto or args.send:
+        out = StringIO()
+    else:
+        out = sys.stdout
+    out.write(HEADER.format(RELEASES[args.release]["tag"].upper()))
+    out.write("\n")
+    addresses, report = package_info(
+        out, unblocked, dep_map, depchecker, orphans=orphans, failed=failed,
         release=args.release)
-    text += "\n"
-    text += info
-    text += FOOTER
-    print text
+    out.write(FOOTER)
+    out.write("\n")
+    if out is not sys.stdout:
+        text = out.getvalue()
+        sys.stdout.write(text)
+
+    if args.json:
+        report["release"] = args.release
+        with open(args.json, "w") as jsonfile:
+            json.dump(report, jsonfile, indent=2)
 
     if args.mailto or args.send:
         now = datetime.datetime.utcnow()
@@ -16,18 +16,25 @@ import time
 import string
 import rpm 
 import shutil
-
-inherit = False
-# get architecture and tag from command line
-if len(sys.argv) > 2:
-    SECONDARY_ARCH = sys.argv[1]
-    tag = sys.argv[2]
-    if len(sys.argv) > 3:
-        inherit = True
-else:
-    print("Compare the content of a tag between 2 koji instances")
-    print("Usage: %s <arch> <tag>" % sys.argv[0])
-    exit(0)
+import functools
+import json
+import argparse
+
+parser = argparse.ArgumentParser(
+    description="Compare the content of a tag between 2 koji instances")
+parser.add_argument("arch", help="secondary arch")
+parser.add_argument("tag", help="tag to compare")
+parser.add_argument("inherit", nargs="?", default=False,
+                    help="include inherited builds when given")
+parser.add_argument("--json", metavar="FILE",
+                    help="write the structured diff as JSON to FILE, for "
+                    "sync-tagged-primary.py --diff or as the argument of "
+                    "build-current.py")
+args = parser.parse_args()
+
+SECONDARY_ARCH = args.arch
+tag = args.tag
+inherit = bool(args.inherit)
 
 
 LOCALKOJIHUB = 'http://%s.koji.fedoraproject.org/kojihub' % (SECONDARY_ARCH)
@@ -38,51 +45,104 @@ SERVERCA = os.path.expanduser('~/.fedora-server-ca.cert')
 CLIENTCA = os.path.expanduser('~/.fedora-upload-ca.cert')
 CLIENTCERT = os.path.expanduser('~/.fedora.cert')
 
-def _rpmvercmp ((e1, v1, r1), (e2, v2, r2)):
-    """find out which build is newer"""
-    if e1 == "None":
-        e1 = "0"
-    if e2 == "None":
-        e2 = "0"
-    rc = rpm.labelCompare((e1, v1, r1), (e2, v2, r2))
-    if rc == 1:
-        #first evr wins
-        return 1
-    elif rc == 0:
-        #same evr
-        return 0
-    else:
-        #second evr wins
-        return -1
-
-def _countMissing (build):
+# more missing builds than this are reported as "more than MAX_MISSING"
+MAX_MISSING = 5
+
+EVRKey = functools.cmp_to_key(rpm.labelCompare)
+
+def _evrKey (build):
+    """sort key of the (epoch, version, release) of a build"""
+    epoch = build['epoch']
+    if epoch is None:
+        epoch = 0
+    return EVRKey((str(epoch), build['version'], build['release']))
+
+def getTagged (kojisession, tag, history=False):
+    """get the latest builds in tag sorted by package name, and with history
+    a dict of package name to all its builds in tag, newest first. Each
+    build gets its EVR sort key as 'evr_key'."""
+    kojisession.multicall = True
+    kojisession.listTagged(tag, inherit=inherit, latest=True)
+    if history:
+        kojisession.listTagged(tag, inherit=inherit)
+    results = kojisession.multiCall(strict=True)
+
+    latest = sorted(results[0][0], key = lambda pkg: pkg['package_name'])
+    for build in latest:
+        build['evr_key'] = _evrKey(build)
+    if not history:
+        return latest, None
+    builds = {}
+    for build in results[1][0]:
+        build['evr_key'] = _evrKey(build)
+        builds.setdefault(build['package_name'], []).append(build)
+    return latest, builds
+
+def _countMissing (build, history):
     """find how many builds are missing in local koji"""
-    builds = remotekojisession.listTagged(tag, inherit=inherit, package=build['package_name'])
     cnt = 0
-    local_evr = (str(build['epoch']), build['version'], build['release'])
-
-#    print "local=%s" % build
-
-    for b in builds:
-#	print "remote[%d]=%s" % (cnt, b)
-	remote_evr = (str(b['epoch']), b['version'], b['release'])
-	newestRPM = _rpmvercmp(local_evr, remote_evr)
-	if newestRPM == 0 or newestRPM == 1:
-	    break
-	cnt += 1
-	if cnt > 5:
-	    break
-
+    for b in history.get(build['package_name'], []):
+        if not build['evr_key'] < b['evr_key']:
+            break
+        cnt += 1
+        if cnt > MAX_MISSING:
+            break
     return cnt
 
+def _buildInfo (build):
+    if build is None:
+        return None
+    return dict((key, build[key]) for key in
+                ('nvr', 'name', 'package_name', 'epoch', 'version',
+                 'release'))
+
+def compareTag (local_pkgs, remote_pkgs, remote_history):
+    """merge the sorted lists of latest builds, returns a list of dicts with
+    package, status (same, newer, older, local_only or remote_only, relative
+    to the local build), local and remote build and the number of missing
+    local builds"""
+    diff = []
+    local = 0
+    remote = 0
+    local_num = len(local_pkgs)
+    remote_num = len(remote_pkgs)
+
+    while (local < local_num) or (remote < remote_num):
+        localbuild = remotebuild = None
+        missing = 0
+        if remote >= remote_num or (local < local_num and
+                local_pkgs[local]['package_name'] < remote_pkgs[remote]['package_name']):
+            localbuild = local_pkgs[local]
+            status = 'local_only'
+            local += 1
+        elif local >= local_num or \
+                remote_pkgs[remote]['package_name'] < local_pkgs[local]['package_name']:
+            remotebuild = remote_pkgs[remote]
+            status = 'remote_only'
+            remote += 1
+        else:
+            localbuild = local_pkgs[local]
+            remotebuild = remote_pkgs[remote]
+            if localbuild['evr_key'] == remotebuild['evr_key']:
+                status = 'same'
+            elif remotebuild['evr_key'] < localbuild['evr_key']:
+                status = 'newer'
+            else:
+                status = 'older'
+                missing = _countMissing(localbuild, remote_history)
+            local += 1
+            remote += 1
+        build = localbuild or remotebuild
+        diff.append({'package': build['package_name'], 'status': status,
+                     'local': _buildInfo(localbuild),
+                     'remote': _buildInfo(remotebuild),
+                     'missing': missing})
+    return diff
+
 localkojisession = koji.ClientSession(LOCALKOJIHUB)
 
 remotekojisession = koji.ClientSession(REMOTEKOJIHUB)
 
-# package indexes
-local = 0
-remote = 0
-
 cnt = {}
 cnt['same'] = 0
 cnt['newer'] = 0
@@ -91,56 +151,34 @@ cnt['local_only'] = 0
 cnt['remote_only'] = 0
 cnt['total_missing_builds'] = 0
 
-local_pkgs = sorted(localkojisession.listTagged(tag, inherit=inherit, latest=True), key = lambda pkg: pkg['package_name'])
-remote_pkgs = sorted(remotekojisession.listTagged(tag, inherit=inherit, latest=True), key = lambda pkg: pkg['package_name'])
-
-local_num = len(local_pkgs)
-remote_num = len(remote_pkgs)
-
-#print "pkgs local=%d remote=%d" % (local_num, remote_num)
-
-#print "local[0]=%s" % (local_pkgs[0])
-#exit(0)
-
-while (local < local_num) or (remote < remote_num):
-#    print "local=%d remote=%d" % (local, remote)
-
-    if remote_pkgs[remote]['package_name'] == local_pkgs[local]['package_name']:
-        local_evr = (str(local_pkgs[local]['epoch']), local_pkgs[local]['version'], local_pkgs[local]['release'])
-        remote_evr = (str(remote_pkgs[remote]['epoch']), remote_pkgs[remote]['version'], remote_pkgs[remote]['release'])
-
-	newestRPM = _rpmvercmp(local_evr, remote_evr)
-	if newestRPM == 0:
-	    print "same: local and remote: %s " % local_pkgs[local]['nvr']
-	    cnt['same'] += 1
-        if newestRPM == 1:
-            print "newer locally: local: %s remote: %s" % (local_pkgs[local]['nvr'], remote_pkgs[remote]['nvr'])
-	    cnt['newer'] += 1
-        if newestRPM == -1:
-	    missing = _countMissing(local_pkgs[local])
-	    if missing > 5:
-		txt = "more than 5"
-	    else:
-		txt = "%d" % missing
-
-            print "newer remote: local: %s remote: %s with %s build(s) missing" % (local_pkgs[local]['nvr'], remote_pkgs[remote]['nvr'], txt)
-	    cnt['total_missing_builds'] += missing
-	    cnt['older'] += 1
-
-	local += 1
-	remote += 1
-
-    elif remote_pkgs[remote]['package_name'] > local_pkgs[local]['package_name']:
-    	print "only locally: %s" % local_pkgs[local]['nvr']
-	local += 1
-	cnt['local_only'] += 1
-
-    elif remote_pkgs[remote]['package_name'] < local_pkgs[local]['package_name']:
-    	print "only remote: %s" % remote_pkgs[remote]['nvr']
-	remote += 1
-	cnt['remote_only'] += 1
-
-#    if cnt['older'] == 5:
-#	break
+local_pkgs, _ = getTagged(localkojisession, tag)
+remote_pkgs, remote_history = getTagged(remotekojisession, tag, history=True)
+
+diff = compareTag(local_pkgs, remote_pkgs, remote_history)
+
+for entry in diff:
+    status = entry['status']
+    cnt[status] += 1
+    if status == 'same':
+        print "same: local and remote: %s " % entry['local']['nvr']
+    elif status == 'newer':
+        print "newer locally: local: %s remote: %s" % (entry['local']['nvr'], entry['remote']['nvr'])
+    elif status == 'older':
+        missing = entry['missing']
+        if missing > MAX_MISSING:
+            txt = "more than %d" % MAX_MISSING
+        else:
+            txt = "%d" % missing
+        print "newer remote: local: %s remote: %s with %s build(s) missing" % (entry['local']['nvr'], entry['remote']['nvr'], txt)
+        cnt['total_missing_builds'] += missing
+    elif status == 'local_only':
+        print "only locally: %s" % entry['local']['nvr']
+    else:
+        print "only remote: %s" % entry['remote']['nvr']
 
 print "statistics: %s" % cnt
+
+if args.json:
+    with open(args.json, 'w') as jsonfile:
+        json.dump({'arch': SECONDARY_ARCH, 'tag': tag, 'inherit': inherit,
+                   'statistics': cnt, 'packages': diff}, jsonfile, indent=2)
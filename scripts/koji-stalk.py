@@ -11,6 +11,7 @@
 import fedmsg
 import threading 
 from collections import deque
+import json
 import time
 import koji
 import subprocess
@@ -20,6 +21,8 @@ import os
 import ConfigParser
 from optparse import OptionParser
 
+import kojiutils
+
 parser = OptionParser() 
 parser.add_option("-c", "--config-file", dest="shadowconfig",
                   default="/etc/koji-shadow/koji-shadow.conf",
@@ -33,6 +36,9 @@ parser.add_option("-t", "--test", dest="testonly", action="store_true",
                   help="Only monitor fedmsg without building", default=False)
 parser.add_option("--threads", type="int", default="3", 
                   help="number of threads per distro")
+parser.add_option("--state-file", dest="statefile", default=None,
+                  help="file to keep queued NVRs in across restarts "
+                  "(default: LOGDIR/KojiStalk-queues.json)")
 
 (options, args) = parser.parse_args()
 
@@ -64,6 +70,9 @@ shadowcommand = options.shadowcommand
 shadowconfig = options.shadowconfig
 logdir = options.logdir
 
+# maximum number of calls per koji multicall
+multicall_size = 100
+
 
 ### End configuration ### 
 
@@ -98,12 +107,134 @@ ks_config.read(shadowconfig)
 local = koji.ClientSession(ks_config.get("main", "server"))
 local.ssl_login(auth_cert, auth_ca, serverca)
 
+class QueueState(object):
+    """ Store the contents of all queues in a JSON file, so pending shadow
+        builds survive a restart. Changes only mark the state dirty, a
+        flusher thread writes it at most every interval seconds. """
+    def __init__(self, filename, interval=5):
+        self.filename = filename
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.dirty = threading.Event()
+        self.queues = {}
+
+    def changed(self):
+        self.dirty.set()
+
+    def flusher(self):
+        while True:
+            self.dirty.wait()
+            time.sleep(self.interval)
+            try:
+                self.save()
+            except (IOError, OSError):
+                logger.exception('Cannot save the queues to %s',
+                                 self.filename)
+                self.dirty.set()
+
+    def start(self):
+        thread = threading.Thread(target=self.flusher)
+        thread.daemon = True
+        thread.start()
+
+    def load(self):
+        try:
+            with open(self.filename) as statefile:
+                return json.load(statefile)
+        except (IOError, ValueError):
+            return {}
+
+    def save(self):
+        with self.lock:
+            # changes from now on are not part of this save
+            self.dirty.clear()
+            data = dict((name, queue.snapshot())
+                        for name, queue in self.queues.items())
+            with open(self.filename + '.tmp', 'w') as statefile:
+                json.dump(data, statefile)
+            os.rename(self.filename + '.tmp', self.filename)
+
+class NVRQueue(object):
+    """ FIFO of NVRs with blocking gets. NVRs that are already queued or
+        being processed are not queued again. """
+    def __init__(self, name, state):
+        self.name = name
+        self.state = state
+        self.items = deque()
+        self.queued = set() # NVRs in items, for quick lookups
+        self.inflight = set()
+        self.condition = threading.Condition()
+        state.queues[name] = self
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return repr(list(self.items))
+
+    def snapshot(self):
+        # NVRs in flight did not finish yet, so they go first after a restart
+        with self.condition:
+            return list(self.inflight) + list(self.items)
+
+    def put(self, nvr):
+        with self.condition:
+            if nvr in self.inflight or nvr in self.queued:
+                logger.debug('%s already queued for %s', nvr, self.name)
+                return False
+            self.items.append(nvr)
+            self.queued.add(nvr)
+            self.condition.notify()
+        self.state.changed()
+        return True
+
+    def get(self):
+        """ Wait for a NVR and mark it in flight """
+        with self.condition:
+            while not self.items:
+                self.condition.wait()
+            nvr = self.items.popleft()
+            self.queued.discard(nvr)
+            self.inflight.add(nvr)
+            return nvr
+
+    def get_all(self, timeout=None):
+        """ Wait up to timeout seconds for NVRs, mark all queued NVRs in
+            flight and return them """
+        with self.condition:
+            if not self.items:
+                self.condition.wait(timeout)
+            nvrs = list(self.items)
+            self.items.clear()
+            self.queued.clear()
+            self.inflight.update(nvrs)
+            return nvrs
+
+    def done(self, nvr):
+        with self.condition:
+            self.inflight.discard(nvr)
+        self.state.changed()
+
+    def requeue(self, nvrs):
+        """ Put NVRs that are in flight back in front of the queue, so they
+            are retried with the next get """
+        with self.condition:
+            self.inflight.difference_update(nvrs)
+            for nvr in reversed(nvrs):
+                if nvr not in self.queued:
+                    self.items.appendleft(nvr)
+                    self.queued.add(nvr)
+            self.condition.notify()
+        self.state.changed()
+
 # set up the queues
-buildqueue = deque()
+state = QueueState(options.statefile or
+                   os.path.join(logdir, 'KojiStalk-queues.json'))
+buildqueue = NVRQueue('unsorted', state)
 
 distqueues = {}
 for distro in distronames:
-    distqueues[distro] = deque() 
+    distqueues[distro] = NVRQueue(distro, state)
 
 class KojiStalk(threading.Thread):
     """ Use fedmsg to monitor what koji.fp.o is building""" 
@@ -128,7 +259,7 @@ class KojiStalk(threading.Thread):
                 'org.fedoraproject.prod.buildsys.build.state.change' and 
                 msg['msg']['new'] == 1 and 
                 msg['msg']['name'] not in ignorelist):
-                buildqueue.append(msg['msg']['name']+'-'+msg['msg']['version']+'-'+msg['msg']['release'])
+                buildqueue.put(msg['msg']['name']+'-'+msg['msg']['version']+'-'+msg['msg']['release'])
 
 class BuildFromDistroQueues(threading.Thread):
     def __init__(self, distro):
@@ -138,28 +269,45 @@ class BuildFromDistroQueues(threading.Thread):
 
     def run(self):
         while True:
-            # excessive debugging:
-            #logger.debug('Checking queue for %s', self.distro)
-            if distqueues[self.distro]:  
-                build_nvr(distqueues[self.distro].popleft(), self.distro)
+            nvr = distqueues[self.distro].get()
+            try:
+                build_nvr(nvr, self.distro)
+            except Exception:
+                logger.exception('Error building %s', nvr)
+            finally:
+                distqueues[self.distro].done(nvr)
+
+def sort_nvrs(nvrs):
+    """ Query koji.fp.o for the targets used for the builds, then dump the
+        NVRs into the appropriate distro-specific queues """
+    logger.debug('Analyzing %s', ', '.join(nvrs))
+    builds = kojiutils.multicall(remote, 'getBuild',
+                                 [((nvr,), {}) for nvr in nvrs],
+                                 size=multicall_size)
+    found = []
+    for nvr, result in zip(nvrs, builds):
+        if isinstance(result, dict) or not result[0]:
+            logger.warn('Cannot get build info for %s: %s', nvr, result)
+        else:
+            found.append((nvr, result[0]['task_id']))
+    requests = kojiutils.multicall(remote, 'getTaskRequest',
+                                   [((task_id,), {}) for nvr, task_id in found],
+                                   size=multicall_size)
+    for (nvr, task_id), result in zip(found, requests):
+        if isinstance(result, dict):
+            logger.warn('Cannot get task request for %s: %s', nvr, result)
+            continue
+        buildtarget = result[0][1]
+        for distro in distronames:
+            if re.search(distro, buildtarget):
+                distqueues[distro].put(nvr)
+                #logger.debug('Placing %s in %s', nvr, distro)
+                break
+        else:
+            if re.search('rawhide', buildtarget):
+                distqueues[rawhide].put(nvr)
             else:
-                time.sleep(60)
-
-def sort_nvr(nvr):
-    """ Query koji.fp.o for the target used for a build, then dump the NVR 
-        into the appropriate distro-specific queue """
-    logger.debug('Analyzing %s', nvr)
-    data = remote.getBuild(nvr)
-    buildtarget = remote.getTaskRequest(data['task_id'])[1]
-    for distro in distronames:
-        if re.search(distro, buildtarget):
-            distqueues[distro].append(nvr)
-            #logger.debug('Placing %s in %s', nvr, distro)
-            return
-    if re.search('rawhide', buildtarget):
-        distqueues[rawhide].append(nvr)
-    else:
-        logger.info('Ignored %s from %s', nvr, buildtarget)
+                logger.info('Ignored %s from %s', nvr, buildtarget)
 
 def build_nvr(nvr, distro):
     """ Use koji-shadow to build a given NVR """
@@ -194,6 +342,15 @@ def build_nvr(nvr, distro):
 
 def main():
 
+    # Requeue NVRs that were pending when we stopped
+    queues = state.load()
+    for nvr in queues.get(buildqueue.name, []):
+        buildqueue.put(nvr)
+    for distro in distronames:
+        for nvr in queues.get(distro, []):
+            distqueues[distro].put(nvr)
+    state.start()
+
     # Start the thread that listens to fedmsg
     ks = KojiStalk(buildqueue) 
     ks.daemon = True
@@ -208,18 +365,30 @@ def main():
             buildthread.start()
  
     logger.debug('Monitoring NVRs queue')
+    retry_delay = 0
     while True:
-        # Sort NVRs we get from fedmsg into dist-specific queues, or wait
-        # for more NVRs to show up if the queue is empty.
-        if buildqueue: 
-            nvr = buildqueue.popleft()
-            sort_nvr(nvr)
+        # Sort all NVRs we got from fedmsg since the last round into
+        # dist-specific queues, or wait for more NVRs to show up
+        nvrs = buildqueue.get_all(timeout=600)
+        if nvrs:
+            try:
+                sort_nvrs(nvrs)
+            except Exception:
+                # Most likely koji.fp.o is not reachable, so keep the NVRs
+                # and retry them later, waiting longer after each failure
+                retry_delay = min(max(retry_delay * 2, 30), 600)
+                logger.exception('Error sorting %s, retrying in %s seconds',
+                                 ', '.join(nvrs), retry_delay)
+                buildqueue.requeue(nvrs)
+                time.sleep(retry_delay)
+                continue
+            retry_delay = 0
+            for nvr in nvrs:
+                buildqueue.done(nvr)
         else:
-            # Every 10 minutes, print the queues
-            if int(time.strftime('%M')) % 10 == 0:
-                for distro in distronames:
-                    if distqueues[distro]:
-                        logger.debug('%s queue: %s', distro, distqueues[distro])
-            time.sleep(60)
+            # Print the queues when nothing happened for 10 minutes
+            for distro in distronames:
+                if distqueues[distro]:
+                    logger.debug('%s queue: %s', distro, distqueues[distro])
 
 main()
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+#
+# kojiutils.py - Helpers for koji multicalls, per thread koji sessions and
+#                pickle caches shared by the release engineering scripts
+#
+# Copyright (C) 2015 Red Hat Inc.
+# SPDX-License-Identifier:	GPL-2.0+
+#
+
+import os
+import threading
+import cPickle as pickle
+
+import koji
+
+MULTICALL_SIZE = 100 # default maximum number of calls per koji multicall
+
+_local = threading.local()
+
+
+def multicall_methods(kojisession, calls, size=MULTICALL_SIZE, strict=False):
+    """Run (method, args, kwargs) calls in multicalls of at most size calls.
+    Returns the list of all results, in order. Unless strict is set, the
+    result of a failed call is a dict with the fault."""
+    results = []
+    for i in range(0, len(calls), size):
+        kojisession.multicall = True
+        for method, args, kwargs in calls[i:i + size]:
+            getattr(kojisession, method)(*args, **kwargs)
+        results.extend(kojisession.multiCall(strict=strict))
+    return results
+
+
+def multicall(kojisession, method, calls, size=MULTICALL_SIZE, strict=False):
+    """Call method for each (args, kwargs) in calls in multicalls of at most
+    size calls, see multicall_methods()"""
+    return multicall_methods(kojisession,
+                             [(method, args, kwargs)
+                              for args, kwargs in calls],
+                             size=size, strict=strict)
+
+
+def thread_session(kojihub, login=None):
+    """Return the koji session of the calling thread for kojihub. koji
+    sessions are not thread safe, so every thread gets its own; login is
+    called with each new session, e.g. to ssl_login."""
+    if not hasattr(_local, 'sessions'):
+        _local.sessions = {}
+    if kojihub not in _local.sessions:
+        kojisession = koji.ClientSession(kojihub)
+        if login is not None:
+            login(kojisession)
+        _local.sessions[kojihub] = kojisession
+    return _local.sessions[kojihub]
+
+
+def load_pickle(filename, default=None):
+    """Return the object pickled in filename, or default if there is no
+    readable pickle"""
+    try:
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return default
+
+
+def save_pickle(filename, obj):
+    """Pickle obj to filename. The pickle is written to a temporary file
+    first and renamed, so an interrupted run never leaves a partial file."""
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # another thread may have created it meanwhile
+            if not os.path.isdir(dirname):
+                raise
+    with open(filename + '.tmp', 'wb') as f:
+        pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(filename + '.tmp', filename)
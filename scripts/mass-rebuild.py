@@ -9,11 +9,19 @@
 #     Jesse Keating <jkeating@redhat.com>
 #
 
+import argparse
 import koji
 import os
+import shutil
+import sqlite3
 import subprocess
 import sys
 import operator
+import threading
+import time
+from Queue import Queue
+
+import kojiutils
 
 # Set some variables
 # Some of these could arguably be passed in as args.
@@ -27,6 +35,11 @@ enviro = os.environ
 target = 'f23-boost'
 
 pkg_skip_list = ['shim', 'shim-signed', 'kernel', 'grub2']
+journalfile = os.path.join(workdir, 'mass-rebuild.sqlite')
+multicall_size = 1000
+
+# stages a package goes through, in order
+STAGES = ['cloned', 'bumped', 'committed', 'built']
 
 # Define functions
 
@@ -63,80 +76,206 @@ def runmeoutput(cmd, action, pkg, env, cwd=workdir):
     return result
 
 
-# Create a koji session
-kojisession = koji.ClientSession('http://koji.fedoraproject.org/kojihub')
+class Journal(object):
+    """Record the last completed stage of each package in a SQLite database,
+       so an interrupted mass rebuild can be resumed."""
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS packages '
+                        '(name TEXT PRIMARY KEY, stage TEXT, updated REAL)')
+        self.db.commit()
+
+    def stage(self, name):
+        with self.lock:
+            row = self.db.execute('SELECT stage FROM packages WHERE name = ?',
+                                  (name,)).fetchone()
+        if row:
+            return row[0]
+        return None
+
+    def record(self, name, stage):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO packages '
+                            '(name, stage, updated) VALUES (?, ?, ?)',
+                            (name, stage, time.time()))
+            self.db.commit()
 
-# Generate a list of packages to iterate over
-pkgs = ['0ad', 'CGAL', 'Coin3', 'Field3D', 'FlightCrew', 'FlightGear', 'FlightGear-Atlas', 'IQmol', 'LuxRender', 'Macaulay2', 'MyPasswordSafe', 'OpenImageIO', 'QuantLib', 'Shinobi', 'SimGear', 'SkyX', 'abiword', 'adobe-source-libraries', 'airinv', 'airrac', 'airtsp', 'akonadi', 'anyterm', 'apt-cacher-ng', 'aqsis', 'ardour', 'ardour2', 'ardour3', 'ardour4', 'asc', 'asio', 'assimp', 'autowrap', 'avogadro', 'barry', 'bastet', 'bibletime', 'blender', 'bookkeeper', 'boost-gdb-printers', 'calligra', 'cclive', 'cegui', 'ceph', 'clementine', 'clucene', 'codeblocks', 'collada-dom', 'compat-qpid-cpp', 'console-bridge', 'csdiff', 'csound', 'curlpp', 'cvc4', 'cyphesis', 'dans-gdal-scripts', 'davix', 'device-mapper-persistent-data', 'diet', 'dmlite', 'dmlite-plugins-s3', 'dolphin-connector', 'dyninst', 'easystroke', 'edb', 'ekiga', 'enblend', 'erlang-basho_metrics', 'exempi', 'fawkes', 'fgrun', 'fife', 'fityk', 'flowcanvas', 'freecad', 'fritzing', 'fts', 'fuse-encfs', 'galera', 'gappa', 'gazebo', 'gearmand', 'gecode', 'gfal2-plugin-xrootd', 'gfal2-python', 'glob2', 'glogg', 'glom', 'gnash', 'gnote', 'gnuradio', 'gource', 'gpick', 'gpsdrive', 'gqrx', 'gr-air-modes', 'gr-osmosdr', 'grfcodec', 'gromacs', 'guitarix', 'hamlib', 'highlight', 'hokuyoaist', 'hugin', 'inkscape', 'iwhd', 'k3d', 'kcm_systemd', 'kdenetwork-strigi-analyzers', 'kdepim', 'kdepimlibs', 'kdevelop', 'kdevplatform', 'kea', 'kf5-kactivities', 'kgraphviewer', 'kicad', 'kig', 'kmymoney', 'kpilot', 'kradio4', 'ktorrent', 'ladish', 'launchy', 'libabw', 'libcdr', 'libclaw', 'libcmis', 'libcutl', 'libe-book', 'libepubgen', 'libetonyek', 'libflatarray', 'libftdi', 'libgltf', 'libint2', 'libixion', 'libkindrv', 'libkni3', 'libkolabxml', 'libktorrent', 'liblas', 'libmspub', 'libmwaw', 'libodb-boost', 'libodfgen', 'libopenraw', 'libopkele', 'liborcus', 'liborigin2', 'libpagemaker', 'libpst', 'librecad', 'libreoffice', 'librevenge', 'librime', 'librvngabw', 'libvisio', 'libwps', 'libyui', 'libyui-bindings', 'libyui-gtk', 'libyui-ncurses', 'libyui-qt', 'licq', 'logstalgia', 'lrslib', 'luabind', 'lucene++', 'luminance-hdr', 'lv2-c++-tools', 'lv2-sorcer', 'lyx', 'mapnik', 'mariadb', 'mbox2eml', 'mdds', 'meson', 'mesos', 'milia', 'minion', 'mkvtoolnix', 'mlpack', 'mmseq', 'mongo-cxx-driver', 'mongodb', 'monotone', 'mrpt', 'ncbi-blast+', 'ncmpcpp', 'nemiver', 'nodejs-mapnik', 'nodejs-mapnik-vector-tile', 'normaliz', 'nss-gui', 'ogre', 'ompl', 'openms', 'openoffice.org-diafilter', 'openscad', 'orthanc', 'osm2pgsql', 'oyranos', 'paraview', 'pcl', 'pdfedit', 'pdns', 'pdns-recursor', 'percolator', 'permlib', 'pgRouting', 'pingus', 'plasma-desktop', 'plasma-workspace', 'player', 'plee-the-bear', 'poedit', 'pokerth', 'polybori', 'polymake', 'povray', 'psi4', 'ptlib', 'pulseview', 'pyexiv2', 'python-lmiwbem', 'python-tag', 'python-ufc', 'python-visual', 'qbittorrent', 'qpid-cpp', 'qpid-qmf', 'qt-gstreamer', 'rb_libtorrent', 'rcsslogplayer', 'rcssmonitor', 'rcssserver', 'rcssserver3d', 'resiprocate', 'rmol', 'rocs', 'rospack', 'scantailor', 'schroot', 'scidavis', 'scribus', 'scummvm-tools', 'sdcc', 'sdformat', 'seqan', 'sevmgr', 'shiny', 'sigil', 'sim', 'simcrs', 'simfqt', 'simspark', 'sinfo', 'slic3r', 'smesh', 'snapper', 'soci', 'sord', 'source-highlight', 'source-highlight-qt', 'spring', 'springlobby', 'srecord', 'stdair', 'stellarium', 'stp', 'supertux', 'swift', 'swig', 'swig2', 'sympol', 'syncevolution', 'synfig', 'tcpflow', 'thrift', 'tintii', 'tncfhh', 'tomahawk', 'trademgen', 'trafficserver', 'travelccm', 'uhd', 'umbrello', 'undertaker', 'urbanlightscape', 'urdfdom', 'urg', 'uwsgi', 'valyriatear', 'vdrift', 'vegastrike', 'vfrnav', 'vigra', 'vios-proxy', 'votca-tools', 'vsqlite++', 'vtk', 'websocketpp', 'wesnoth', 'widelands', 'writerperfect', 'wt', 'xboxdrv', 'xmlcopyeditor', 'xmms2', 'xsd', 'xylib', 'yadex', 'yaml-cpp', 'yoshimi', 'zookeeper', 'zorba']
 
+def packages_to_rebuild(kojisession):
+    """Return the names of the unblocked packages in buildtag that were not
+       built for one of the targets since epoch."""
+    pkgs = kojisession.listPackages(buildtag, inherited=True)
+    # reduce the list to those that are not blocked and sort by package name
+    pkgs = sorted([pkg for pkg in pkgs if not pkg['blocked']],
+                  key=operator.itemgetter('package_name'))
+    print 'Checking %s packages for builds since %s...' % (len(pkgs), epoch)
 
-# reduce the list to those that are not blocked and sort by package name
+    results = kojiutils.multicall(kojisession, 'listBuilds',
+                                  [((pkg['package_id'],),
+                                    {'state': 1, 'createdAfter': epoch})
+                                   for pkg in pkgs], size=multicall_size)
+    newbuilds = {}
+    task_ids = set()
+    for pkg, result in zip(pkgs, results):
+        if isinstance(result, dict):
+            sys.stderr.write('%s failed listBuilds: %s\n' % (
+                pkg['package_name'], result['faultString']))
+            result = [[]]
+        newbuilds[pkg['package_name']] = result[0]
+        task_ids.update([build['task_id'] for build in result[0]
+                         if build['task_id']])
+    task_ids = sorted(task_ids)
 
-print 'Checking %s packages...' % len(pkgs)
+    requests = kojiutils.multicall(kojisession, 'getTaskInfo',
+                                   [((task_id,), {'request': True})
+                                    for task_id in task_ids],
+                                   size=multicall_size)
+    task_targets = {}
+    for task_id, request in zip(task_ids, requests):
+        if isinstance(request, dict):
+            continue
+        try:
+            task_targets[task_id] = request[0]['request'][1]
+        except (IndexError, KeyError, TypeError):
+            pass
 
-# Loop over each package
-for pkg in pkgs:
-    name = pkg
+    rebuild = []
+    for pkg in pkgs:
+        for build in newbuilds[pkg['package_name']]:
+            if task_targets.get(build['task_id']) in targets:
+                break
+        else:
+            rebuild.append(pkg['package_name'])
+    return rebuild
 
-    # some package we just dont want to ever rebuild
-    if name in pkg_skip_list:
-        print 'Skipping %s, package is explicitely skipped'
-        continue
 
+def rebuild(name, journal):
+    """Run the remaining rebuild stages for package name, recording each
+       completed stage in the journal."""
+    stage = journal.stage(name)
+    done = STAGES.index(stage) + 1 if stage in STAGES else 0
+    checkout = os.path.join(workdir, name)
 
-    # Check out git
-    fedpkgcmd = ['fedpkg', 'clone', name]
-    print 'Checking out %s' % name
-    if runme(fedpkgcmd, 'fedpkg', name, enviro):
-        continue
+    if done < 1:
+        # Remove leftovers of an interrupted checkout
+        if os.path.exists(checkout):
+            shutil.rmtree(checkout)
 
-    # Check for a checkout
-    if not os.path.exists(os.path.join(workdir, name)):
-        sys.stderr.write('%s failed checkout.\n' % name)
-        continue
+        # Check out git
+        fedpkgcmd = ['fedpkg', 'clone', name]
+        print 'Checking out %s' % name
+        if runme(fedpkgcmd, 'fedpkg', name, enviro):
+            return
+
+        # Check for a checkout
+        if not os.path.exists(checkout):
+            sys.stderr.write('%s failed checkout.\n' % name)
+            return
+        journal.record(name, 'cloned')
 
     # Check for a noautobuild file
-    if os.path.exists(os.path.join(workdir, name, 'noautobuild')):
+    if os.path.exists(os.path.join(checkout, 'noautobuild')):
         # Maintainer does not want us to auto build.
         print 'Skipping %s due to opt-out' % name
-        continue
-
-    # Find the spec file
-    files = os.listdir(os.path.join(workdir, name))
-    spec = ''
-    for file in files:
-        if file.endswith('.spec'):
-            spec = os.path.join(workdir, name, file)
-            break
+        journal.record(name, 'skipped')
+        return
+
+    if done < 2:
+        # Find the spec file
+        files = os.listdir(checkout)
+        spec = ''
+        for file in files:
+            if file.endswith('.spec'):
+                spec = os.path.join(checkout, file)
+                break
 
-    if not spec:
-        sys.stderr.write('%s failed spec check\n' % name)
-        continue
+        if not spec:
+            sys.stderr.write('%s failed spec check\n' % name)
+            return
 
-    # rpmdev-bumpspec
-    bumpspec = ['rpmdev-bumpspec', '-u', user, '-c', comment,
-                os.path.join(workdir, name, spec)]
-    print 'Bumping %s' % spec
-    if runme(bumpspec, 'bumpspec', name, enviro):
-        continue
+        # rpmdev-bumpspec
+        bumpspec = ['rpmdev-bumpspec', '-u', user, '-c', comment, spec]
+        print 'Bumping %s' % spec
+        if runme(bumpspec, 'bumpspec', name, enviro):
+            return
+        journal.record(name, 'bumped')
 
-    # git commit
-    commit = ['fedpkg', 'commit', '-p', '-m', comment]
-    print 'Committing changes for %s' % name
-    if runme(commit, 'commit', name, enviro,
-                 cwd=os.path.join(workdir, name)):
-        continue
+    if done < 3:
+        # git commit
+        commit = ['fedpkg', 'commit', '-p', '-m', comment]
+        print 'Committing changes for %s' % name
+        if runme(commit, 'commit', name, enviro, cwd=checkout):
+            return
+        journal.record(name, 'committed')
 
     # get git url
     urlcmd = ['fedpkg', 'giturl']
     print 'Getting git url for %s' % name
-    url = runmeoutput(urlcmd, 'giturl', name, enviro,
-                 cwd=os.path.join(workdir, name))
+    url = runmeoutput(urlcmd, 'giturl', name, enviro, cwd=checkout)
     if not url:
-        continue
+        return
 
     # build
     build = ['fedpkg', 'build', '--nowait', '--background', '--target', target]
     print 'Building %s' % name
-    runme(build, 'build', name, enviro, 
-          cwd=os.path.join(workdir, name))
+    if not runme(build, 'build', name, enviro, cwd=checkout):
+        journal.record(name, 'built')
+
+
+def worker(queue, journal):
+    while True:
+        name = queue.get()
+        if name is None:
+            break
+        try:
+            rebuild(name, journal)
+        except Exception, e:
+            sys.stderr.write('%s failed: %s\n' % (name, e))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='Number of packages to process in parallel')
+    parser.add_argument('--journal', default=journalfile,
+                        help='SQLite file recording the progress')
+    parser.add_argument('pkgs', nargs='*',
+                        help='Packages to rebuild instead of all packages '
+                        'in %s not built since %s' % (buildtag, epoch))
+    args = parser.parse_args()
+
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    journal = Journal(args.journal)
+
+    # Create a koji session
+    kojisession = koji.ClientSession('http://koji.fedoraproject.org/kojihub')
+
+    # Generate a list of packages to iterate over
+    if args.pkgs:
+        pkgs = sorted(args.pkgs)
+    else:
+        pkgs = packages_to_rebuild(kojisession)
+
+    print 'Checking %s packages...' % len(pkgs)
+
+    queue = Queue()
+    for name in pkgs:
+        # some package we just dont want to ever rebuild
+        if name in pkg_skip_list:
+            print 'Skipping %s, package is explicitely skipped' % name
+            continue
+        if journal.stage(name) in ('built', 'skipped'):
+            continue
+        queue.put(name)
+
+    threads = []
+    for i in range(args.jobs):
+        queue.put(None)
+        thread = threading.Thread(target=worker, args=(queue, journal))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
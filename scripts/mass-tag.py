@@ -12,6 +12,10 @@
 import koji
 import os
 import operator
+import sys
+from multiprocessing.pool import ThreadPool
+
+import kojiutils
 
 # Set some variables
 # Some of these could arguably be passed in as args.
@@ -19,98 +23,190 @@ target = 'f24' # tag to tag into
 holdingtag = 'f24-icu' # tag holding the rebuilds
 newbuilds = {} # dict of packages that have a newer build attempt
 tasks = {} # dict of new build task info
-
-# Create a koji session
-kojisession = koji.ClientSession('https://koji.fedoraproject.org/kojihub')
+multicall_size = 500 # calls per koji multicall
+workers = 4 # multicalls running at the same time
+# NVRs tagged into target so far, a rerun skips them
+journalfile = os.path.expanduser('~/.cache/mass-tag-%s-%s.journal' % (
+    holdingtag, target))
 
 # Log into koji
 clientcert = os.path.expanduser('~/.fedora.cert')
 clientca = os.path.expanduser('~/.fedora-upload-ca.cert')
 serverca = os.path.expanduser('~/.fedora-server-ca.cert')
-kojisession.ssl_login(clientcert, clientca, serverca)
+
+
+def get_session():
+    """Return the logged in koji session of this thread"""
+    return kojiutils.thread_session(
+        'https://koji.fedoraproject.org/kojihub',
+        lambda kojisession: kojisession.ssl_login(clientcert, clientca,
+                                                  serverca))
+
+
+def run_chunk(job):
+    """Run one multicall of method for the (args, kwargs) in calls"""
+    method, calls = job
+    return calls, kojiutils.multicall(get_session(), method, calls,
+                                      size=multicall_size)
+
+
+def multicall(pool, method, calls):
+    """Call method for each (args, kwargs) in calls in multicalls of at most
+       multicall_size calls, run by the threads of pool. Returns the list of
+       all results, in order."""
+    chunks = [(method, calls[i:i + multicall_size])
+              for i in range(0, len(calls), multicall_size)]
+    results = []
+    for chunk_calls, chunk_results in pool.imap(run_chunk, chunks):
+        results.extend(chunk_results)
+    return results
+
+
+def load_journal():
+    try:
+        with open(journalfile) as journal:
+            return set(line.strip() for line in journal if line.strip())
+    except IOError:
+        return set()
+
+
+def save_journal(nvrs):
+    """Replace the journal with nvrs"""
+    journaldir = os.path.dirname(journalfile)
+    if not os.path.isdir(journaldir):
+        os.makedirs(journaldir)
+    with open(journalfile + '.tmp', 'w') as journal:
+        for nvr in sorted(nvrs):
+            journal.write(nvr + '\n')
+    os.rename(journalfile + '.tmp', journalfile)
+
+
+pool = ThreadPool(workers)
+kojisession = get_session()
 
 # Generate a list of builds to iterate over, sorted by package name
 builds = sorted(kojisession.listTagged(holdingtag, latest=True),
                 key=operator.itemgetter('package_name'))
 
-# Generate a list of packages in the target, reduced by not blocked.
+# Generate a set of packages in the target, reduced by not blocked.
 pkgs = kojisession.listPackages(target, inherited=True)
-pkgs = [pkg['package_name'] for pkg in pkgs if not pkg['blocked']]
+pkgs = set(pkg['package_name'] for pkg in pkgs if not pkg['blocked'])
 
 print 'Checking %s builds...' % len(builds)
 
-# Get the task creation time from our builds
-kojisession.multicall = True
-for build in builds:
-    taskid = build['task_id']
-    kojisession.getTaskInfo(taskid)
-
-results = kojisession.multiCall()
-
-for build, [result] in zip (builds, results):
-    build['task_creation_time'] = result['create_time']
-
-# Use multicall
-kojisession.multicall = True
+tagged = load_journal()
+if tagged:
+    # Only trust the journal for builds that are still tagged into target,
+    # and forget the others so the journal does not grow forever
+    current = set(build['nvr'] for build in kojisession.listTagged(target))
+    if tagged - current:
+        print 'Forgetting %s journaled builds no longer in %s' % (
+            len(tagged - current), target)
+        tagged &= current
+        save_journal(tagged)
+    print 'Skipping %s builds tagged by an earlier run' % len(tagged)
+    builds = [build for build in builds if build['nvr'] not in tagged]
 
-# Loop over each build
 for build in builds:
-    id = build['package_id']
-    builddate = build['task_creation_time']
+    if not build['package_name'] in pkgs:
+        print 'Skipping %s, blocked in %s' % (build['package_name'], target)
+builds = [build for build in builds if build['package_name'] in pkgs]
 
-    # Query to see if a build has already been attempted
-    kojisession.listBuilds(id, createdAfter=builddate)
+# Get the task creation time from our builds
+results = multicall(pool, 'getTaskInfo',
+                    [((build['task_id'],), {}) for build in builds])
+
+found = []
+for build, result in zip(builds, results):
+    if isinstance(result, dict):
+        sys.stderr.write('Skipping %s, failed to get task info: %s\n' % (
+            build['nvr'], result['faultString']))
+        continue
+    build['task_creation_time'] = result[0]['create_time']
+    found.append(build)
+builds = found
 
-# Get the results
-results = kojisession.multiCall()
+# Query to see if a build has already been attempted
+results = multicall(pool, 'listBuilds',
+                    [((build['package_id'],),
+                      {'createdAfter': build['task_creation_time']})
+                     for build in builds])
 
 # For each build, get its request info
-kojisession.multicall = True
-for build, [result] in zip(builds, results):
-    if not build['package_name'] in pkgs:
+task_ids = set()
+found = []
+for build, result in zip(builds, results):
+    if isinstance(result, dict):
+        sys.stderr.write('Skipping %s, failed to list newer builds: %s\n' % (
+            build['nvr'], result['faultString']))
         continue
-    for newbuild in result:
+    found.append(build)
+    for newbuild in result[0]:
         if newbuild['build_id'] == build['build_id']:
             continue
         newbuilds.setdefault(build['package_name'], []).append(newbuild)
-        kojisession.getTaskInfo(newbuild['task_id'],
-                                request=True)
+        task_ids.add(newbuild['task_id'])
+task_ids = sorted(task_ids)
+builds = found
 
-requests = kojisession.multiCall()
+requests = multicall(pool, 'getTaskInfo',
+                     [((task_id,), {'request': True}) for task_id in task_ids])
 
 # Populate the task info dict
-for [request] in requests:
-    tasks[request['id']] = request
+for task_id, request in zip(task_ids, requests):
+    if isinstance(request, dict):
+        sys.stderr.write('Failed to get info of task %s: %s\n' % (
+            task_id, request['faultString']))
+        continue
+    tasks[task_id] = request[0]
 
-# Loop through the results and tag if necessary
-kojisession.multicall = True
+# Loop through the results and find the builds to tag
 taglist = []
-pkgcount = 0
 for build in builds:
-    if not build['package_name'] in pkgs:
-        print 'Skipping %s, blocked in %s' % (build['package_name'], target)
-        continue
     newer = False
-    if build['package_name'] in newbuilds.keys():
+    if build['package_name'] in newbuilds:
         for newbuild in newbuilds[build['package_name']]:
+            if newbuild['state'] != 1:
+                continue
+            if newbuild['task_id'] not in tasks:
+                # better not tag than to tag over a newer build
+                print 'Skipping %s, cannot check newer build %s.' % (
+                    build['nvr'], newbuild['nvr'])
+                newer = True
+                break
             # Scrape the task info out of the tasks dict from the newbuild task ID
-            if tasks[newbuild['task_id']]['request'][1] in (target, '%s-candidate' % target, 'rawhide', 'dist-rawhide') \
-            and newbuild['state'] == 1:
+            if tasks[newbuild['task_id']]['request'][1] in (target, '%s-candidate' % target, 'rawhide', 'dist-rawhide'):
                 print 'Newer build found for %s.' % build['package_name']
                 newer = True
                 break
     if not newer:
         print 'Tagging %s into %s' % (build['nvr'], target)
         taglist.append(build['nvr'])
-        kojisession.tagBuildBypass(target, build)
-        pkgcount += 1
-    if pkgcount == 1000:
-        print 'Tagging %s builds.' % pkgcount
-        results = kojisession.multiCall()
-        pkgcount = 0
-        kojisession.multicall = True
-
-print 'Tagging %s builds.' % pkgcount
-results = kojisession.multiCall()
-print 'Tagged %s builds.' % len(taglist)
 
+# Tag in chunks, recording every build koji confirmed in the journal
+print 'Tagging %s builds.' % len(taglist)
+chunks = [('tagBuildBypass', [((target, nvr), {})
+                              for nvr in taglist[i:i + multicall_size]])
+          for i in range(0, len(taglist), multicall_size)]
+journaldir = os.path.dirname(journalfile)
+if not os.path.isdir(journaldir):
+    os.makedirs(journaldir)
+failed = 0
+with open(journalfile, 'a') as journal:
+    for calls, results in pool.imap_unordered(run_chunk, chunks):
+        for ((tag, nvr), kwargs), result in zip(calls, results):
+            if isinstance(result, dict):
+                sys.stderr.write('Failed to tag %s: %s\n' % (
+                    nvr, result['faultString']))
+                failed += 1
+            else:
+                journal.write(nvr + '\n')
+        journal.flush()
+        print 'Tagged a chunk of %s builds.' % len(calls)
+pool.close()
+pool.join()
+
+print 'Tagged %s builds.' % (len(taglist) - failed)
+if failed:
+    print 'Failed to tag %s builds, run again to retry them.' % failed
+    sys.exit(1)
@@ -12,11 +12,16 @@
 
 import koji
 import getpass
+import os
+import shutil
 import tempfile
 import urllib2
+from collections import deque
+from multiprocessing.pool import ThreadPool
 from bugzilla.rhbugzilla import RHBugzilla
 from xmlrpclib import Fault
-from find_failures import get_failed_builds
+from find_failures import get_rebuild_failures
+import kojiutils
 
 # Set some variables
 # Some of these could arguably be passed in as args.
@@ -30,10 +35,36 @@ product = "Fedora" # for BZ product field
 version = "rawhide" # for BZ version field
 tracking_bug = 1239338 # Tracking bug for mass build failures
 
+bzurl = 'https://bugzilla.redhat.com'
+work_url = 'http://kojipkgs.fedoraproject.org/work'
+# Components we filed bugs for, so reruns skip them without asking bugzilla
+ledger_file = os.path.expanduser(
+    '~/.cache/mass_rebuild_file_bugs-%s.ledger' % buildtag)
+log_workers = 8 # concurrent log downloads
+max_log_size = 5 * 1024 * 1024 # only the last 5 MiB of a log get attached
+multicall_size = 100
+
+_bzclient = None
+
+
+def get_bzclient():
+    """Return the bugzilla client shared by all queries and bug reports"""
+    global _bzclient
+    if _bzclient is None:
+        _bzclient = RHBugzilla(url="%s/xmlrpc.cgi" % bzurl)
+    return _bzclient
+
+
+def bz_login():
+    bzclient = get_bzclient()
+    username = raw_input('Bugzilla username: ')
+    bzclient.login(user=username,
+                   password=getpass.getpass())
+
 
 def report_failure(product, component, version, summary, comment, logs):
     """This function files a new bugzilla bug for component with given
-    arguments
+    arguments, returns the new bug or None if it could not be filed
 
     Keyword arguments:
     product -- bugzilla product (usually Fedora)
@@ -41,7 +72,8 @@ def report_failure(product, component, version, summary, comment, logs):
     version -- component version to file bug for (usually rawhide for Fedora)
     summary -- short bug summary
     comment -- first comment describing the bug in more detail
-    logs -- list of the log file to attach to the bug report
+    logs -- list of (name, file object) of the logs to attach to the bug
+            report
 
     """
     data = {
@@ -57,100 +89,198 @@ def report_failure(product, component, version, summary, comment, logs):
         'bug_file_loc': '',
         'priority': 'unspecified',
         }
-    bzurl = 'https://bugzilla.redhat.com'
-    bzclient = RHBugzilla(url="%s/xmlrpc.cgi" % bzurl)
+    bzclient = get_bzclient()
 
+    for attempt in range(2):
+        try:
+            print 'Creating the bug report'
+            bug = bzclient.createbug(**data)
+            break
+        except Fault, ex:
+            print ex
+            if attempt:
+                return None
+            bz_login()
+    #print "Running bzcreate: %s" % data
     try:
-        print 'Creating the bug report'
-        bug = bzclient.createbug(**data)
-        #print "Running bzcreate: %s" % data
         bug.refresh()
-        print bug
-        for log in logs:
-            name = log.rsplit('/', 1)[-1]
-            response = urllib2.urlopen(log)
-            fp = tempfile.TemporaryFile()
-            fp.write(response.read())
-            fp.seek(0)
-            try:
-                print 'Attaching file %s to the ticket' % name
-                attid = bzclient.attachfile(
-                    bug.id, fp, name, content_type='text/plain')
-            except Fault, ex:
-                print ex
-            finally:
-                fp.close()
     except Fault, ex:
+        # the bug exists, so still attach the logs to it
         print ex
-        username = raw_input('Bugzilla username: ')
-        bzclient.login(user=username,
-                       password=getpass.getpass())
-        report_failure(product, component, version, summary, comment, logs)
+    print bug
+    for name, fp in logs:
+        try:
+            print 'Attaching file %s to the ticket' % name
+            attid = bzclient.attachfile(
+                bug.id, fp, name, content_type='text/plain')
+        except Fault, ex:
+            print ex
+    return bug
 
 
 def get_filed_bugs(tracking_bug):
-    """Query bugzilla if given bug has already been filed
+    """Query bugzilla for the bugs blocking the tracking bug
 
     Keyword arguments:
-    product -- bugzilla product (usually Fedora)
-    component -- component (package) to file bug against
-    version -- component version to file bug for (usually rawhide for Fedora)
-    summary -- short bug summary
+    tracking_bug -- id of the mass rebuild tracking bug
     """
     query_data = {'blocks': tracking_bug}
-    bzurl = 'https://bugzilla.redhat.com'
-    bzclient = RHBugzilla(url="%s/xmlrpc.cgi" % bzurl)
 
-    return bzclient.query(query_data)
+    return get_bzclient().query(query_data)
+
+
+def load_ledger():
+    try:
+        with open(ledger_file) as ledger:
+            return set(line.strip() for line in ledger if line.strip())
+    except IOError:
+        return set()
+
+
+def add_to_ledger(component):
+    ledgerdir = os.path.dirname(ledger_file)
+    if not os.path.isdir(ledgerdir):
+        os.makedirs(ledgerdir)
+    with open(ledger_file, 'a') as ledger:
+        ledger.write(component + '\n')
 
 
 def get_task_failed(kojisession, task_id):
     ''' For a given task_id, use the provided kojisession to return the
     task_id of the first children that failed to build.
     '''
-    for child in kojisession.getTaskChildren(task_id):
-        if child['state'] == 5:  # 5 == Failed
-            return child['id']
+    return get_tasks_failed(kojisession, [task_id])[task_id]
+
+
+def get_tasks_failed(kojisession, task_ids):
+    ''' Like get_task_failed for many task_ids, using multicalls. Returns a
+    dict of task_id to the task_id of its first failed child or None.
+    '''
+    failed_children = {}
+    results = kojiutils.multicall(kojisession, 'getTaskChildren',
+                                  [((task_id,), {}) for task_id in task_ids],
+                                  size=multicall_size)
+    for task_id, result in zip(task_ids, results):
+        failed_children[task_id] = None
+        if isinstance(result, dict):
+            print 'Cannot get children of task %s: %s' % (
+                task_id, result['faultString'])
+            continue
+        for child in result[0]:
+            if child['state'] == 5:  # 5 == Failed
+                failed_children[task_id] = child['id']
+                break
+    return failed_children
+
+
+def fetch_log(url):
+    """Stream a log into a temporary file, keeping only its last
+    max_log_size bytes so huge logs neither fill memory nor bugzilla"""
+    response = urllib2.urlopen(url)
+    fp = tempfile.TemporaryFile()
+    try:
+        shutil.copyfileobj(response, fp, 65536)
+    except:
+        fp.close()
+        raise
+    finally:
+        response.close()
+    size = fp.tell()
+    if size > max_log_size:
+        # copy the tail to a new file, again without reading it to memory
+        tail = tempfile.TemporaryFile()
+        tail.write('[... %d bytes skipped ...]\n' % (size - max_log_size))
+        fp.seek(size - max_log_size)
+        shutil.copyfileobj(fp, tail, 65536)
+        fp.close()
+        fp = tail
+    fp.seek(0)
+    return fp
+
+
+def fetch_logs(job):
+    """Fetch the logs of the failed child task of a build, runs in the log
+    download pool"""
+    build, child_id = job
+    logs = []
+    if not child_id:
+        return build, logs
+    base_path = koji.pathinfo.taskrelpath(child_id)
+    log_url = "%s/%s/" % (work_url, base_path)
+    for name in ("build.log", "root.log", "state.log"):
+        try:
+            logs.append((name, fetch_log(log_url + name)))
+        except (urllib2.URLError, IOError), ex:
+            print 'Cannot fetch %s%s: %s' % (log_url, name, ex)
+    return build, logs
+
+
+def fetch_logs_bounded(pool, jobs):
+    """Like pool.imap(fetch_logs, jobs), but with at most 2 * log_workers
+    jobs in flight, so the downloaded logs of builds whose bugs are not
+    filed yet do not pile up"""
+    pending = deque()
+    jobs = iter(jobs)
+    for job in jobs:
+        pending.append(pool.apply_async(fetch_logs, (job,)))
+        if len(pending) >= 2 * log_workers:
+            break
+    while pending:
+        result = pending.popleft().get()
+        for job in jobs:
+            pending.append(pool.apply_async(fetch_logs, (job,)))
+            break
+        yield result
 
 
 if __name__ == '__main__':
     kojisession = koji.ClientSession('http://koji.fedoraproject.org/kojihub')
     print 'Getting the list of failed builds...'
-    failbuilds = get_failed_builds(kojisession, epoch, buildtag, desttag)
+    failbuilds = get_rebuild_failures(kojisession, epoch, buildtag, desttag)
     print 'Getting the list of filed bugs...'
+    filed_bugs_components = load_ledger()
     filed_bugs = get_filed_bugs(tracking_bug)
-    filed_bugs_components = [bug.component for bug in filed_bugs]
-    for build in failbuilds:
-        global product, version
+    filed_bugs_components.update(bug.component for bug in filed_bugs)
+
+    todo = []
+    for component in sorted(failbuilds):
+        if component in filed_bugs_components:
+            print "Skipping %s, bug already filed" % component
+            continue
+        todo.append(failbuilds[component])
+
+    print 'Looking up the failed tasks...'
+    failed_children = get_tasks_failed(
+        kojisession, [build['task_id'] for build in todo])
+    jobs = [(build, failed_children[build['task_id']]) for build in todo]
+
+    # Logs are downloaded in parallel while the bugs get filed in order over
+    # the single bugzilla connection
+    pool = ThreadPool(log_workers)
+    for build, logs in fetch_logs_bounded(pool, jobs):
         task_id = build['task_id']
         component = build['package_name']
         summary = "%s: FTBFS in %s" % (component, 'rawhide')
-        work_url = 'http://kojipkgs.fedoraproject.org/work'
 
-        child_id = get_task_failed(kojisession, task_id)
-        if not child_id:
+        if not failed_children[task_id]:
             print 'No children failed for task: %s (%s)' % (
                 task_id, component)
-            logs = []
-        else:
-            base_path = koji.pathinfo.taskrelpath(child_id)
-            log_url = "%s/%s/" % (work_url, base_path)
-            build_log = log_url + "build.log"
-            root_log = log_url + "root.log"
-            state_log = log_url + "state.log"
-            logs = [build_log, root_log, state_log]
 
         comment = """Your package %s failed to build from source in current rawhide.
 
-http://koji.fedoraproject.org/koji/taskinfo?taskID=%s
+%s
 
 For details on mass rebuild see https://fedoraproject.org/wiki/Fedora_23_Mass_Rebuild
-""" % (component, task_id)
+""" % (component, build['taskurl'])
 
-        if component not in filed_bugs_components:
-            print "Filing bug for %s" % component
-            report_failure(
+        print "Filing bug for %s" % component
+        try:
+            bug = report_failure(
                 product, component, version, summary, comment, logs=logs)
-            filed_bugs_components.append(component)
-        else:
-            print "Skipping %s, bug already filed" % component
+        finally:
+            for name, fp in logs:
+                fp.close()
+        if bug:
+            add_to_ledger(component)
+    pool.close()
+    pool.join()
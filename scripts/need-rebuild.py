@@ -15,6 +15,10 @@ import os
 import operator
 import datetime
 import sys
+import threading
+from Queue import Queue
+
+import kojiutils
 
 # Set some variables
 # Some of these could arguably be passed in as args.
@@ -23,10 +27,9 @@ target = 'f23'
 updates = 'f23-candidate'
 rawhide = 'rawhide' # Change to dist-f13 after we branch
 epoch = '2015-06-16 00:00:00.000000' # rebuild anything not built after this date
-tobuild = {} # dict of owners to lists of packages needing to be built
-unbuilt = [] # raw list of unbuilt packages
-newbuilds = {}
-tasks = {}
+multicall_size = 1000 # maximum number of calls per koji multicall
+# cache of kojihub -> {task id: build tag}, finished tasks never change
+taskcache_file = os.path.expanduser('~/.cache/need-rebuild-tasks.pickle')
 # List of Kojihubs to be searched
 kojihubs = [
 'http://koji.fedoraproject.org/kojihub',
@@ -36,7 +39,10 @@ kojihubs = [
 ]
 
 #'http://sparc.koji.fedoraproject.org/kojihub',
-def needRebuild(kojihub):
+def needRebuild(kojihub, buildtags):
+    """Return a dict of package name -> owner for the packages on kojihub
+    that were not built since epoch. buildtags is the task cache for this
+    hub, a dict of task id -> build tag, and is updated in place."""
 
     # Create a koji session
     kojisession = koji.ClientSession(kojihub)
@@ -46,55 +52,71 @@ def needRebuild(kojihub):
         pkgs = kojisession.listPackages(target, inherited=True)
     except:
         print >> sys.stderr, "Failed to get the packages list from koji: %s (skipping)" % kojihub
-        return -1
-    print "%s<br/>" % kojihub
+        return None
 
     # reduce the list to those that are not blocked and sort by package name
     pkgs = sorted([pkg for pkg in pkgs if not pkg['blocked']],
                   key=operator.itemgetter('package_name'))
 
     # Get completed builds since epoch
-    kojisession.multicall = True
-    for pkg in pkgs:
-        kojisession.listBuilds(pkg['package_id'], state=1, createdAfter=epoch)
-
-    results = kojisession.multiCall()
-
-    # For each build, get it's request info
-    kojisession.multicall = True
-    for pkg, [result] in zip(pkgs, results):
-        newbuilds[pkg['package_name']] = []
-        for newbuild in result:
-            newbuilds[pkg['package_name']].append(newbuild)
-            kojisession.getTaskInfo(newbuild['task_id'],
-                                    request=True)
+    try:
+        results = kojiutils.multicall(
+            kojisession, 'listBuilds',
+            [((pkg['package_id'],), {'state': 1, 'createdAfter': epoch})
+             for pkg in pkgs], size=multicall_size)
+    except:
+        print >> sys.stderr, "Failed to get the builds list from koji: %s (skipping)" % kojihub
+        return None
+
+    # For each build not in the cache, get it's request info
+    newbuilds = {}
+    task_ids = set()
+    for pkg, result in zip(pkgs, results):
+        if len(result) > 1:
+            print >> sys.stderr, "Failed to list builds of %s on %s" % (pkg['package_name'], kojihub)
+            newbuilds[pkg['package_name']] = []
+            continue
+        newbuilds[pkg['package_name']] = result[0]
+        for newbuild in result[0]:
+            if newbuild['task_id'] not in buildtags:
+                task_ids.add(newbuild['task_id'])
+    task_ids = sorted(task_ids)
 
     try:
-        requests = kojisession.multiCall()
+        requests = kojiutils.multicall(
+            kojisession, 'getTaskInfo',
+            [((task_id,), {'request': True}) for task_id in task_ids],
+            size=multicall_size)
     except:
         print >> sys.stderr, "Failed to get the build request information: %s (skipping)" % kojihub
-        return -1
-
+        return None
 
-    # Populate the task info dict
-    for request in requests:
+    # Populate the task cache
+    for task_id, request in zip(task_ids, requests):
         if len(request) > 1:
             continue
-        tasks[request[0]['id']] = request[0]
+        try:
+            buildtags[task_id] = request[0]['request'][1]
+        except (IndexError, KeyError, TypeError):
+            pass
 
-    unbuiltnew = []
+    unbuiltnew = {}
     for pkg in pkgs:
         for newbuild in newbuilds[pkg['package_name']]:
-            # Scrape the task info out of the tasks dict from the newbuild task ID
-            try:
-                if tasks[newbuild['task_id']]['request'][1] in [target, buildtag, updates, rawhide, 'dist-rawhide']:
-                    break
-            except:
-                pass
+            # Look up the build tag from the newbuild task ID
+            if buildtags.get(newbuild['task_id']) in [target, buildtag, updates, rawhide, 'dist-rawhide']:
+                break
         else:
-            tobuild.setdefault(pkg['owner_name'], set()).add(pkg['package_name'])
-            unbuiltnew.append(pkg['package_name'])
-    return set(unbuiltnew)
+            unbuiltnew[pkg['package_name']] = pkg['owner_name']
+    return unbuiltnew
+
+def hubWorker(kojihub, buildtags, results):
+    try:
+        unbuiltnew = needRebuild(kojihub, buildtags)
+    except Exception, e:
+        print >> sys.stderr, "Failed to check %s: %s (skipping)" % (kojihub, e)
+        unbuiltnew = None
+    results.put((kojihub, unbuiltnew))
 
 now = datetime.datetime.now()
 now_str = "%s UTC" % str(now.utcnow())
@@ -105,26 +127,53 @@ print '</head><body>'
 print "<p>Last run: %s</p>" % now_str
 print "<p>Included build tags: %s</p>" % [target, buildtag, updates, rawhide]
 print "<p>Included Koji instances:<br/>"
+sys.stdout.flush()
 
-# Go through all Kojis to get unbuilt packages
+# Query all Kojis concurrently to get unbuilt packages
+taskcache = kojiutils.load_pickle(taskcache_file, {})
+results = Queue()
 for kojihub in kojihubs:
-    unbuiltnew = needRebuild(kojihub)
-    if unbuiltnew == -1:
+    thread = threading.Thread(target=hubWorker,
+                              args=(kojihub, taskcache.setdefault(kojihub, {}),
+                                    results))
+    thread.daemon = True
+    thread.start()
+
+# A package needs a rebuild only if it is unbuilt on every hub, so the
+# report can only be written once all hubs answered
+unbuilt = None # set of packages unbuilt on every hub
+hubowners = {} # kojihub -> {package name: owner}
+for i in range(len(kojihubs)):
+    kojihub, unbuiltnew = results.get()
+    if unbuiltnew is None:
         continue
-    if len(unbuilt) == 0:
-        unbuilt = unbuiltnew
+    print "%s<br/>" % kojihub
+    sys.stdout.flush()
+    hubowners[kojihub] = unbuiltnew
+    if unbuilt is None:
+        unbuilt = set(unbuiltnew)
     else:
-        unbuilt = unbuilt & unbuiltnew
+        unbuilt &= set(unbuiltnew)
 print "</p>"
+if unbuilt is None:
+    unbuilt = set()
+
+# Hubs may disagree about the owner of a package, the first hub in kojihubs
+# that answered wins, no matter in which order the hubs finished
+owners = {} # package name -> owner
+for kojihub in kojihubs:
+    for pkg, owner in hubowners.get(kojihub, {}).iteritems():
+        owners.setdefault(pkg, owner)
 
-# Update the maintainer-package list
-for owner in tobuild.keys():
-    for pkg in tobuild[owner].copy():
-        if pkg not in unbuilt:
-            tobuild[owner].remove(pkg)
-    if len(tobuild[owner]) == 0:
-        del tobuild[owner]
+try:
+    kojiutils.save_pickle(taskcache_file, taskcache)
+except (IOError, OSError), e:
+    print >> sys.stderr, "Failed to save the task cache: %s" % e
 
+# Build the maintainer-package list
+tobuild = {} # dict of owners to sets of packages needing to be built
+for pkg in unbuilt:
+    tobuild.setdefault(owners[pkg], set()).add(pkg)
 
 print "<p>%s packages need rebuilding:</p><hr/>" % len(unbuilt)
 
@@ -134,7 +183,8 @@ for owner in sorted(tobuild.keys()):
     print '<dt>%s (%s):</dt>' % (owner, len(tobuild[owner]))
     for pkg in sorted(tobuild[owner]):
         print '<dd><a href="http://koji.fedoraproject.org/koji/packageinfo?packageID=%s">%s</a></dd>' % (pkg, pkg)
-    print '</dl>'
+    sys.stdout.flush()
+print '</dl>'
 print '<p>The script that generated this page can be found at '
 print '<a href="https://pagure.io/releng/blob/master/f/scripts">https://pagure.io/releng/blob/master/f/scripts</a>.'
 print 'There you can also report bugs and RFEs.</p>'
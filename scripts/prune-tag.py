@@ -13,11 +13,15 @@
 import os
 import optparse
 import sys
+import functools
 import koji
 import logging
+import rpm
+from multiprocessing.pool import ThreadPool
+
+import kojiutils
 
 status = 0
-builds = {}
 untag = []
 loglevel = ''
 KOJIHUB = 'https://koji.fedoraproject.org/kojihub'
@@ -28,14 +32,32 @@ CLIENTCERT = os.path.expanduser('~/.fedora.cert')
 # Setup a dict of our key names as sigul knows them to the actual key ID
 # that koji would use.  We should get this from sigul somehow.
 
+EVRKey = functools.cmp_to_key(rpm.labelCompare)
+
 # Define our usage
-usage = 'usage: %prog [options] tag'
+usage = 'usage: %prog [options] tag\n       %prog [options] --apply PLAN'
 # Create a parser to parse our arguments
 parser = optparse.OptionParser(usage=usage)
 parser.add_option('-v', '--verbose', action='count', default=0,
                   help='Be verbose, specify twice for debug')
 parser.add_option('-n', '--dry-run', action='store_true', default=False,
                   help='Perform a dry run without untagging')
+parser.add_option('-k', '--keep', type='int', default=1,
+                  help='Number of builds to keep per package (default: 1)')
+parser.add_option('-o', '--order', choices=['time', 'evr'], default='time',
+                  help='Keep the newest builds by tag time or by EVR '
+                  '(default: time)')
+parser.add_option('-p', '--plan',
+                  help='With --dry-run, write the builds to untag to PLAN')
+parser.add_option('-a', '--apply',
+                  help='Untag the builds listed in PLAN without looking at '
+                  'the tag again')
+parser.add_option('-b', '--batch-size', type='int', default=100,
+                  help='Packages to look up per multicall (default: 100)')
+parser.add_option('-c', '--chunk-size', type='int', default=100,
+                  help='Builds to untag per multicall (default: 100)')
+parser.add_option('-j', '--jobs', type='int', default=4,
+                  help='Untag multicalls to run in parallel (default: 4)')
 
 # Get our options and arguments
 (opts, args) = parser.parse_args()
@@ -52,55 +74,122 @@ logging.basicConfig(format='%(levelname)s: %(message)s',
                     level=loglevel)
 
 # Check to see if we got any arguments
-if not args:
+if not args and not opts.apply:
     parser.print_help()
     sys.exit(1)
 
-tag = args[0]
-
-# setup the koji session
-logging.info('Setting up koji session')
-kojisession = koji.ClientSession(KOJIHUB)
-if not kojisession.ssl_login(CLIENTCERT, CLIENTCA, SERVERCA):
-    logging.error('Unable to log into koji')
-    sys.exit(1)
-
-# Get a list of tagged packages
-logging.info('Getting builds from %s' % tag)
-tagged = kojisession.listTagged(tag)
-
-logging.debug('Got %s builds' % len(builds))
-
-# Sort builds by package
-for b in tagged:
-    builds.setdefault(b['package_name'], []).append(b)
-
-# Find the packages with multiple builds
-for pkg in sorted(builds.keys()):
-    if len(builds[pkg]) > 1:
-        logging.debug('Leaving newest build %s' % builds[pkg][0]['nvr'])
-        for build in builds[pkg][1:]:
-            logging.debug('Adding %s to untag list' % build['nvr'])
-            untag.append(build['nvr'])
-
-# Now untag all the builds
-logging.info('Untagging %s builds' % len(untag))
-if not opts.dry_run:
-    kojisession.multicall = True
-for build in untag:
-    if not opts.dry_run:
-        kojisession.untagBuildBypass(tag, build, force=True)
-    logging.debug('Untagging %s' % build)
-
-if not opts.dry_run:
-    results = kojisession.multiCall()
-
-    for build, result in zip(untag, results):
+if opts.keep < 1:
+    parser.error('--keep needs to be at least 1')
+
+if opts.plan and not opts.dry_run:
+    parser.error('--plan only makes sense with --dry-run')
+
+def login(kojisession):
+    if not kojisession.ssl_login(CLIENTCERT, CLIENTCA, SERVERCA):
+        raise koji.AuthError('Unable to log into koji')
+
+def get_session():
+    """Return the logged in koji session of this thread"""
+    return kojiutils.thread_session(KOJIHUB, login)
+
+def newest_first(pkgbuilds):
+    """Sort the builds of a package, newest first"""
+    if opts.order == 'evr':
+        key = lambda b: EVRKey((str(b['epoch'] or 0), b['version'],
+                                b['release']))
+    else:
+        key = lambda b: b['create_event']
+    return sorted(pkgbuilds, key=key, reverse=True)
+
+def prune_candidates(kojisession, tag):
+    """Yield the NVRs to untag from tag, fetching the tag history of
+    opts.batch_size packages at a time"""
+    packages = sorted(set(pkg['package_name'] for pkg in
+                          kojisession.listPackages(tagID=tag,
+                                                   inherited=True)))
+    logging.info('Checking %s packages in %s' % (len(packages), tag))
+    for i in range(0, len(packages), opts.batch_size):
+        batch = packages[i:i + opts.batch_size]
+        kojisession.multicall = True
+        for pkg in batch:
+            kojisession.listTagged(tag, package=pkg)
+        for pkg, result in zip(batch, kojisession.multiCall()):
+            if isinstance(result, dict):
+                logging.error('Error getting builds of %s: %s' % (
+                    pkg, result['faultString']))
+                continue
+            pkgbuilds = newest_first(result[0])
+            for build in pkgbuilds[:opts.keep]:
+                logging.debug('Leaving build %s' % build['nvr'])
+            for build in pkgbuilds[opts.keep:]:
+                logging.debug('Adding %s to untag list' % build['nvr'])
+                yield build['nvr']
+
+def untag_chunk(chunk):
+    """Untag a chunk of (tag, nvr), returns the list of (tag, nvr, error)"""
+    try:
+        kojisession = get_session()
+        kojisession.multicall = True
+        for tag, build in chunk:
+            kojisession.untagBuildBypass(tag, build, force=True)
+        results = kojisession.multiCall()
+    except Exception, e:
+        # a failed login or multicall fails every build of the chunk
+        return [(tag, build, str(e)) for tag, build in chunk]
+    errors = []
+    for (tag, build), result in zip(chunk, results):
         if isinstance(result, dict):
-            logging.error('Error tagging %s' % build)
             if result['traceback']:
-                logging.error('    ' + result['traceback'][-1])
+                error = result['traceback'][-1]
+            else:
+                error = result['faultString']
+            errors.append((tag, build, error))
+    return errors
+
+if opts.apply:
+    # Read the (tag, nvr) pairs of a dry run
+    with open(opts.apply) as plan:
+        untag = [tuple(line.split()) for line in plan
+                 if line.strip() and not line.startswith('#')]
+else:
+    tag = args[0]
+
+    # setup the koji session
+    logging.info('Setting up koji session')
+    try:
+        kojisession = get_session()
+    except koji.AuthError:
+        logging.error('Unable to log into koji')
+        sys.exit(1)
+
+    # Get the builds to untag, in package batches
+    logging.info('Getting builds from %s' % tag)
+    untag = [(tag, nvr) for nvr in prune_candidates(kojisession, tag)]
+
+if opts.dry_run:
+    for tag, build in untag:
+        logging.debug('Untagging %s' % build)
+    if opts.plan:
+        with open(opts.plan, 'w') as plan:
+            plan.write('# prune-tag plan: untag these builds, '
+                       'keeping %s by %s\n' % (opts.keep, opts.order))
+            for tag, build in untag:
+                plan.write('%s %s\n' % (tag, build))
+        logging.info('Wrote plan for %s builds to %s' % (len(untag),
+                                                         opts.plan))
+else:
+    # Now untag all the builds
+    logging.info('Untagging %s builds' % len(untag))
+    chunks = [untag[i:i + opts.chunk_size]
+              for i in range(0, len(untag), opts.chunk_size)]
+    pool = ThreadPool(opts.jobs)
+    for errors in pool.imap_unordered(untag_chunk, chunks):
+        for tag, build, error in errors:
+            logging.error('Error untagging %s from %s' % (build, tag))
+            logging.error('    ' + error)
             status = 1
+    pool.close()
+    pool.join()
 
 logging.info('All done, pruned %s builds.' % len(untag))
 sys.exit(status)
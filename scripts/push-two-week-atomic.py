@@ -21,15 +21,21 @@
 #
 
 import os
+import re
 import sys
 import json
 import glob
+import time
 import shutil
+import getpass
+import hashlib
 import fnmatch
+import tempfile
 import smtplib
 import argparse
 import logging
 import subprocess
+from multiprocessing.pool import ThreadPool
 
 import requests
 
@@ -69,6 +75,7 @@ MARK_ATOMIC_BAD_JSON_URL = \
     'https://pagure.io/mark-atomic-bad/raw/master/f/bad-builds.json'
 MARK_ATOMIC_BAD_JSON = requests.get(MARK_ATOMIC_BAD_JSON_URL).text
 MARK_ATOMIC_BAD_BUILDS = json.loads(MARK_ATOMIC_BAD_JSON)
+MARK_ATOMIC_BAD_BUILD_IDS = set(MARK_ATOMIC_BAD_BUILDS['bad-builds'])
 
 
 DATAGREPPER_URL = "https://apps.fedoraproject.org/datagrepper/raw"
@@ -76,9 +83,33 @@ DATAGREPPER_URL = "https://apps.fedoraproject.org/datagrepper/raw"
 DATAGREPPER_DELTA = 1209600
 # category to filter on from datagrepper
 DATAGREPPER_CATEGORY = "autocloud"
-
-
-SIGUL_SIGNED_TXT_PATH = "/tmp/signed"
+# number of datagrepper pages to fetch in parallel
+DATAGREPPER_WORKERS = 8
+# datagrepper messages from previous runs, keyed by msg_id
+DATAGREPPER_CACHE = os.path.expanduser(
+    "~/.cache/push-two-week-atomic-autocloud.json")
+
+# autocloud image_name -> autocloud_info key
+AUTOCLOUD_IMAGE_TYPES = {
+    u'Fedora-Cloud-Atomic': "atomic_qcow2",
+    u'Fedora-Cloud-Atomic-Vagrant-Libvirt': "atomic_vagrant_libvirt",
+    u'Fedora-Cloud-Atomic-Vagrant-Virtualbox': "atomic_vagrant_virtualbox",
+}
+
+
+# directory for the temporary output files of sigul
+SIGUL_SIGNED_TXT_DIR = "/tmp"
+# how often to try signing a checksum file before giving up
+SIGUL_SIGN_RETRIES = 5
+# number of checksum files to sign / artifacts to verify in parallel
+ATOMIC_STAGE_WORKERS = 4
+
+PGP_SIGNED_HEADER = "-----BEGIN PGP SIGNED MESSAGE-----"
+# BSD style "SHA256 (file) = checksum" and GNU style "checksum *file" lines
+CHECKSUM_LINE_RES = [
+    re.compile(r'^SHA256 \((?P<name>.+)\) = (?P<checksum>[0-9a-f]{64})$'),
+    re.compile(r'^(?P<checksum>[0-9a-f]{64}) [ *](?P<name>.+)$'),
+]
 
 # Number of atomic testing composes to keep around
 ATOMIC_COMPOSE_PERSIST_LIMIT = 20
@@ -95,6 +126,114 @@ def construct_url(msg):
     return image_name, image_url
 
 
+def load_datagrepper_cache(cache_file, delta):
+    """
+    load_datagrepper_cache
+
+        Load the messages of previous runs that are not older than delta
+        seconds
+
+    return -> (dict, float)
+        Messages keyed by msg_id and the time of the last fetch
+    """
+    try:
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return {}, 0
+
+    oldest = time.time() - delta
+    messages = dict(
+        (msg_id, msg) for msg_id, msg in cache[u'messages'].items()
+        if msg[u'timestamp'] >= oldest
+    )
+    return messages, cache[u'fetched']
+
+
+def save_datagrepper_cache(cache_file, messages, fetched):
+    """
+    save_datagrepper_cache
+
+        Store the messages for the next run
+    """
+    cache_dir = os.path.dirname(cache_file)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(cache_file + '.tmp', 'w') as f:
+            json.dump({'fetched': fetched, 'messages': messages}, f)
+        os.rename(cache_file + '.tmp', cache_file)
+    except (IOError, OSError), e:
+        log.warn("Unable to write datagrepper cache: {0}".format(e))
+
+
+def get_datagrepper_messages(
+        datagrepper_url=DATAGREPPER_URL,
+        delta=DATAGREPPER_DELTA,
+        category=DATAGREPPER_CATEGORY,
+        cache_file=DATAGREPPER_CACHE,
+        workers=DATAGREPPER_WORKERS):
+    """
+    get_datagrepper_messages
+
+        Get all messages of the last delta seconds in category. Only the
+        messages since the last run are requested from datagrepper, all pages
+        after the first one are fetched in parallel.
+
+    return -> list
+        Messages, newest first
+    """
+    messages, fetched = load_datagrepper_cache(cache_file, delta)
+    now = time.time()
+    # overlap with the previous run a bit to not miss messages that were
+    # published while it was running
+    if fetched:
+        query_delta = min(delta, int(now - fetched) + 600)
+    else:
+        query_delta = delta
+
+    # rows_per_page is maximum 100 from Fedora's datagrepper
+    request_params = {
+        "delta": query_delta,
+        "category": category,
+        "rows_per_page": 100,
+    }
+
+    def get_page(page):
+        r = requests.get(datagrepper_url,
+                         params=dict(page=page, **request_params))
+        r.raise_for_status()
+        return r.json()
+
+    # Start with page 1 response from datagrepper to know the number of
+    # pages and then fetch the rest of the pages concurrently
+    first_page = get_page(1)
+    pages = [first_page[u'raw_messages']]
+    if first_page[u'pages'] > 1:
+        pool = ThreadPool(workers)
+        try:
+            pages.extend(
+                page[u'raw_messages'] for page in
+                pool.map(get_page, range(2, first_page[u'pages'] + 1))
+            )
+        finally:
+            pool.close()
+            pool.join()
+
+    new_messages = 0
+    for page in pages:
+        for msg in page:
+            if msg[u'msg_id'] not in messages:
+                new_messages += 1
+            messages[msg[u'msg_id']] = msg
+    log.info("datagrepper: {0} new messages, {1} total".format(
+        new_messages, len(messages)))
+
+    save_datagrepper_cache(cache_file, messages, now)
+    return sorted(messages.values(), key=lambda m: m[u'timestamp'],
+                  reverse=True)
+
+
 def get_latest_successful_autocloud_test_info(
         release,
         datagrepper_url=DATAGREPPER_URL,
@@ -113,101 +252,57 @@ def get_latest_successful_autocloud_test_info(
     [1] - https://github.com/kushaldas/autocloud/
     """
 
-    # rows_per_page is maximum 100 from Fedora's datagrepper
-    request_params = {
-        "delta": delta,
-        "category": category,
-        "rows_per_page": 100,
-    }
-    r = requests.get(datagrepper_url, params=request_params)
-
-    # Start with page 1 response from datagrepper, grab the raw messages
-    # and then continue to populate the list with the rest of the pages of data
-    autocloud_data = r.json()[u'raw_messages']
-    for rpage in range(2, r.json()[u'pages']+1):
-        autocloud_data += requests.get(
-            datagrepper_url,
-            params=dict(page=rpage, **request_params)
-        ).json()[u'raw_messages']
+    autocloud_data = get_datagrepper_messages(
+        datagrepper_url=datagrepper_url,
+        delta=delta,
+        category=category,
+    )
 
+    # Find the latest successful message of every image type in one pass
     # FIXME - I would like to find a good way to extract the types from the
     #         datagrepper query instead of specifying each artifact
-    atomic_qcow2 = [
-        s for s in autocloud_data
-        if s[u'msg'][u'status'] == u'success'
-        and s[u'msg'][u'image_name'] == u'Fedora-Cloud-Atomic'
-        and u'release' in s[u'msg'].keys()
-        and s[u'msg'][u'release'] == str(release)
-        and not build_manually_marked_bad(
-            s[u'msg'][u'image_url'].split('/')[-1]
-        )
-    ]
-
-    atomic_vagrant_libvirt = [
-        s for s in autocloud_data
-        if s[u'msg'][u'status'] == u'success'
-        and s[u'msg'][u'image_name'] == u'Fedora-Cloud-Atomic-Vagrant-Libvirt'
-        and u'release' in s[u'msg'].keys()
-        and s[u'msg'][u'release'] == str(release)
-        and not build_manually_marked_bad(
-            s[u'msg'][u'image_url'].split('/')[-1]
-        )
-    ]
-
-    atomic_vagrant_vbox = [
-        s for s in autocloud_data
-        if s[u'msg'][u'status'] == u'success'
-        and s[u'msg'][u'image_name'] == u'Fedora-Cloud-Atomic-Vagrant-Virtualbox'
-        and u'release' in s[u'msg'].keys()
-        and s[u'msg'][u'release'] == str(release)
-        and not build_manually_marked_bad(
-            s[u'msg'][u'image_url'].split('/')[-1]
-        )
-    ]
+    latest = {}
+    for s in autocloud_data:
+        image_type = AUTOCLOUD_IMAGE_TYPES.get(s[u'msg'].get(u'image_name'))
+        if image_type is None or image_type in latest:
+            continue
+        if s[u'msg'][u'status'] == u'success' \
+                and s[u'msg'].get(u'release') == str(release) \
+                and not build_manually_marked_bad(
+                    s[u'msg'][u'image_url'].split('/')[-1]):
+            latest[image_type] = s
+            if len(latest) == len(AUTOCLOUD_IMAGE_TYPES):
+                break
 
     autocloud_info = {}
 
-    if atomic_qcow2:
-        image_name, image_url = construct_url(atomic_qcow2[0])
-        autocloud_info["atomic_qcow2"] = {
-            "name": atomic_qcow2[0][u'msg'][u'image_name'],
-            "release": atomic_qcow2[0][u'msg'][u'release'],
+    for image_type, msg in latest.items():
+        image_name, image_url = construct_url(msg)
+        autocloud_info[image_type] = {
+            "name": msg[u'msg'][u'image_name'],
+            "release": msg[u'msg'][u'release'],
             "image_name": image_name,
             "image_url": image_url,
         }
 
+    if "atomic_qcow2" in autocloud_info:
+        atomic_qcow2 = autocloud_info["atomic_qcow2"]
         # FIXME - This is a bit of a hack right now, but the raw image is what
         #         the qcow2 is made of so only qcow2 is tested and infers the
         #         success of both qcow2 and raw.xz
         autocloud_info["atomic_raw"] = {
-            "name": atomic_qcow2[0][u'msg'][u'image_name'] + '-Raw',
-            "release": atomic_qcow2[0][u'msg'][u'release'],
-            "image_name": image_name.replace('qcow2', 'raw.xz'),    # HACK
-            "image_url": image_url.replace('qcow2', 'raw.xz'),      # HACK
-        }
-
-    if atomic_vagrant_libvirt:
-        image_name, image_url = construct_url(atomic_vagrant_libvirt[0])
-        autocloud_info["atomic_vagrant_libvirt"] = {
-            "name": atomic_vagrant_libvirt[0][u'msg'][u'image_name'],
-            "release": atomic_vagrant_libvirt[0][u'msg'][u'release'],
-            "image_name": image_name,
-            "image_url": image_url,
-        }
-
-    if atomic_vagrant_vbox:
-        image_name, image_url = construct_url(atomic_vagrant_vbox[0])
-        autocloud_info["atomic_vagrant_virtualbox"] = {
-            "name": atomic_vagrant_vbox[0][u'msg'][u'image_name'],
-            "release": atomic_vagrant_vbox[0][u'msg'][u'release'],
-            "image_name": image_name,
-            "image_url": image_url,
+            "name": atomic_qcow2["name"] + '-Raw',
+            "release": atomic_qcow2["release"],
+            "image_name": atomic_qcow2["image_name"].replace(
+                'qcow2', 'raw.xz'),    # HACK
+            "image_url": atomic_qcow2["image_url"].replace(
+                'qcow2', 'raw.xz'),    # HACK
         }
 
     return autocloud_info
 
 
-def build_manually_marked_bad(build_id, bad_builds=MARK_ATOMIC_BAD_BUILDS):
+def build_manually_marked_bad(build_id, bad_builds=MARK_ATOMIC_BAD_BUILD_IDS):
     """
     build_manually_marked_bad
 
@@ -216,13 +311,14 @@ def build_manually_marked_bad(build_id, bad_builds=MARK_ATOMIC_BAD_BUILDS):
         build_id
             Build id of most recently found auto-tested good compose build
 
+        bad_builds
+            Set of build ids marked bad
+
     return -> bool
         True if the build was marked bad, else False
     """
 
-    bad = [b for b in bad_builds['bad-builds'] if b == build_id]
-
-    return len(bad) > 0
+    return build_id in bad_builds
 
 
 def send_atomic_announce_email(
@@ -286,29 +382,146 @@ Fedora Release Engineering
         print "ERROR: Unable to send email:\n{0}\n".format(e)
 
 
+def sha256sum(path, blocksize=1024 * 1024):
+    """
+    sha256sum
+
+        Return the hex sha256 digest of the file at path
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_checksum_manifests(artifact_path):
+    """
+    read_checksum_manifests
+
+        Parse all *CHECKSUM files below artifact_path, signed or not
+
+    return -> dict
+        Full path of each listed artifact -> sha256 checksum
+    """
+    artifacts = {}
+    for full_dir_path, _, short_names in os.walk(artifact_path):
+        for sname in fnmatch.filter(short_names, '*CHECKSUM'):
+            with open(os.path.join(full_dir_path, sname), 'r') as f:
+                for line in f:
+                    for checksum_re in CHECKSUM_LINE_RES:
+                        match = checksum_re.match(line.strip())
+                        if match:
+                            artifacts[os.path.join(
+                                full_dir_path, match.group('name')
+                            )] = match.group('checksum')
+                            break
+    return artifacts
+
+
+def artifact_is_staged(dest, checksum, size):
+    """
+    artifact_is_staged
+
+        Check if dest has the expected size and checksum
+    """
+    try:
+        if os.path.getsize(dest) != size:
+            return False
+    except OSError:
+        return False
+    return sha256sum(dest) == checksum
+
+
+def stage_artifact(source, dest, checksum, link_dest=None):
+    """
+    stage_artifact
+
+        Stage a single artifact at dest unless it is already there, by
+        hardlinking it from link_dest if that has the right content, else by
+        copying it. The result is verified against checksum.
+
+    return -> bool
+        True if the artifact is staged correctly
+    """
+    size = os.path.getsize(source)
+    if artifact_is_staged(dest, checksum, size):
+        log.info("stage_artifact: {0} is already staged".format(dest))
+        return True
+
+    dest_dir = os.path.dirname(dest)
+    if not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir)
+    tmp_dest = dest + ".part"
+    if os.path.exists(tmp_dest):
+        os.unlink(tmp_dest)
+
+    if link_dest and artifact_is_staged(link_dest, checksum, size):
+        log.info("stage_artifact: linking {0}".format(dest))
+        os.link(link_dest, tmp_dest)
+    else:
+        log.info("stage_artifact: copying {0}".format(dest))
+        shutil.copy2(source, tmp_dest)
+        if sha256sum(tmp_dest) != checksum:
+            log.error(
+                "stage_artifact: checksum mismatch for {0}".format(source)
+            )
+            os.unlink(tmp_dest)
+            return False
+    os.rename(tmp_dest, dest)
+    return True
+
+
 def stage_atomic_release(
         compose_id,
         compose_basedir=COMPOSE_BASEDIR,
         testing_basedir=ATOMIC_TESTING_BASEDIR,
-        dest_dir=ATOMIC_STABLE_DESTINATION):
+        dest_dir=ATOMIC_STABLE_DESTINATION,
+        workers=ATOMIC_STAGE_WORKERS):
     """
     stage_atomic_release
 
         stage the release somewhere, this will remove the old and rsync up the
         new twoweek release
 
+        Every artifact listed in a CHECKSUM file is staged and verified on its
+        own first, so an interrupted release does not need to copy the images
+        again. rsync then syncs the remaining files and removes the old ones.
+
     """
 
     source_loc = os.path.join(compose_basedir, compose_id)
+    link_loc = os.path.join(testing_basedir, compose_id)
+
+    artifacts = read_checksum_manifests(source_loc)
+
+    def stage(item):
+        source, checksum = item
+        relpath = os.path.relpath(source, source_loc)
+        try:
+            return stage_artifact(
+                source,
+                os.path.join(dest_dir, relpath),
+                checksum,
+                link_dest=os.path.join(link_loc, relpath),
+            )
+        except (IOError, OSError), e:
+            log.error("stage_artifact: {0} failed: {1}".format(source, e))
+            return False
+
+    pool = ThreadPool(workers)
+    try:
+        staged = pool.map(stage, sorted(artifacts.items()))
+    finally:
+        pool.close()
+        pool.join()
+    if not all(staged):
+        log.error("stage_atomic_release: staging artifacts failed")
+        exit(3)
 
     rsync_cmd = [
         'rsync -avhHP --delete-after',
-        '--link-dest={0}'.format(
-            os.path.join(
-                testing_basedir,
-                compose_id
-            )
-        ),
+        '--link-dest={0}'.format(link_loc),
         "{0}/*".format(source_loc),
         dest_dir
     ]
@@ -321,77 +534,119 @@ def stage_atomic_release(
         exit(3)
 
 
+def checksum_file_is_signed(cfile):
+    """
+    checksum_file_is_signed
+
+        Check the header of cfile for a PGP signature
+    """
+    with open(cfile, 'r') as f:
+        return f.read(len(PGP_SIGNED_HEADER)) == PGP_SIGNED_HEADER
+
+
+def sign_checksum_file(
+        key,
+        cfile,
+        passphrase,
+        signed_txt_dir=SIGUL_SIGNED_TXT_DIR,
+        retries=SIGUL_SIGN_RETRIES):
+    """
+    sign_checksum_file
+
+        Sign a single checksum file with sigul using its own temporary output
+        file and replace the checksum file with the signed version.
+
+    return -> bool
+        True if the file was signed
+    """
+    fd, signed_txt_path = tempfile.mkstemp(
+        prefix="signed-{0}-".format(os.path.basename(cfile)),
+        dir=signed_txt_dir,
+    )
+    os.close(fd)
+
+    sigulsign_cmd = [
+        "sigul", "--batch", "sign-text", "-o", signed_txt_path, key, cfile
+    ]
+    log.info("sign_checksum_files: Signing {0}".format(cfile))
+    for attempt in range(1, retries + 1):
+        child = subprocess.Popen(sigulsign_cmd, stdin=subprocess.PIPE)
+        child.communicate(passphrase + '\0')
+        if child.returncode == 0:
+            break
+        log.warn(
+            "sigul command for {0} failed, attempt {1}/{2}".format(
+                cfile, attempt, retries)
+        )
+        time.sleep(5 * attempt)
+    else:
+        log.error("sign_checksum_files: giving up on {0}".format(cfile))
+        os.unlink(signed_txt_path)
+        return False
+
+    if subprocess.call(["chgrp", "releng", signed_txt_path]) or \
+            subprocess.call(["chmod", "664", signed_txt_path]) or \
+            subprocess.call(
+                "sg releng 'mv {0} {1}'".format(signed_txt_path, cfile),
+                shell=True):
+        log.error(
+            "sign_checksum_files: sg releng 'mv {0} {1}' FAILED".format(
+                signed_txt_path,
+                cfile,
+            )
+        )
+        return False
+    return True
+
+
 def sign_checksum_files(
         key,
         artifact_path,
-        signed_txt_path=SIGUL_SIGNED_TXT_PATH):
+        passphrase=None,
+        signed_txt_dir=SIGUL_SIGNED_TXT_DIR,
+        workers=ATOMIC_STAGE_WORKERS):
     """
     sign_checksum_files
 
         Use sigul to sign checksum files onces we know the successfully tested
-        builds.
+        builds. The sigul passphrase is only asked for when there are
+        unsigned checksum files and no passphrase is given.
     """
 
     # Grab all the checksum_files
     checksum_files = []
     for full_dir_path, _, short_names in os.walk(artifact_path):
         for sname in fnmatch.filter(short_names, '*CHECKSUM'):
-            checksum_files.append(
-                os.path.join(
-                    full_dir_path,
-                    sname,
+            cfile = os.path.join(full_dir_path, sname)
+            # Check to make sure this file isn't already signed, if it is then
+            # don't sign it again
+            if checksum_file_is_signed(cfile):
+                log.info(
+                    "sign_checksum_files: {0} is already signed".format(cfile)
                 )
-            )
+                continue
+            checksum_files.append(cfile)
 
-    for cfile in checksum_files:
-
-        # Check to make sure this file isn't already signed, if it is then
-        # don't sign it again
-        already_signed = False
-        with open(cfile, 'r') as f:
-            for line in f.readlines():
-                if "-----BEGIN PGP SIGNED MESSAGE-----" in line:
-                    already_signed = True
-                    break
-        if already_signed:
-            log.info(
-                "sign_checksum_files: {0} is already signed".format(cfile)
-            )
-            continue
+    if not checksum_files:
+        return
 
-        shutil.copy(cfile, signed_txt_path)
+    if passphrase is None:
+        passphrase = getpass.getpass(
+            "Sigul passphrase for {0}: ".format(key))
 
-        # Basically all of this is ugly and I feel bad about it.
-        sigulsign_cmd = [
-            "sigul sign-text -o {0} {1} {2}".format(
-                signed_txt_path,
-                key,
-                cfile
-            ),
-            "&&",
-            "chgrp releng {0}".format(signed_txt_path),
-            "&&",
-            "chmod 664 {0}".format(signed_txt_path),
-        ]
-
-        log.info("sign_checksum_files: Signing {0}".format(cfile))
-        sigulsign_cmd = ' '.join(sigulsign_cmd)
-        while subprocess.call(sigulsign_cmd, shell=True):
-            log.warn(
-                "sigul command for {0} failed, retrying".format(cfile)
-            )
+    pool = ThreadPool(workers)
+    try:
+        signed = pool.map(
+            lambda cfile: sign_checksum_file(
+                key, cfile, passphrase, signed_txt_dir=signed_txt_dir),
+            checksum_files
+        )
+    finally:
+        pool.close()
+        pool.join()
 
-        if subprocess.call(
-            "sg releng 'mv {0} {1}'".format(signed_txt_path, cfile),
-            shell=True
-        ):
-            log.error(
-                "sign_checksum_files: sg releng 'mv {0} {1}' FAILED".format(
-                    signed_txt_path,
-                    cfile,
-                )
-            )
-            sys.exit(3)
+    if not all(signed):
+        sys.exit(3)
 
 
 def fedmsg_publish(topic, msg):
@@ -468,7 +723,6 @@ if __name__ == '__main__':
     if not pargs.release:
         log.error("No release arg passed, see -h for help")
         sys.exit(1)
-
     log.info("Querying datagrepper for latest AutoCloud successful tests")
     # Acquire the latest successful builds from datagrepper
     tested_autocloud_info = get_latest_successful_autocloud_test_info(
@@ -14,6 +14,8 @@ import subprocess
 import optparse
 import createrepo
 import sys
+import cPickle as pickle
+from multiprocessing import Pool
 
 
 
@@ -23,6 +25,8 @@ ARCHES = {'arm': ['arm', 'armhfp', 'aarch64'],
           's390': ['s390', 's390x']}
 #TARGETPATH = '/srv/pub/fedora-secondary/test/'
 TARGETPATH = '/srv/pub/fedora-secondary/'
+# cache of binary rpm path -> SOURCERPM, see loadIndex()
+INDEXFILE = os.path.expanduser('~/.cache/secondary-sync-index.pickle')
 
 
 
@@ -191,6 +195,57 @@ def getSRPM(rpmfilename):
          return None
     return h.sprintf('%{SOURCERPM}')
 
+def loadIndex(indexfile):
+    '''
+    Load the header index, a dict of binary rpm path ->
+    ((size, mtime, inode), SOURCERPM)
+    '''
+    try:
+        with open(indexfile, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, EOFError, pickle.UnpicklingError), e:
+        log.debug('Not using index %s: %s' % (indexfile, e))
+        return {}
+
+def saveIndex(index, indexfile):
+    ''' Atomically write the header index '''
+    indexdir = os.path.dirname(indexfile)
+    if indexdir and not os.path.isdir(indexdir):
+        os.makedirs(indexdir)
+    tmpfile = indexfile + '.tmp'
+    with open(tmpfile, 'wb') as f:
+        pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmpfile, indexfile)
+
+def getSRPMs(rpmfiles, oldindex, workers):
+    '''
+    Get the SRPM for each of the given binary rpm paths. Headers are only read
+    for rpms that are not in oldindex with the same size, mtime and inode,
+    using a pool of worker processes.
+    Returns the new index for rpmfiles.
+    '''
+    index = {}
+    toread = []
+    for rpmfile in rpmfiles:
+        st = os.stat(rpmfile)
+        key = (st.st_size, st.st_mtime, st.st_ino)
+        cached = oldindex.get(rpmfile)
+        if cached is not None and cached[0] == key:
+            index[rpmfile] = cached
+        else:
+            toread.append((rpmfile, key))
+    print "reading headers of %s new or changed rpms (%s cached)" % (
+        len(toread), len(index))
+    if toread:
+        pool = Pool(workers)
+        srpmfiles = pool.map(getSRPM, [f[0] for f in toread], chunksize=64)
+        pool.close()
+        pool.join()
+        for (rpmfile, key), srpmfile in zip(toread, srpmfiles):
+            if srpmfile is not None:
+                index[rpmfile] = (key, srpmfile)
+    return index
+
 def srpmLocation(base, package):
     ''' 
     Takes a base path for the sources rpm
@@ -227,8 +282,7 @@ def main(opts):
     # work out what SRPMS we need and what can be removed.
     srpms = {}
     existing_srpms = {}
-    to_sync_srpms = {}
-    to_delete_srpms = {}
+    rpmfiles = []
     sourcerepo = []
     for root, dirs, files in os.walk(TARGETPATH):
         if not root.find('/archive/') == -1 or not root.find('/.snapshot/') == -1 :
@@ -243,35 +297,29 @@ def main(opts):
             sourcerepo.append(root)
         for name in files:
             if name.endswith('rpm') and not name.endswith('src.rpm'):
-                srpmfile = getSRPM(os.path.join( root, name))
-                if not srpmfile == None:
-                    print "getting data for %s" % name
-                    srpms[srpmfile] = srpmLocation(root, name)
+                rpmfiles.append(os.path.join(root, name))
             if name.endswith('src.rpm'):
                 existing_srpms[name] = root
 
-    for srpm in zip(srpms.keys(), srpms.values()):
-        if srpm[0] not in existing_srpms.keys() and srpm[0] not in to_sync_srpms.keys():
-            print "Need: %s  At: %s" % (srpm[0], srpm[1])
-            to_sync_srpms[srpm[0]] = srpm[1] 
-
-    for srpm in zip(existing_srpms.keys(), existing_srpms.values()):
-        if srpm[0] not in srpms.keys() and srpm[0] not in to_delete_srpms.keys():
-            print "To Delete: %s" % srpm[0]
-            to_delete_srpms[srpm[0]] = srpm[1]
+    index = getSRPMs(rpmfiles, loadIndex(opts.index), opts.workers)
+    if not opts.only_show:
+        saveIndex(index, opts.index)
+    for rpmfile in rpmfiles:
+        if rpmfile in index:
+            root, name = os.path.split(rpmfile)
+            srpms[index[rpmfile][1]] = srpmLocation(root, name)
 
+    to_sync_srpms = set(srpms) - set(existing_srpms)
+    to_delete_srpms = set(existing_srpms) - set(srpms)
 
-    for files in zip(to_sync_srpms.keys(), to_sync_srpms.values()):
-        print files
-        srpm = files[0]
-        arch = files[1][0]
-        dest = files[1][1]
-        source = files[1][2]
+    for srpm in sorted(to_sync_srpms):
+        (arch, dest, source) = srpms[srpm]
+        print "Need: %s  At: %s" % (srpm, srpms[srpm])
         if not opts.only_show:
             syncSRPM(srpm, arch, dest, source)
 
-    for files in zip(to_delete_srpms.keys(), to_delete_srpms.values()):
-        srpmfile = os.path.join(files[1], files[0])
+    for srpm in sorted(to_delete_srpms):
+        srpmfile = os.path.join(existing_srpms[srpm], srpm)
         print "Removing: %s" % srpmfile
         if not opts.only_show:
             os.unlink(srpmfile)
@@ -306,6 +354,12 @@ if __name__ == '__main__':
                      default=False, help="Show what would be done but dont actually do it.")
     opt_p.add_option('-n', '--no-sync', action='store_true', dest='no_sync',
                      default=False, help="Skip syncing new bits.")
+    opt_p.add_option('-i', '--index', action='store', dest='index',
+                     default=INDEXFILE,
+                     help="File to cache rpm headers in (default: %default)")
+    opt_p.add_option('-w', '--workers', action='store', dest='workers',
+                     type='int', default=None,
+                     help="Processes reading rpm headers (default: cpu count)")
 
     (opts, args) = opt_p.parse_args()
 
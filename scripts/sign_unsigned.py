@@ -6,12 +6,17 @@ import md5
 import os
 import os.path
 import shutil
+import subprocess
 import sys
 import tempfile
+import threading
 import time
 import optparse
 import inspect
 import getpass
+from Queue import Queue
+
+import kojiutils
 
 # AbstractTool class
 #     parent for all classes, just to define the options only once
@@ -376,6 +381,14 @@ class SignUnsigned(CliTool, KojiTool):
         self.parser.add_option("--show-time", action="store_true")
         self.parser.add_option("--workdir")
         self.parser.add_option("--write-rpms", action="store_true")
+        self.parser.add_option("--sig-cache", default=os.path.expanduser(
+            "~/.cache/sign_unsigned-sigs.pickle"))
+        self.parser.add_option("--query-threads", type="int", default=4)
+        self.parser.add_option("--query-chunk-size", type="int", default=500)
+        self.parser.add_option("--copy-threads", type="int", default=4)
+        self.parser.add_option("--sign-workers", type="int", default=1,
+            help="Concurrent signing processes, only use more than one if "
+                 "signing does not prompt for a passphrase")
         self.gpg_keys = {'37017186': { 'name': 'redhatrelease',
                           'description': 'Red Hat, Inc. (release key) <security@redhat.com>',
                           'signing_server_id': 'redhatrelease' },
@@ -420,26 +433,22 @@ class SignUnsigned(CliTool, KojiTool):
             }
         self.body_header_tags = ['siggpg', 'sigpgp']
         self.head_header_tags = ['dsaheader', 'rsaheader']
+        self.sig_rank_tables = {}
+        self.use_reflink = None
 
 
     def get_key_name(self, keyid):
         return self.gpg_keys[keyid.upper()]['name']
 
-    def sig_level(self, sigs, level='rawhide', exact=False):
-        """Check if signature(s) satisfy required level"""
+    def sig_rank_table(self, level='rawhide', exact=False):
+        """Return a dict of signature -> rank for all signatures that satisfy
+        the required level, the required level itself has rank 0"""
+        key = (level, exact)
+        if key in self.sig_rank_tables:
+            return self.sig_rank_tables[key]
 
         orderings = [['fedora-rawhide', 'rawhide', 'fedora-test', 'fedora-gold', 'f10-test', 'f10', 'f11'],
              ['beta', 'security', 'gold', 'redhatrelease']]
-        if not sigs:
-             return False
-        sigs = [ x for x in sigs if x ]
-        if not sigs:
-             return False
-        for i in range(0, len(sigs)):
-             try:
-                  sigs[i] = self.get_key_name(sigs[i])
-             except KeyError:
-                  pass
         if exact:
             valid = [level]
         else:
@@ -451,32 +460,107 @@ class SignUnsigned(CliTool, KojiTool):
             if not valid:
                  #raise RuntimeError, "could not find level %s" % level
                  valid = [level]
-        for lvl in valid:
-             if lvl.lower() in sigs or lvl.upper() in sigs:
-                  return True
+        table = {}
+        for rank, lvl in enumerate(valid):
+            # signatures are either key ids or names of unknown keys
+            for name in (lvl.lower(), lvl.upper()):
+                table.setdefault(name, rank)
+                for keyid, data in self.gpg_keys.items():
+                    if data['name'] == name:
+                        table.setdefault(keyid.lower(), rank)
+                        table.setdefault(keyid.upper(), rank)
+        self.sig_rank_tables[key] = table
+        return table
+
+    def sig_level(self, sigs, level='rawhide', exact=False):
+        """Check if signature(s) satisfy required level"""
+        if not sigs:
+             return False
+        table = self.sig_rank_table(level, exact)
+        for sig in sigs:
+            if sig and sig in table:
+                return True
         return False
 
+    def load_sig_cache(self):
+        """Return the cached signatures, a dict of rpm id -> list of sigkeys"""
+        return kojiutils.load_pickle(self.options.sig_cache, {})
+
+    def save_sig_cache(self, sig_cache):
+        if self.options.test:
+            return
+        try:
+            kojiutils.save_pickle(self.options.sig_cache, sig_cache)
+        except (IOError, OSError), e:
+            self.print_msg("Warning: cannot write signature cache: %s" % e)
+
+    def query_sigs(self, rpm_ids):
+        """Return a dict of rpm id -> list of sigkeys, querying koji with
+        several sessions in chunked multicalls"""
+        chunk_size = self.options.query_chunk_size
+        chunks = Queue()
+        for i in range(0, len(rpm_ids), chunk_size):
+            chunks.put(rpm_ids[i:i + chunk_size])
+        sig_idx = dict((rpm_id, []) for rpm_id in rpm_ids)
+        errors = []
+
+        def worker():
+            session = None
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    break
+                # keep consuming chunks after errors, so every chunk is
+                # accounted for and the error is raised below
+                try:
+                    if session is None:
+                        session = koji.ClientSession(self.options.kojihub,
+                                                     self.options.__dict__)
+                    session.multicall = True
+                    for rpm_id in chunk:
+                        session.queryRPMSigs(rpm_id=rpm_id)
+                    results = session.multiCall()
+                except Exception, e:
+                    errors.append(e)
+                    continue
+                for rpm_id, result in zip(chunk, results):
+                    if isinstance(result, dict):
+                        errors.append(result)
+                        continue
+                    # each rpm id is only part of one chunk
+                    sig_idx[rpm_id] = [row['sigkey'] for row in result[0]]
+
+        threads = []
+        for i in range(max(self.options.query_threads, 1)):
+            chunks.put(None)
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise RuntimeError, "Error reading signature data: %r" % errors[0]
+        return sig_idx
+
     def find_uncached(self, rpms, level='rawhide'):
         """Return the rpms that do not have a cached signature of sufficient level"""
         ret = []
-        self.print_debug("Reading signature data")
-        sigdata = []
-        self.koji_session.multicall = True
-        for rinfo in rpms:
-            self.koji_session.queryRPMSigs(rpm_id=rinfo['id'])
-        results = self.koji_session.multiCall()
-        for result in results:
-            sigdata.extend(result[0])
-        sig_idx = {}
-        #index by rpm and sigkey
-        self.print_debug("Indexing %d signatures" % len(sigdata))
-        for row in sigdata:
-            sig_idx.setdefault(row['rpm_id'], []).append(row['sigkey'])
+        sig_cache = self.load_sig_cache()
+        # signatures are not removed, so rpms with a sufficient signature in
+        # the local cache do not need to be checked again
+        to_query = [rinfo['id'] for rinfo in rpms
+                    if not self.sig_level(sig_cache.get(rinfo['id']),
+                                          level=level)]
+        self.print_debug("Reading signature data (%d of %d rpms not cached)" %
+                         (len(to_query), len(rpms)))
+        sig_cache.update(self.query_sigs(to_query))
+        self.save_sig_cache(sig_cache)
         i = 0
         for rpminfo in rpms:
             i += 1
             self.print_debug("%d/%d: checking %s" % (i, len(rpms), self.rpm_nvra(rpminfo)))
-            sigs = sig_idx.get(rpminfo['id'], [])
+            sigs = sig_cache.get(rpminfo['id'], [])
             self.print_debug("found sigs: %r" % sigs)
             if not self.sig_level(sigs, level=level):
                 self.print_debug("uncached")
@@ -628,30 +712,118 @@ class SignUnsigned(CliTool, KojiTool):
                   cmd = "rpm --define '_gpg_name %s' --define '_signature gpg' --resign %s"  % (self.get_key_description(keyid), ' '.join(paths))
          return cmd
 
-    def do_signing(self, pathargs, level):
-        """Use rpm to sign packages"""
-        mypaths = list(pathargs)
-        while len(mypaths):
-            if self.options.server:
-                nlen = 25
-            else:
-                nlen = 1000
-            cmd = self.get_signing_command(level, mypaths[:nlen], server=self.options.server)
-            del mypaths[:nlen]
-            if self.options.test:
-                self.print_msg("would have run: %s" % cmd)
-            else:
-                self.print_debug("Running: %s" % cmd)
-                # loop in case password is mistyped
-                while os.system(cmd):
-                    # sleep briefly (give user a chance to ctrl-C)
-                    time.sleep(2)
+    def signing_chunks(self, pathargs, workers=1):
+        """Split paths into chunks for the signing command, using at least one
+        chunk per worker"""
+        if self.options.server:
+            nlen = 25
+        else:
+            nlen = 1000
+        nlen = max(1, min(nlen, (len(pathargs) + workers - 1) / workers))
+        return [pathargs[i:i + nlen] for i in range(0, len(pathargs), nlen)]
+
+    def sign_chunk(self, paths, level):
+        cmd = self.get_signing_command(level, paths, server=self.options.server)
+        if self.options.test:
+            self.print_msg("would have run: %s" % cmd)
+        else:
+            self.print_debug("Running: %s" % cmd)
+            # loop in case password is mistyped
+            while os.system(cmd):
+                # sleep briefly (give user a chance to ctrl-C)
+                time.sleep(2)
+
+    def do_signing_parallel(self, pathargs, level):
+        """Use rpm to sign packages with --sign-workers concurrent processes
+
+        Yields (chunk, success) for each chunk of paths as soon as it is done
+        """
+        workers = max(self.options.sign_workers, 1)
+        chunks = self.signing_chunks(list(pathargs), workers)
+        todo = Queue()
+        done = Queue()
+        for chunk in chunks:
+            todo.put(chunk)
+
+        def worker():
+            while True:
+                chunk = todo.get()
+                if chunk is None:
+                    break
+                try:
+                    self.sign_chunk(chunk, level)
+                except Exception, e:
+                    self.print_msg("Error signing %s: %s" % (chunk, e))
+                    done.put((chunk, False))
+                else:
+                    done.put((chunk, True))
+
+        for i in range(workers):
+            todo.put(None)
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+        for i in range(len(chunks)):
+            yield done.get()
+
+    def copy_rpm(self, src, dst):
+        """Copy src to dst, as a reflink if the filesystem supports it"""
+        if self.use_reflink is not False:
+            with open(os.devnull, 'w') as devnull:
+                ret = subprocess.call(['cp', '--reflink=always', src, dst],
+                                      stderr=devnull)
+            if ret == 0:
+                self.use_reflink = True
+                return
+            if self.use_reflink is None:
+                self.print_debug("Reflinks not supported, copying packages")
+                self.use_reflink = False
+        shutil.copyfile(src, dst)
+
+    def stage_rpms(self, rpms, workdir):
+        """Copy rpms into workdir with --copy-threads threads
+
+        Returns a dict of staged path -> rpminfo
+        """
+        staged = {}
+        jobs = Queue()
+        for rpminfo in rpms:
+            src = self.rpm_path(rpminfo)
+            fn = "%s.rpm" % self.rpm_nvra(rpminfo)
+            dst = "%s/%s" % (workdir, fn)
+            staged[dst] = rpminfo
+            if not self.options.test:
+                jobs.put((src, dst))
+        errors = []
+
+        def worker():
+            while True:
+                job = jobs.get()
+                if job is None:
+                    break
+                try:
+                    self.copy_rpm(*job)
+                except (IOError, OSError), e:
+                    errors.append(e)
+
+        threads = []
+        for i in range(max(self.options.copy_threads, 1)):
+            jobs.put(None)
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return staged
 
     def sign_to_cache(self, rpms, level):
         """Sign and cache the signatures
 
-        We sign duplicate copies and import the signature headers. The original rpms
-        remain unchanged.
+        We sign duplicate copies and import the signature headers as soon as
+        each chunk is signed. The original rpms remain unchanged.
         """
         if not rpms:
             self.print_debug("No unsigned rpms")
@@ -664,20 +836,16 @@ class SignUnsigned(CliTool, KojiTool):
         workdir = tempfile.mkdtemp(prefix='sign_unsigned.', dir=self.options.workdir)
         self.print_debug("Using workdir: %s" % workdir)
         self.print_debug("Copying packages")
-        pkglist = []
-        for rpminfo in rpms:
-            src = self.rpm_path(rpminfo)
-            fn = "%s.rpm" % self.rpm_nvra(rpminfo)
-            dst = "%s/%s" % (workdir, fn)
-            if not self.options.test:
-                shutil.copyfile(src, dst)
-            pkglist.append(dst)
+        staged = self.stage_rpms(rpms, workdir)
         self.print_debug("Signing copies")
-        self.do_signing(pkglist, level)
+        for chunk, success in self.do_signing_parallel(sorted(staged), level):
+            if self.options.test or not success:
+                continue
+            self.print_msg("Importing signatures (%d rpms)" % len(chunk))
+            self.import_sig_from_files([staged[path] for path in chunk],
+                                       level, workdir)
         if self.options.test:
             return
-        self.print_msg("Importing signatures")
-        self.import_sig_from_files(rpms, level, workdir)
         if self.options.write_rpms:
             self.print_msg("Writing RPMs")
             self.write_sigs(rpms, self.get_key_id(level).lower())
@@ -19,7 +19,10 @@ import getpass
 import shutil
 import subprocess
 import tempfile
+import threading
+import time
 import logging
+from Queue import Queue
 
 import gpgme
 
@@ -320,9 +323,9 @@ def writeRPMs(status, kojihelper, batch=None):
             written += 1
             logging.debug('Writing out %s with %s, %s of %s',
                           rpm, key, written, rpmcount)
-        errors = kojihelper.write_signed_rpms(workset, KEYS[key]['id'])
+        write_errors = kojihelper.write_signed_rpms(workset, KEYS[key]['id'])
 
-        for rpm, result in errors.items():
+        for rpm, result in write_errors.items():
             logging.error('Error writing out %s' % rpm)
             errors.setdefault('Writing', []).append(rpm)
             if result['traceback']:
@@ -409,6 +412,159 @@ class SigulHelper(object):
         return command + rpms
 
 
+class SigningPipeline(object):
+    """ Sign RPMs with several concurrent sigul processes and write out the
+    signed copies in koji while later batches are still being signed.
+
+    Batches flow through two bounded queues: the main thread feeds the sign
+    queue, ``sigul_workers`` threads run sigul (retrying failed batches) and
+    hand signed batches to ``koji_writers`` threads, each of which owns its
+    own KojiHelper since koji sessions are not thread safe.
+    """
+    write_chunk_size = 100
+
+    def __init__(self, sigul_helper, keyid, arch=None, batch_size=50,
+                 sigul_workers=4, koji_writers=2, retries=2, retry_delay=10,
+                 write=True):
+        self.sigul_helper = sigul_helper
+        self.keyid = keyid
+        self.arch = arch
+        self.batch_size = batch_size
+        self.sigul_workers = sigul_workers
+        self.koji_writers = koji_writers if write else 0
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self.sign_queue = Queue(maxsize=2 * sigul_workers)
+        self.write_queue = Queue(maxsize=2 * max(koji_writers, 1))
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.signed = []
+        self.written = []
+        self.errors = {}
+
+    def _add_error(self, kind, rpms):
+        if not rpms:
+            return
+        with self.lock:
+            self.errors.setdefault(kind, []).extend(rpms)
+
+    def _sign_batch(self, batchnr, rpms):
+        """ Run sigul for one batch, retrying it up to self.retries times.
+        Returns True when the batch was signed. """
+        command = self.sigul_helper.build_sign_cmdline(rpms)
+        for attempt in range(self.retries + 1):
+            if attempt:
+                logging.warning('Retrying batch %s (attempt %s/%s)',
+                                batchnr, attempt + 1, self.retries + 1)
+                time.sleep(self.retry_delay * attempt)
+            logging.info('Signing batch %s/%s with %s rpms', batchnr,
+                         self.batches, len(rpms))
+            logging.debug('Running %s', subprocess.list2cmdline(command))
+            ret, stdout, stderr = self.sigul_helper.run_command(command)
+            if ret == 0:
+                return True
+            logging.error('Error signing batch %s: %s', batchnr,
+                          stderr.strip())
+        return False
+
+    def _sigul_worker(self):
+        while True:
+            item = self.sign_queue.get()
+            if item is None:
+                break
+            batchnr, rpms = item
+            try:
+                signed = self._sign_batch(batchnr, rpms)
+            except Exception as error:
+                # keep draining the queue, the producer blocks on put()
+                logging.error('Error signing batch %s: %s', batchnr, error)
+                signed = False
+            if signed:
+                with self.lock:
+                    self.signed.extend(rpms)
+                if self.koji_writers:
+                    self.write_queue.put(item)
+            else:
+                logging.error('Giving up on signing %s', rpms)
+                self._add_error('Signing', rpms)
+
+    def _koji_writer(self):
+        kojihelper = None
+        while True:
+            item = self.write_queue.get()
+            if item is None:
+                break
+            batchnr, rpms = item
+            if kojihelper is None:
+                try:
+                    kojihelper = KojiHelper(arch=self.arch)
+                except Exception as error:
+                    # keep draining the queue, the signers block on put()
+                    logging.error('Error logging into koji for batch %s: %s',
+                                  batchnr, error)
+                    self._add_error('Writing', rpms)
+                    continue
+            logging.info('Writing out batch %s with %s rpms', batchnr,
+                         len(rpms))
+            for start in range(0, len(rpms), self.write_chunk_size):
+                workset = rpms[start:start + self.write_chunk_size]
+                try:
+                    write_errors = kojihelper.write_signed_rpms(workset,
+                                                                self.keyid)
+                except Exception as error:
+                    logging.error('Error writing out batch %s: %s',
+                                  batchnr, error)
+                    self._add_error('Writing', workset)
+                    continue
+                for rpm, result in write_errors.items():
+                    logging.error('Error writing out %s' % rpm)
+                    if result['traceback']:
+                        logging.error('    ' + result['traceback'][-1])
+                self._add_error('Writing', write_errors.keys())
+                with self.lock:
+                    self.written.extend(
+                        [rpm for rpm in workset if rpm not in write_errors])
+
+    def _start(self, target, count):
+        threads = []
+        for _ in range(count):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def run(self, rpms):
+        """ Sign (and write out) rpms, returns the number of failed rpms
+        """
+        start = time.time()
+        batches = [rpms[i:i + self.batch_size]
+                   for i in range(0, len(rpms), self.batch_size)]
+        self.batches = len(batches)
+
+        signers = self._start(self._sigul_worker, self.sigul_workers)
+        writers = self._start(self._koji_writer, self.koji_writers)
+
+        for batchnr, batch in enumerate(batches, 1):
+            self.sign_queue.put((batchnr, batch))
+        for _ in signers:
+            self.sign_queue.put(None)
+        for thread in signers:
+            thread.join()
+        for _ in writers:
+            self.write_queue.put(None)
+        for thread in writers:
+            thread.join()
+
+        failed = sum(len(rpms) for rpms in self.errors.values())
+        logging.warning(
+            'Signed %s/%s rpms in %s batches, wrote %s, %s failures '
+            '(%.1f seconds)', len(self.signed), len(rpms), len(batches),
+            len(self.written), failed, time.time() - start)
+        return failed
+
+
 if __name__ == "__main__":
     # Define our usage
     usage = 'usage: %prog [options] key (build1, build2)'
@@ -437,6 +593,16 @@ if __name__ == "__main__":
     parser.add_option('--sigul-batch-size',
                       help='Amount of RPMs to sign in a sigul batch',
                       default=50, type="int")
+    parser.add_option('--sigul-workers',
+                      help='Amount of sigul processes to run in parallel',
+                      default=4, type="int")
+    parser.add_option('--koji-writers',
+                      help='Amount of parallel koji sessions writing out '
+                      'signed rpms',
+                      default=2, type="int")
+    parser.add_option('--sigul-retries',
+                      help='How often to retry a failed sigul batch',
+                      default=2, type="int")
     parser.add_option('--sigul-config-file',
                       help='Config file to use for sigul',
                       default=None, type="str")
@@ -574,40 +740,20 @@ if __name__ == "__main__":
 
     # run sigul
     logging.debug('Found %s unsigned rpms' % len(unsigned))
-    batchsize = opts.sigul_batch_size
-
-    def run_sigul(rpms, batchnr):
-        global status
-        logging.info('Signing batch %s/%s with %s rpms' % (
-            batchnr, (total + batchsize - 1) / batchsize, len(rpms))
-        )
-        command = sigul_helper.build_sign_cmdline(rpms)
-        logging.debug('Running %s' % subprocess.list2cmdline(command))
-        ret = sigul_helper.run_command(command)[0]
-        if ret != 0:
-            logging.error('Error signing %s' % (rpms))
-            for rpm in rpms:
-                errors.setdefault('Signing', []).append(rpm)
-        status += 1
-
     logging.info('Signing rpms via sigul')
-    total = len(unsigned)
-    batchnr = 0
-    rpms = []
-    for rpm in unsigned:
-        rpms += [rpm]
-        if len(rpms) == batchsize:
-            batchnr += 1
-            run_sigul(rpms, batchnr)
-            rpms = []
-
-    if len(rpms) > 0:
-        batchnr += 1
-        run_sigul(rpms, batchnr)
-
-    # Now that we've signed things, time to write them out, if so desired.
-    if not opts.just_sign:
+    # --write-all writes out every rpm once signing is done, so the pipeline
+    # only needs to write out signed batches on its own otherwise
+    pipeline = SigningPipeline(
+        sigul_helper, KEYS[key]['id'], arch=opts.arch,
+        batch_size=opts.sigul_batch_size, sigul_workers=opts.sigul_workers,
+        koji_writers=opts.koji_writers, retries=opts.sigul_retries,
+        write=not (opts.just_sign or opts.write_all))
+    status = 1 if pipeline.run(unsigned) else status
+    for kind, rpms in pipeline.errors.items():
+        errors.setdefault(kind, []).extend(rpms)
+
+    if opts.write_all and not opts.just_sign:
         exit(writeRPMs(status, kojihelper))
 
     logging.info('All done.')
-    sys.exit(status)
+    exit(status)
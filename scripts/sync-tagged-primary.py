@@ -18,14 +18,28 @@ import tempfile
 import shutil
 import rpm
 import argparse
+import json
 
 # get architecture and tags from command line
 parser = argparse.ArgumentParser()
 parser.add_argument("--dry-run", help="no changes will be made", action="store_true")
 parser.add_argument("arch", help="secondary arch to sync")
 parser.add_argument("tag", nargs="+", help="tag to sync")
+parser.add_argument("--diff", metavar="FILE",
+                    help="take the latest builds of the compared tag from "
+                    "the output of koji-compare.py --json")
 args = parser.parse_args()
 
+diff = None
+if args.diff:
+    with open(args.diff) as difffile:
+        diff = json.load(difffile)
+    if diff['arch'] != args.arch:
+        parser.error("%s compares arch %s" % (args.diff, diff['arch']))
+    # getTagged() does not include inherited builds, so neither may the diff
+    if diff['inherit']:
+        parser.error("%s includes inherited builds" % args.diff)
+
 # Should probably set these from a koji config file
 SERVERCA = os.path.expanduser('~/.fedora-server-ca.cert')
 CLIENTCA = os.path.expanduser('~/.fedora-upload-ca.cert')
@@ -66,16 +80,18 @@ for tag in args.tag:
     secblocked = [] # holding for blocked pkgs
     totag = []
     tountag = []
-    pripkgnvrs = []
-    secpkgnvrs = []
 
-    pripkgs = getTagged(kojisession, tag)
-    secpkgs = getTagged(seckojisession, tag)
+    if diff and diff['tag'] == tag:
+        pripkgs = [entry['remote'] for entry in diff['packages']
+                   if entry['remote']]
+        secpkgs = [entry['local'] for entry in diff['packages']
+                   if entry['local']]
+    else:
+        pripkgs = getTagged(kojisession, tag)
+        secpkgs = getTagged(seckojisession, tag)
 
-    for pkg in pripkgs:
-        pripkgnvrs.append(pkg['nvr'])
-    for pkg in secpkgs:
-        secpkgnvrs.append(pkg['nvr'])
+    pripkgnvrs = set(pkg['nvr'] for pkg in pripkgs)
+    secpkgnvrs = set(pkg['nvr'] for pkg in secpkgs)
 
     for pkg in pripkgs:
         if pkg['nvr'] not in secpkgnvrs:
@@ -6,6 +6,10 @@
 import os
 import sys
 import sets
+import cPickle as pickle
+import hashlib
+import heapq
+import itertools
 import yum
 import koji
 import yum.Errors
@@ -50,6 +54,12 @@ known_good = {
 # Where to checkout owners/owners.list
 ownersworkdir = '/srv/extras-push/work'
 
+# Koji hub and tags to look up the latest builds of broken packages in
+koji_server = "http://koji.fedoraproject.org/kojihub"
+koji_tags = ["dist-rawhide"]
+# Number of calls per koji multicall
+koji_multicall_size = 100
+
 
 def parseArgs():
     usage = "usage: %s [options (see -h)]" % sys.argv[0]
@@ -71,6 +81,10 @@ def parseArgs():
                       "not all newer ones")
     parser.add_option("-m", "--missing", default=False, action="store_true",
                       help="check for packages missing in newer repos")
+    parser.add_option("-i", "--indexdir",
+                      default=os.path.expanduser('~/.cache/upgradecheck'),
+                      help="directory to keep the per-repo package indexes "
+                      "in between runs")
     (opts, args) = parser.parse_args()
     return (opts, args)
 
@@ -80,42 +94,146 @@ class MySolver(yum.YumBase):
 
         self.arch = arch
         self.doConfigSetup(fn = config)
-        if hasattr(self.repos, 'sqlite'):
-            self.repos.sqlite = False
-            self.repos._selectSackType()
+        self.sackSetup = False
 
     def readMetadata(self):
+        # Only fetches repomd.xml, the sacks get populated on demand by
+        # repoIndex
         self.doRepoSetup()
-        self.doSackSetup(archs)
-        for repo in self.repos.listEnabled():
-            self.repos.populateSack(which=[repo.id])
+
+    def populateRepo(self, repo):
+        if not self.sackSetup:
+            self.doSackSetup(archs)
+            self.sackSetup = True
+        self.repos.populateSack(which=[repo.id])
 
     def log(self, value, msg):
         pass
 
+def repomdChecksum(repo):
+    try:
+        f = open(os.path.join(repo.cachedir, 'repomd.xml'), 'rb')
+    except IOError:
+        return None
+    try:
+        return hashlib.sha256(f.read()).hexdigest()
+    finally:
+        f.close()
+
+def sortKey(name):
+    return (name.lower(), name)
+
+def repoIndex(solver, repo, indexdir):
+    """Return the sorted list of (sort key, name, evr, repo id) of the newest
+    package of each name in repo. The list is kept in indexdir and only
+    rebuilt from the metadata when the repomd.xml of the repo changes."""
+    checksum = repomdChecksum(repo)
+    indexfile = os.path.join(indexdir, '%s.index' % repo.id)
+    try:
+        f = open(indexfile, 'rb')
+        try:
+            (oldchecksum, index) = pickle.load(f)
+        finally:
+            f.close()
+        if checksum and oldchecksum == checksum:
+            return index
+    except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+        pass
+
+    solver.populateRepo(repo)
+    newest = {}
+    for pkg in solver.pkgSack.returnPackages(repoid=repo.id):
+        evr = (pkg.epoch, pkg.version, pkg.release)
+        if pkg.name not in newest or compareEVR(evr, newest[pkg.name]) > 0:
+            newest[pkg.name] = evr
+    index = [(sortKey(name), name, evr, repo.id)
+             for (name, evr) in newest.iteritems()]
+    index.sort()
+
+    if checksum:
+        if not os.path.isdir(indexdir):
+            os.makedirs(indexdir)
+        f = open(indexfile + '.tmp', 'wb')
+        try:
+            pickle.dump((checksum, index), f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(indexfile + '.tmp', indexfile)
+    return index
+
+def distPackages(indexes):
+    """Yield (sort key, name, {"evr": evr, "repo": repo id}) for the newest
+    package of each name in the repo indexes of a dist, sorted by name"""
+    for (key, name), entries in itertools.groupby(heapq.merge(*indexes),
+                                                  lambda x: x[:2]):
+        newest = None
+        for (key, name, evr, repoid) in entries:
+            if not newest or compareEVR(evr, newest["evr"]) > 0:
+                newest = {"evr": evr, "repo": repoid}
+        yield (key, name, newest)
+
+def mergeDists(enabled_dists, indexes):
+    """Walk the package indexes of all dists at once in name order, yielding
+    (name, [package data or None for each dist])"""
+    streams = []
+    for (i, dist) in enumerate(enabled_dists):
+        streams.append(((key, name, i, data) for (key, name, data)
+                        in distPackages(indexes[dist])))
+    for (key, name), entries in itertools.groupby(heapq.merge(*streams),
+                                                  lambda x: x[:2]):
+        pkgdata = [None] * len(enabled_dists)
+        for (key, name, i, data) in entries:
+            pkgdata[i] = data
+        yield (name, pkgdata)
+
 def evrstr(evr):
     return evr and "%s:%s-%s" % evr or "(missing)"
 
-def koji_get_info(name, report, pkg_evr, tags=["dist-rawhide"]):
-    koji_server = "http://koji.fedoraproject.org/kojihub"
+def koji_get_info(lookups, tags=koji_tags):
+    """Look up the latest builds of all the (name, evr) lookups in tags over
+    one koji session. Returns a dict of (name, evr) to the report lines for
+    the builds that are newer than evr."""
     koji_session = koji.ClientSession(koji_server, {})
     fmt = "     %(nvr)-40s %(tag_name)-20s %(owner_name)s"
 
-    for tag in tags:
-        pkg = koji_session.getLatestBuilds(tag, package=name);
-        if len(pkg) == 0:
-            continue
-        evr = ()
-        e = u'0'
-        if pkg[0]['epoch']:
-            e = u'%s' % pkg[0]['epoch']
-        v = u'%s' % pkg[0]['version']
-        r = u'%s' % pkg[0]['release']
-        evr = e, v, r
-        if compareEVR(evr, pkg_evr) > 0:
-            output = [ fmt % x for x in pkg ]
-            for line in output:
-                report.append(line)
+    lookups = sorted(set(lookups))
+    calls = [(name, tag) for (name, pkg_evr) in lookups for tag in tags]
+    results = []
+    for i in range(0, len(calls), koji_multicall_size):
+        koji_session.multicall = True
+        for (name, tag) in calls[i:i + koji_multicall_size]:
+            koji_session.getLatestBuilds(tag, package=name)
+        results.extend(koji_session.multiCall())
+
+    info = {}
+    results = iter(results)
+    for (name, pkg_evr) in lookups:
+        lines = info[(name, pkg_evr)] = []
+        for tag in tags:
+            result = results.next()
+            if isinstance(result, dict) or len(result[0]) == 0:
+                continue
+            pkg = result[0]
+            evr = ()
+            e = u'0'
+            if pkg[0]['epoch']:
+                e = u'%s' % pkg[0]['epoch']
+            v = u'%s' % pkg[0]['version']
+            r = u'%s' % pkg[0]['release']
+            evr = e, v, r
+            if compareEVR(evr, pkg_evr) > 0:
+                lines.extend([ fmt % x for x in pkg ])
+    return info
+
+def expand_koji_info(report, info):
+    """Replace the (name, evr) placeholders in report with the koji info"""
+    expanded = []
+    for line in report:
+        if isinstance(line, tuple):
+            expanded.extend(info[line])
+        else:
+            expanded.append(line)
+    return expanded
 
 def main():
     (opts, cruft) = parseArgs()
@@ -156,41 +274,26 @@ def main():
     if not opts.quiet:
         print 'Reading in repository metadata - please wait....'
 
+    indexes = {}
     for dist in solvers.keys():
         try:
             solvers[dist].readMetadata()
+            indexes[dist] = [repoIndex(solvers[dist], repo, opts.indexdir)
+                             for repo in solvers[dist].repos.listEnabled()]
         except yum.Errors.RepoError, e:
             print 'Metadata read error for dist %s, excluding it' % dist
             del solvers[dist]
 
-    pkgdict = {}
-    for dist in dists:
-        pkgdict[dist] = {}
-
     enabled_dists = solvers.keys()
     enabled_dists.sort()
 
-    allnames = {} # Python < 2.4 compat, otherwise we'd use sorted(set(...))
-    for dist in enabled_dists:
-        # Would use returnNewestByName() but it's broken in yum 3.0.1 (#220841)
-        # returnNewestByNameArch() works for our purposes as long as we only
-        # deal with one arch (src).
-        for pkg in solvers[dist].pkgSack.returnNewestByNameArch():
-            if pkg.name[-10:] == "-debuginfo": pass
-            allnames[pkg.name] = 1
-            pkgdict[dist][pkg.name] = {
-                "evr": (pkg.epoch, pkg.version, pkg.release),
-                "repo": pkg.repoid,
-                }
-    allnames = allnames.keys()
-    allnames.sort(lambda x, y: cmp(x.lower(), y.lower()))
-
     report = []
     missing_report = []
     reports = {}  # report per owner, key is owner email addr
 
-    for name in allnames:
-        pkgdata = map(lambda x: pkgdict[x].get(name), enabled_dists)
+    # The koji lookups are done in one go after this pass, until then the
+    # reports hold (name, evr) placeholders for their output
+    for (name, pkgdata) in mergeDists(enabled_dists, indexes):
         broken_paths = []
 
         for i in range(len(pkgdata)):
@@ -207,7 +310,7 @@ def main():
                         missing = "%s %s %s not in next repo" % \
                         (name, evrstr(curr["evr"]), curr["repo"])
                         missing_report.append(missing)
-                        koji_get_info(name, missing_report, pkg_evr = curr["evr"])
+                        missing_report.append((name, curr["evr"]))
                         missing_report.append("")
                     continue
 
@@ -239,10 +342,15 @@ def main():
                         evrstr(broken[0]["evr"]), evrstr(broken[1]["evr"]))
                 reports[owner].append(what)
                 report.append(what)
-                koji_get_info(name, report, pkg_evr = broken[1]["evr"])
+                report.append((name, broken[1]["evr"]))
             reports[owner].append("")
             report.append("")
 
+    info = koji_get_info([line for line in report + missing_report
+                          if isinstance(line, tuple)])
+    report = expand_koji_info(report, info)
+    missing_report = expand_koji_info(missing_report, info)
+
     # Insert "sorted by owner" report at the top.
     oldreport = report
     report = []